@@ -28,6 +28,16 @@ if db_engine == 'django.db.backends.sqlite3':
     DATABASES['default']['NAME'] = os.environ.get('DB_NAME', 'db.sqlite3')
 
 
+# a cache shared by all the processes, e.g. CACHE_BACKEND=django_redis.cache.RedisCache
+# with CACHE_LOCATION=redis://redis:6379/1
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
 DEFAULT_FILE_STORAGE = os.environ.get(
     'DEFAULT_FILE_STORAGE',
     'django.core.files.storage.FileSystemStorage')
@@ -36,8 +46,25 @@ AWS_S3_REGION_NAME = os.environ.get('AWS_STORAGE_BUCKET_NAME')
 AWS_S3_ENDPOINT_URL = os.environ.get('AWS_S3_ENDPOINT_URL')
 AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
-AWS_DEFAULT_ACL = os.environ.get('AWS_DEFAULT_ACL', 'public-read')
+# files of private albums must not be readable from the bucket
+AWS_DEFAULT_ACL = os.environ.get('AWS_DEFAULT_ACL', 'private')
 AWS_S3_CUSTOM_DOMAIN = os.environ.get('AWS_S3_CUSTOM_DOMAIN')
+# pages link the files to /files/, which checks the access and redirects
+# to a url signed for IMS_SIGNED_URL_EXPIRE seconds, the urls of the
+# storage are never sent
+AWS_QUERYSTRING_AUTH = False
+# stored files are addressed by their sha1 and never change, shared caches
+# may only keep the files of a public bucket
+AWS_S3_OBJECT_PARAMETERS = {
+    'CacheControl': '%s, max-age=31536000, immutable' % (
+        'public' if AWS_DEFAULT_ACL.startswith('public') else 'private'),
+}
+
+IMS_ASYNC_DERIVATIVES = os.environ.get('IMS_ASYNC_DERIVATIVES') == 'on'
 
 STATIC_ROOT = '/var/www/static'
 MEDIA_ROOT = '/var/www/media'
+# /files/ checks the access then nginx sends the file from the internal
+# /protected/ location of nginx/site.conf
+IMS_X_ACCEL_REDIRECT_PREFIX = os.environ.get('IMS_X_ACCEL_REDIRECT_PREFIX',
+                                             '/protected/')
@@ -27,9 +27,63 @@ DEBUG = True
 
 ALLOWED_HOSTS = []
 
-MEDIA_URL = '/images/'
+# image files are only served by /files/, which checks their albums
+MEDIA_URL = '/files/'
 MEDIA_ROOT = './media/'
 
+# Generate md/sm image files in `manage.py derivativeworker` instead of
+# the upload request.
+IMS_ASYNC_DERIVATIVES = False
+
+# Uploaded or downloaded image files larger than this are rejected.
+IMS_MAX_UPLOAD_SIZE = 256 * 1024 * 1024
+
+# Derivative shapes generated besides md/sm, e.g. {'lg': (1200, 1200)}
+IMS_EXTRA_SHAPES = {}
+
+# Sizes allowed in /r/{sha1}/{width}x{height}.{ext} besides the shape sizes,
+# and the byte size `manage.py evictderivatives` trims the rendered files to.
+# Use a cache shared by all web processes (memcached, redis) so concurrent
+# requests for the same derivative render it only once.
+IMS_DERIVATIVE_SIZES = [(150, 150), (500, 500), (1000, 1000)]
+IMS_DERIVATIVE_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+
+# Format of md/sm and extra shape files, e.g. 'WEBP', None keeps the source
+# format. They are stored in one format for every client, only /r/ urls
+# without an extension negotiate AVIF/WebP by the Accept header.
+# Encoder options by format, e.g. {'WEBP': {'quality': 75}}.
+IMS_DERIVATIVE_FORMAT = None
+IMS_ENCODE_OPTIONS = {}
+# Chunked uploads. Part files are kept on the local disk, servers behind a
+# load balancer need a shared directory. None uses the system temp directory.
+IMS_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+IMS_UPLOAD_SESSION_DIR = None
+
+# With DEFAULT_FILE_STORAGE = 'ims.packstore.PackedStorage', files smaller
+# than IMS_PACK_MAX_BLOB_SIZE are appended to segment files of up to
+# IMS_PACK_SEGMENT_SIZE bytes instead of being stored one file each.
+IMS_PACK_MAX_BLOB_SIZE = 64 * 1024
+IMS_PACK_SEGMENT_SIZE = 256 * 1024 * 1024
+
+# Image files are served by /files/{name}, the MEDIA_URL. The view checks
+# the albums of the file then hands the transfer to nginx with
+# X-Accel-Redirect to IMS_X_ACCEL_REDIRECT_PREFIX, an internal location of
+# MEDIA_ROOT, or to Apache/lighttpd with IMS_X_SENDFILE. S3 files are
+# redirected to urls signed for IMS_SIGNED_URL_EXPIRE seconds.
+IMS_X_ACCEL_REDIRECT_PREFIX = None
+IMS_X_SENDFILE = False
+IMS_SIGNED_URL_EXPIRE = 300
+
+# Signed share urls of image files, /s/{expires}/{signature}/{name}, are
+# valid for at least IMS_SHARE_URL_EXPIRE seconds; their expiry is rounded
+# up to IMS_SHARE_URL_BUCKET so the urls signed meanwhile are the same.
+IMS_SHARE_URL_EXPIRE = 7 * 24 * 3600
+IMS_SHARE_URL_BUCKET = 3600
+
+# Images whose perceptual hashes differ by at most IMS_NEAR_DUPLICATE_DISTANCE
+# of their 64 bits are near duplicates, from 0 to 8.
+IMS_NEAR_DUPLICATE_DISTANCE = 4
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -100,6 +154,20 @@ DATABASES = {
 }
 
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+# seconds cached album output is kept, see ims.cache
+IMS_CACHE_TIMEOUT = 3600
+# albums answered by the search typeahead, albums/find.json, see ims.search
+IMS_SEARCH_TYPEAHEAD_LIMIT = 20
+# limits of the queries to /graphql, see ims.querycost
+IMS_GRAPHQL_MAX_DEPTH = 12
+IMS_GRAPHQL_MAX_COST = 20000
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
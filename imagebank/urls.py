@@ -14,17 +14,33 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 import os
+import re
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.conf.urls.static import static
 from django.views.static import serve
 from django.conf import settings
 from django.http import FileResponse
+from ims.views import serve_media
 
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('accounts/', include('django.contrib.auth.urls')),
     path('', include('ims.urls')),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) + \
-              static(settings.STATIC_URL)
+] + static(settings.STATIC_URL)
+
+# MEDIA_URL is /files/ of ims.urls, which checks the access to the files,
+# unless a deployment chooses to serve them all publicly
+public_media = settings.MEDIA_URL.strip('/') != 'files'
+if public_media:
+    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT,
+                          view=serve_media)
+
+if public_media and not settings.DEBUG and \
+        settings.DEFAULT_FILE_STORAGE == 'ims.packstore.PackedStorage':
+    # packed files are not on the disk for the web server to find
+    urlpatterns += [
+        re_path(r'^%s(?P<path>.*)$' % re.escape(settings.MEDIA_URL.lstrip('/')),
+                serve_media, {'document_root': settings.MEDIA_ROOT}),
+    ]
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+import random
+import httpx
+from .client import OpException, hash_file
+from .exceptions import IMAGE_FILE_NOT_FOUND
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+
+class AsyncImageBankClient:
+    """
+    asyncio client sharing one pool of keep-alive connections.
+    At most `concurrency` requests are in flight, failed connections and
+    busy responses are retried with exponential backoff.
+
+        async with AsyncImageBankClient(base_url, token) as client:
+            images = await client.upload_many(paths, album_id=1)
+    """
+    def __init__(self, base_url, token, concurrency=8, max_retries=5,
+                 backoff=0.5, timeout=60, transport=None):
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={'Authorization': f'Token {token}'},
+            limits=httpx.Limits(max_connections=concurrency,
+                                max_keepalive_connections=concurrency),
+            timeout=timeout,
+            transport=transport)
+        self._concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._max_retries = max_retries
+        self._backoff = backoff
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    @staticmethod
+    def raise_response_error(response: httpx.Response):
+        status_code = response.status_code
+        if 400 <= status_code < 500:
+            try:
+                response_json = response.json()
+            except ValueError:
+                response_json = None
+            if isinstance(response_json, dict):
+                raise OpException(response_json.get('error_code'),
+                                  response_json.get('error_msg'))
+        response.raise_for_status()
+
+    async def _request(self, method, path, files=None, **kwargs):
+        """
+        :param files: callable returning the files to post, called again
+        for each attempt so the files are sent from their beginning
+        """
+        attempt = 0
+        while True:
+            opened = files() if files else {}
+            try:
+                async with self._semaphore:
+                    response = await self._client.request(
+                        method, path, files=opened or None, **kwargs)
+                if response.status_code not in RETRY_STATUS_CODES \
+                        or attempt >= self._max_retries:
+                    self.raise_response_error(response)
+                    return response
+            except httpx.TransportError:
+                if attempt >= self._max_retries:
+                    raise
+            finally:
+                for f in opened.values():
+                    f.close()
+
+            delay = self._backoff * (2 ** attempt) * (0.5 + random.random())
+            attempt += 1
+            logger.warning('%s %s retry %s in %.1fs', method, path,
+                           attempt, delay)
+            await asyncio.sleep(delay)
+
+    async def get_album(self, album_id):
+        response = await self._request('GET', f'/api/v1/album/{album_id}')
+        return response.json()['album']
+
+    async def upload_image(self, path=None, source=None, album_title=None,
+                           album_id=None, title=None, sha1=None, dedupe=True):
+        """
+        Upload an image file, the file is streamed from the disk
+        :param path: path of the image file
+        :param sha1: attach the existing file of the hash, the file of path
+            is uploaded if the server doesn't have it
+        :param dedupe: hash the file of path and attach the existing file
+            when the server has one
+        """
+        post_data = {}
+        if album_title:
+            post_data['album'] = album_title
+        if album_id:
+            post_data['album_id'] = album_id
+        if title or path is not None:
+            post_data['title'] = title or os.path.basename(path)
+
+        if path is not None and sha1 is None and dedupe:
+            sha1 = await asyncio.to_thread(hash_file, path)
+        if sha1 is not None:
+            try:
+                response = await self._request('POST', '/api/v1/image/upload',
+                                               data=dict(post_data, sha1=sha1))
+                return response.json()['image']
+            except OpException as e:
+                if e.error_code != IMAGE_FILE_NOT_FOUND or path is None:
+                    raise
+
+        files = None
+        if path is not None:
+            def files():
+                return {'file': open(path, 'rb')}
+        elif source is not None:
+            post_data['source'] = source
+        else:
+            raise Exception('Either path or source should be assigned')
+        response = await self._request('POST', '/api/v1/image/upload',
+                                       data=post_data, files=files)
+        return response.json()['image']
+
+    async def upload_many(self, paths, album_id=None, album_title=None,
+                          return_exceptions=True) -> list:
+        """
+        Upload image files concurrently, the files the server already has
+        are attached by their sha1 and not sent.
+        :param paths: iterable of file paths, consumed as the uploads go
+        :param return_exceptions: put the exception of a failed upload in
+        the results instead of raising it
+        :return: uploaded images, in the order of paths
+        """
+        results = {}
+        items = enumerate(paths)
+
+        async def worker():
+            for i, path in items:
+                try:
+                    image = await self.upload_image(
+                        path, album_id=album_id, album_title=album_title)
+                except (Exception, OpException) as e:
+                    if not return_exceptions:
+                        raise
+                    logger.error('upload %s failed: %r', path, e)
+                    image = e
+                results[i] = image
+
+        await asyncio.gather(*[worker() for _ in range(self._concurrency)])
+        return [results[i] for i in range(len(results))]
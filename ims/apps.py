@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ImsConfig(AppConfig):
     name = 'ims'
+
+    def ready(self):
+        # connect the search index signals
+        from . import search  # noqa: F401
@@ -0,0 +1,78 @@
+"""
+Album output cached on Django's cache framework.
+Entries are keyed by the album id and the album version, writes bump the
+version so stale entries are never read and expire by themselves.
+The version is cached as well, a version read from the database before a
+concurrent bump can stay cached for VERSION_TIMEOUT at most.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_TIMEOUT = 60
+DEFAULT_TIMEOUT = 3600
+STATS_KEYS = ('hits', 'misses')
+
+
+def get_timeout():
+    return getattr(settings, 'IMS_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def _version_key(album_id):
+    return 'ims:album:%s:version' % album_id
+
+
+def _count(name):
+    key = 'ims:cache:%s' % name
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def get_album_version(album_id, load):
+    """
+    :param load: callable returning (owner id, version) of the album from
+        the database, or None when the album doesn't exist
+    :return: (owner id, version) or None
+    """
+    key = _version_key(album_id)
+    value = cache.get(key)
+    if value is None:
+        value = load()
+        if value is None:
+            return None
+        cache.add(key, tuple(value), VERSION_TIMEOUT)
+    return tuple(value)
+
+
+def bump_album_version(album_id):
+    """
+    Drop the cached version after the album version changed, once the
+    change commits, a version read before could be cached again otherwise
+    """
+    key = _version_key(album_id)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+def get_or_build(name, album_id, version, build, *parts):
+    """The cached value of the album version, built and cached on miss."""
+    key = ':'.join(['ims:album:%s:v%s:%s' % (album_id, version, name)]
+                   + [str(part) for part in parts])
+    value = cache.get(key)
+    if value is not None:
+        _count('hits')
+        return value
+    _count('misses')
+    value = build()
+    cache.set(key, value, get_timeout())
+    return value
+
+
+def get_stats() -> dict:
+    counts = cache.get_many(['ims:cache:%s' % name for name in STATS_KEYS])
+    stats = {name: counts.get('ims:cache:%s' % name, 0) for name in STATS_KEYS}
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / total if total else None
+    return stats
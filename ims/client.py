@@ -1,13 +1,20 @@
+import os
 import json
 import logging
+from hashlib import sha1
 from urllib.parse import urljoin
 import requests
 from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth, AuthBase
+from .exceptions import IMAGE_FILE_NOT_FOUND
 
 
 logger = logging.getLogger(__name__)
 
+EXISTS_BATCH_SIZE = 1000
+CHUNKED_UPLOAD_THRESHOLD = 32 * 1024 * 1024
+CHUNK_RESUME_ATTEMPTS = 3
+
 
 class OpException(BaseException):
     def __init__(self, error_code, error_msg):
@@ -15,6 +22,19 @@ class OpException(BaseException):
         self.error_msg = error_msg
 
 
+def hash_file(fobj) -> str:
+    """sha1 of a file path or a file object, read in chunks"""
+    if isinstance(fobj, str):
+        with open(fobj, 'rb') as f:
+            return hash_file(f)
+    position = fobj.tell()
+    hash_obj = sha1()
+    for chunk in iter(lambda: fobj.read(64 * 1024), b''):
+        hash_obj.update(chunk)
+    fobj.seek(position)
+    return hash_obj.hexdigest()
+
+
 class TokenCredential(AuthBase):
     def __init__(self, token):
         self._token = token
@@ -26,16 +46,21 @@ class TokenCredential(AuthBase):
 
 
 class ImageBankClient:
-    def __init__(self, base_url, token):
+    def __init__(self, base_url, token,
+                 chunked_threshold=CHUNKED_UPLOAD_THRESHOLD):
+        """
+        :param chunked_threshold: files larger than it are uploaded in
+            chunks, a dropped connection only resends the current chunk
+        """
         self._base_url = base_url
         self._token = token
+        self._chunked_threshold = chunked_threshold
         session = requests.Session()
         if isinstance(token, str):
             session.auth = TokenCredential(token)
         else:
             session.auth = token
         session.mount(base_url, HTTPAdapter(max_retries=5))
-        session.keep_alive = False
         self._session = session
 
     def raise_response_error(self, response):
@@ -66,12 +91,43 @@ class ImageBankClient:
         self.raise_response_error(response)
         return json.loads(response.content)['albums']
 
+    def iter_albums(self, title=None, page_size=100):
+        """Iterate all albums, following the next_cursor of each page."""
+        params = {'page_size': page_size}
+        if title:
+            params['title'] = title
+        while True:
+            response = self._session.get(self._get_url('/api/v1/albums'),
+                                         params=params)
+            self.raise_response_error(response)
+            response_json = response.json()
+            yield from response_json['albums']
+            if not response_json.get('next_cursor'):
+                return
+            params['cursor'] = response_json['next_cursor']
+
     def get_album(self, album_id):
         response = self._session.get(
             self._get_url(f'/api/v1/album/{album_id}'))
         self.raise_response_error(response)
         return json.loads(response.content)['album']
 
+    def iter_album_images(self, album_id, shapes=None):
+        """
+        Iterate images of an album as the server streams them
+        :param shapes: only return files of these shape names
+        """
+        params = {'format': 'ndjson'}
+        if shapes:
+            params['shapes'] = ','.join(shapes)
+        with self._session.get(
+                self._get_url(f'/api/v1/album/{album_id}/images'),
+                params=params, stream=True) as response:
+            self.raise_response_error(response)
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
     def find_albums(self, title=None):
         params = {}
         if title:
@@ -113,8 +169,54 @@ class ImageBankClient:
         print(response, album['id'])
         return album
 
+    def find_existing_files(self, hashes) -> set:
+        """The sha1 hashes of files the user's images already have"""
+        hashes = list(hashes)
+        existing = set()
+        for i in range(0, len(hashes), EXISTS_BATCH_SIZE):
+            response = self._session.post(
+                self._get_url('/api/v1/files/exists'),
+                json={'sha1': hashes[i:i + EXISTS_BATCH_SIZE]})
+            self.raise_response_error(response)
+            existing.update(response.json()['exists'])
+        return existing
+
+    def upload_images(self, paths, album_title=None, album_id=None):
+        """
+        Upload image files, the files the user's images already have are
+        attached by their sha1 and not sent.
+        :return: list of images in the order of paths
+        """
+        hashes = [hash_file(path) for path in paths]
+        existing = self.find_existing_files(set(hashes))
+        return [self.upload_image(
+                    path, album_title=album_title, album_id=album_id,
+                    sha1=sha1_hash if sha1_hash in existing else None,
+                    dedupe=False)
+                for path, sha1_hash in zip(paths, hashes)]
+
     def upload_image(self, fobj=None, source=None, album_title=None,
-                     album_id=None, title=None):
+                     album_id=None, title=None, sha1=None, dedupe=True):
+        """
+        :param sha1: attach the existing file of the hash, fobj is
+            uploaded if the server doesn't have it
+        :param dedupe: hash fobj and attach the existing file when the
+            server has one
+        """
+        if fobj is not None and sha1 is None and dedupe:
+            sha1 = hash_file(fobj)
+        if sha1 is not None:
+            post_data = {'sha1': sha1}
+            name = fobj if isinstance(fobj, str) else getattr(fobj, 'name', None)
+            if title is None and isinstance(name, str):
+                title = os.path.basename(name)
+            try:
+                return self._post_image(post_data, {}, album_title,
+                                        album_id, title)
+            except OpException as e:
+                if e.error_code != IMAGE_FILE_NOT_FOUND or fobj is None:
+                    raise
+
         file_opend = False
         files = {}
         try:
@@ -124,28 +226,85 @@ class ImageBankClient:
                 file_opend = True
                 files = {'file': f_content}
             elif hasattr(fobj, 'read'):
+                f_content = fobj
                 files = {'file': fobj}
             elif source is not None:
                 post_data['source'] = source
             else:
                 raise Exception('Either fobj or source should be assigned')
 
-            if album_title:
-                post_data['album_title'] = album_title
-            if album_id:
-                post_data['album_id'] = album_id
-            if title:
-                post_data['title'] = title
-            response = self._session.post(
-                self._get_url('/api/v1/image/upload'),
-                post_data, files=files)
-            self.raise_response_error(response)
-            return json.loads(response.content)['image']
-
+            if files and self._get_file_size(f_content) > self._chunked_threshold:
+                return self._upload_chunked(f_content, album_title, album_id,
+                                            title)
+            return self._post_image(post_data, files, album_title,
+                                    album_id, title)
         finally:
             if file_opend:
                 f_content.close()
 
+    @staticmethod
+    def _get_file_size(f):
+        position = f.tell()
+        size = f.seek(0, 2)
+        f.seek(position)
+        return size
+
+    def _upload_chunked(self, f, album_title=None, album_id=None, title=None):
+        """
+        Upload a file by a chunked upload session, the upload resumes from
+        the server's received size when a chunk fails.
+        """
+        post_data = {'filename': os.path.basename(getattr(f, 'name', 'file')),
+                     'size': self._get_file_size(f)}
+        if album_title:
+            post_data['album'] = album_title
+        if album_id:
+            post_data['album_id'] = album_id
+        if title:
+            post_data['title'] = title
+        response = self._session.post(self._get_url('/api/v1/uploads'),
+                                      post_data)
+        self.raise_response_error(response)
+        upload = response.json()['upload']
+        upload_url = self._get_url(f'/api/v1/uploads/{upload["id"]}')
+
+        failures = 0
+        while upload['received'] < upload['size']:
+            index = upload['next_index']
+            f.seek(index * upload['chunk_size'])
+            try:
+                response = self._session.put(
+                    f'{upload_url}/chunks/{index}',
+                    data=f.read(upload['chunk_size']),
+                    headers={'Content-Type': 'application/octet-stream'})
+                self.raise_response_error(response)
+            except requests.RequestException:
+                failures += 1
+                if failures > CHUNK_RESUME_ATTEMPTS:
+                    raise
+                logger.warning('chunk %s of upload %s failed, resume',
+                               index, upload['id'])
+                response = self._session.get(upload_url)
+                self.raise_response_error(response)
+            upload = response.json()['upload']
+
+        response = self._session.post(f'{upload_url}/commit')
+        self.raise_response_error(response)
+        return response.json()['image']
+
+    def _post_image(self, post_data, files, album_title, album_id, title):
+        if album_title:
+            post_data['album'] = album_title
+        if album_id:
+            post_data['album_id'] = album_id
+        if title:
+            post_data['title'] = title
+        response = self._session.post(
+            self._get_url('/api/v1/image/upload'),
+            post_data, files=files)
+        self.raise_response_error(response)
+        return json.loads(response.content)['image']
+
     def crop_image(self, image_id, pos, shape_name):
         post_data = {
             'image_id': image_id,
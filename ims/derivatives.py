@@ -0,0 +1,139 @@
+"""
+Derivatives rendered on request and kept in an evictable cache.
+Cached files are addressed by the source sha1, the size box and the format:
+derivatives/{sha1[0:2]}/{sha1}/{width}x{height}.{ext}
+"""
+import time
+import logging
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import DefaultStorage
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+from django.utils import timezone
+from PIL import Image as PImage
+from .models import CachedDerivative, ImageFile
+from .process import FORMAT_EXT, get_derivative_shapes, make_thumbnail
+from .storage import delete_files
+
+logger = logging.getLogger(__name__)
+
+LOCK_TIMEOUT = 30
+LOCK_WAIT = 10
+# access time is written at most once per interval for cache hits
+ACCESS_UPDATE_INTERVAL = timedelta(hours=1)
+
+
+def get_allowed_sizes() -> set:
+    """The shape sizes, and the IMS_DERIVATIVE_SIZES of the settings"""
+    sizes = set(tuple(size) for size in getattr(settings, 'IMS_DERIVATIVE_SIZES',
+                                                ()))
+    sizes.update(get_derivative_shapes().values())
+    return sizes
+
+
+def get_derivative_name(sha1_hash, size, image_format):
+    return 'derivatives/%s/%s/%sx%s.%s' % (sha1_hash[0:2], sha1_hash,
+                                           size[0], size[1],
+                                           FORMAT_EXT[image_format])
+
+
+@contextmanager
+def single_flight(key):
+    """
+    Hold a lock in the cache so only one request renders the key at a time.
+    Waiters give up after LOCK_WAIT seconds and go on without the lock.
+    The lock is shared between processes only with a shared cache backend.
+    """
+    lock_key = 'ims:lock:%s' % key
+    deadline = time.monotonic() + LOCK_WAIT
+    acquired = cache.add(lock_key, 1, LOCK_TIMEOUT)
+    while not acquired and time.monotonic() < deadline:
+        time.sleep(0.05)
+        acquired = cache.add(lock_key, 1, LOCK_TIMEOUT)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(lock_key)
+
+
+def find_derivative(image_file, size, image_format):
+    return CachedDerivative.objects.filter(source=image_file, width=size[0],
+                                           height=size[1],
+                                           format=image_format).first()
+
+
+def render_derivative(image_file: ImageFile, size: tuple, image_format: str):
+    with image_file.photo.open() as f:
+        image = PImage.open(f)
+        image.draft(None, (size[0] * 2, size[1] * 2))
+        _, buffer = make_thumbnail(image, size, image_format)
+        image.close()
+    return buffer
+
+
+def get_or_render_derivative(image_file: ImageFile, size: tuple,
+                             image_format: str) -> CachedDerivative:
+    now = timezone.now()
+    derivative = find_derivative(image_file, size, image_format)
+    if derivative:
+        if derivative.access_at < now - ACCESS_UPDATE_INTERVAL:
+            CachedDerivative.objects.filter(pk=derivative.pk) \
+                .update(access_at=now)
+        return derivative
+
+    key = '%s:%sx%s:%s' % (image_file.sha1, size[0], size[1], image_format)
+    with single_flight(key):
+        derivative = find_derivative(image_file, size, image_format)
+        if derivative:
+            return derivative
+
+        logger.info('render derivative %s', key)
+        name = get_derivative_name(image_file.sha1, size, image_format)
+        buffer = render_derivative(image_file, size, image_format)
+        storage = DefaultStorage()
+        if not storage.exists(name):
+            storage.save(name, buffer)
+        derivative = CachedDerivative(source=image_file, width=size[0],
+                                      height=size[1], format=image_format,
+                                      file_size=buffer.getbuffer().nbytes,
+                                      access_at=now)
+        derivative.photo.name = name
+        try:
+            with transaction.atomic():
+                derivative.save()
+        except IntegrityError:
+            # rendered by a request which didn't wait for the lock
+            derivative = find_derivative(image_file, size, image_format)
+    return derivative
+
+
+def evict_derivatives(max_size: int) -> tuple:
+    """
+    Delete the least recently used derivatives until the cache fits in
+    max_size bytes
+    :return: (deleted count, deleted bytes)
+    """
+    total_size = CachedDerivative.objects \
+        .aggregate(total_size=Sum('file_size'))['total_size'] or 0
+    storage = DefaultStorage()
+    deleted_count = deleted_size = 0
+    while total_size > max_size:
+        derivatives = CachedDerivative.objects.order_by('access_at', 'id') \
+            .values_list('id', 'photo', 'file_size')[:1000]
+        to_delete = {}
+        for derivative_id, name, file_size in derivatives:
+            if total_size <= max_size:
+                break
+            to_delete[derivative_id] = name
+            total_size -= file_size
+            deleted_size += file_size
+        if not to_delete:
+            break
+        CachedDerivative.objects.filter(id__in=to_delete.keys()).delete()
+        delete_files(storage, to_delete.values())
+        deleted_count += len(to_delete)
+    return deleted_count, deleted_size
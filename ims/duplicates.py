@@ -0,0 +1,131 @@
+"""
+Near-duplicate images by the hamming distance of their perceptual hashes.
+Comparing every pair of hashes is quadratic, so the hashes are searched
+with a multi-index: cut into max distance + 1 chunks of bits, two hashes
+within the distance have at least one chunk equal. For each chunk the
+hashes are sorted by it, and only the hashes of the same chunk value are
+compared, with NumPy over the whole array at once. The close pairs are
+joined into clusters by a union-find.
+"""
+import numpy as np
+from django.conf import settings
+from .models import Image, ImageFile
+from .process import hash_image_file
+
+HASH_BITS = 64
+DEFAULT_MAX_DISTANCE = 4
+# more chunks of fewer bits would compare most of the pairs
+MAX_DISTANCE = 8
+
+
+def get_max_distance():
+    return getattr(settings, 'IMS_NEAR_DUPLICATE_DISTANCE',
+                   DEFAULT_MAX_DISTANCE)
+
+
+def popcount(values):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1) \
+        .sum(axis=1)
+
+
+def find_close_pairs(hashes, max_distance):
+    """
+    :param hashes: array of distinct uint64 hashes
+    :return: (left, right) arrays of the indexes of the pairs of hashes
+        within max_distance bits, a pair may be found more than once
+    """
+    count = len(hashes)
+    bounds = np.linspace(0, HASH_BITS, max_distance + 2).astype(np.uint64)
+    lefts, rights = [], []
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        mask = np.uint64((1 << int(high - low)) - 1)
+        keys = (hashes >> low) & mask
+        order = np.argsort(keys, kind='stable')
+        # compared in the sorted order, reading memory side by side
+        keys, values = keys[order], hashes[order]
+        # positions followed by the same key `offset` positions later
+        offset = 1
+        active = np.flatnonzero(keys[:-1] == keys[1:])
+        while active.size:
+            distances = popcount(values[active] ^ values[active + offset])
+            close = active[distances <= max_distance]
+            lefts.append(order[close])
+            rights.append(order[close + offset])
+            offset += 1
+            active = active[active + offset < count]
+            active = active[keys[active] == keys[active + offset]]
+    if not lefts:
+        return np.empty(0, np.intp), np.empty(0, np.intp)
+    return np.concatenate(lefts), np.concatenate(rights)
+
+
+def cluster_hashes(hashes, max_distance=None) -> list:
+    """
+    :param hashes: signed 64 bits perceptual hashes
+    :return: lists of the indexes of the hashes within max_distance bits
+        of another of their list, the lists of 2 hashes or more
+    """
+    max_distance = get_max_distance() if max_distance is None \
+        else max_distance
+    if not 0 <= max_distance <= MAX_DISTANCE:
+        raise ValueError('max_distance must be from 0 to %s' % MAX_DISTANCE)
+    values = np.asarray(hashes, dtype=np.int64).view(np.uint64)
+    # equal hashes are the same cluster already
+    distinct, inverse = np.unique(values, return_inverse=True)
+
+    parents = list(range(len(distinct)))
+
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    for left, right in zip(*find_close_pairs(distinct, max_distance)):
+        left, right = find(left), find(right)
+        if left != right:
+            parents[max(left, right)] = min(left, right)
+
+    roots = np.array([find(index) for index in range(len(distinct))],
+                     dtype=np.intp)[inverse.reshape(-1)]
+    order = np.argsort(roots, kind='stable')
+    starts = np.flatnonzero(np.diff(roots[order])) + 1
+    return [cluster.tolist() for cluster in np.split(order, starts)
+            if len(cluster) > 1]
+
+
+def get_near_duplicates(owner, max_distance=None) -> list:
+    """
+    Images of the owner's albums whose origin files look the same
+    :return: lists of image ids, the largest clusters first
+    """
+    rows = Image.objects \
+        .filter(album__owner=owner, origin_file__phash__isnull=False) \
+        .values_list('id', 'origin_file__phash')
+    image_ids, hashes = [], []
+    for image_id, phash in rows.iterator():
+        image_ids.append(image_id)
+        hashes.append(phash)
+    clusters = [[image_ids[index] for index in cluster]
+                for cluster in cluster_hashes(hashes, max_distance)]
+    return sorted(clusters, key=lambda cluster: (-len(cluster), cluster[0]))
+
+
+def hash_image_files(batch_size=1000) -> int:
+    """
+    Hash the origin files uploaded before the files were hashed
+    :return: count of files hashed
+    """
+    count = 0
+    last_id = 0
+    while True:
+        image_files = list(ImageFile.objects
+                           .filter(id__gt=last_id, phash__isnull=True,
+                                   origin__isnull=False)
+                           .distinct().order_by('id')[:batch_size])
+        if not image_files:
+            return count
+        count += sum(hash_image_file(image_file) for image_file in image_files)
+        last_id = image_files[-1].id
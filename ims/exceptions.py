@@ -1,6 +1,10 @@
 ERROR_OBJECT_NOT_FOUND = 10001
 PARAMETER_REQUIRED = 10002
 INVALID_IMAGE_FILE = 10003
+IMAGE_FILE_TOO_LARGE = 10004
+INVALID_PARAMETER = 10005
+SOURCE_DOWNLOAD_FAILED = 10006
+IMAGE_FILE_NOT_FOUND = 10007
 
 class ImsException(BaseException):
     def __init__(self, error_code, error_msg):
@@ -11,4 +15,28 @@ class ImsException(BaseException):
 class InvalidImageFile(ImsException):
     def __init__(self):
         super(InvalidImageFile, self).__init__(INVALID_IMAGE_FILE,
-                                               'Invalid Image File')
\ No newline at end of file
+                                               'Invalid Image File')
+
+
+class ImageFileTooLarge(ImsException):
+    def __init__(self):
+        super(ImageFileTooLarge, self).__init__(IMAGE_FILE_TOO_LARGE,
+                                                'Image File Too Large')
+
+
+class InvalidParameter(ImsException):
+    def __init__(self, name):
+        super(InvalidParameter, self).__init__(INVALID_PARAMETER,
+                                               'Invalid parameter %s.' % name)
+
+
+class SourceDownloadFailed(ImsException):
+    def __init__(self, source):
+        super(SourceDownloadFailed, self).__init__(
+            SOURCE_DOWNLOAD_FAILED, 'Failed to download %s.' % source)
+
+
+class ImageFileNotFound(ImsException):
+    def __init__(self, sha1_hash):
+        super(ImageFileNotFound, self).__init__(
+            IMAGE_FILE_NOT_FOUND, 'Image file %s not found.' % sha1_hash)
@@ -0,0 +1,72 @@
+"""
+Mark and sweep of image files no longer bound to any image.
+Uploads deduplicated to an existing file touch its update_at before binding
+it, files updated within the grace period are never collected so an upload
+racing the sweep keeps its file.
+"""
+import logging
+from datetime import timedelta
+from django.core.files.storage import DefaultStorage
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Sum
+from django.utils import timezone
+from .models import CachedDerivative, ImageFile, ImageToFile
+from .storage import delete_files
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GRACE = timedelta(days=1)
+
+
+def get_orphan_image_files(grace: timedelta = DEFAULT_GRACE):
+    return ImageFile.objects \
+        .filter(update_at__lt=timezone.now() - grace) \
+        .exclude(Exists(ImageToFile.objects.filter(file=OuterRef('pk'))))
+
+
+def get_orphan_image_files_size(grace: timedelta = DEFAULT_GRACE) -> tuple:
+    """:return: (count, bytes) of the files a sweep would delete"""
+    result = get_orphan_image_files(grace) \
+        .aggregate(count=Count('id'), size=Sum('file_size'))
+    return result['count'], result['size'] or 0
+
+
+def sweep_image_files(grace: timedelta = DEFAULT_GRACE,
+                      batch_size=1000) -> tuple:
+    """
+    Delete orphan image files, their cached derivatives and their blobs.
+    Rows are deleted first, blobs of files uploaded again in the meantime
+    are kept.
+    :return: (deleted count, deleted bytes)
+    """
+    storage = DefaultStorage()
+    deleted_count = deleted_size = 0
+    last_id = 0
+    while True:
+        batch = list(get_orphan_image_files(grace)
+                     .filter(id__gt=last_id).order_by('id')
+                     .values_list('id', flat=True)[:batch_size])
+        if not batch:
+            break
+        last_id = batch[-1]
+
+        with transaction.atomic():
+            # the conditions are checked again on the locked rows
+            image_files = list(get_orphan_image_files(grace)
+                               .select_for_update()
+                               .filter(id__in=batch)
+                               .values_list('id', 'photo', 'file_size'))
+            ids = [file_id for file_id, _, _ in image_files]
+            names = [name for _, name, _ in image_files]
+            names += CachedDerivative.objects.filter(source_id__in=ids) \
+                .values_list('photo', flat=True)
+            ImageFile.objects.filter(id__in=ids).delete()
+
+        reused_names = set(ImageFile.objects.filter(photo__in=names)
+                           .values_list('photo', flat=True))
+        delete_files(storage, [name for name in names
+                               if name not in reused_names])
+        logger.info('%s image files collected', len(ids))
+        deleted_count += len(ids)
+        deleted_size += sum(file_size for _, _, file_size in image_files)
+    return deleted_count, deleted_size
@@ -0,0 +1,88 @@
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import DerivativeJob
+from .process import generate_derivative_files, attach_image_files
+from .process import hash_image_file
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3
+
+
+def is_async_derivatives_enabled():
+    return getattr(settings, 'IMS_ASYNC_DERIVATIVES', False)
+
+
+def enqueue_derivatives(image) -> DerivativeJob:
+    """The image's job waiting or running, or a new pending one"""
+    job = DerivativeJob.objects \
+        .filter(image=image, status__in=[DerivativeJob.STATUS_PENDING,
+                                         DerivativeJob.STATUS_RUNNING]) \
+        .order_by('id').first()
+    if job is None:
+        job = DerivativeJob.objects.create(image=image)
+    return job
+
+
+def claim_jobs(limit=10) -> list:
+    """
+    Claim pending jobs for the current worker.
+    Rows locked by other workers are skipped, the conditional update makes
+    the claim safe on backends without row locks (sqlite) as well.
+    """
+    claimed = []
+    with transaction.atomic():
+        jobs = DerivativeJob.objects.select_for_update(skip_locked=True) \
+            .filter(status=DerivativeJob.STATUS_PENDING) \
+            .order_by('id')[:limit]
+        for job in jobs:
+            updated = DerivativeJob.objects \
+                .filter(id=job.id, status=DerivativeJob.STATUS_PENDING) \
+                .update(status=DerivativeJob.STATUS_RUNNING,
+                        attempts=F('attempts') + 1,
+                        update_at=timezone.now())
+            if updated:
+                claimed.append(job)
+    return claimed
+
+
+def run_job(job: DerivativeJob):
+    try:
+        image = job.image
+        shape_files = generate_derivative_files(image.origin_file)
+        attach_image_files(image, shape_files)
+        # uploads leave the hash to the job in async mode
+        if image.origin_file.phash is None:
+            hash_image_file(image.origin_file)
+    except Exception as e:
+        logger.exception('derivative job %s failed', job.id)
+        job.refresh_from_db()
+        if job.attempts >= MAX_ATTEMPTS:
+            job.status = DerivativeJob.STATUS_FAILED
+        else:
+            job.status = DerivativeJob.STATUS_PENDING
+        job.error = str(e)
+        job.save()
+        return False
+
+    job.delete()
+    return True
+
+
+def run_pending_jobs(limit=10) -> int:
+    jobs = claim_jobs(limit)
+    for job in jobs:
+        run_job(job)
+    return len(jobs)
+
+
+def requeue_stale_jobs(timeout: timedelta) -> int:
+    """Put back jobs whose worker died while running them."""
+    return DerivativeJob.objects \
+        .filter(status=DerivativeJob.STATUS_RUNNING,
+                update_at__lt=timezone.now() - timeout) \
+        .update(status=DerivativeJob.STATUS_PENDING)
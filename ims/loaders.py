@@ -0,0 +1,91 @@
+"""
+DataLoader-style batching for the synchronous GraphQL executor.
+A connection primes the loaders of its page with the keys of its nodes,
+the first node resolving a relation then loads the relation of every
+primed key with one query, the following nodes read it from the loader.
+The executor resolves a page depth first, so a loader also primes the
+loader of the next relation with all the objects of its batch.
+A load may be limited to the objects of the page, a loader then caches
+the keys by limit, as the fields of a query may ask pages of other sizes.
+Loaders live on the request, so nothing is shared between requests.
+"""
+from collections import defaultdict
+from django.db.models import OuterRef, Q, Subquery
+from .models import Album, Image, ImageToFile
+
+
+class BatchLoader:
+    def __init__(self, batch_load, primes=None):
+        """
+        :param batch_load: callable taking a list of keys and the most
+            objects to load by key, None for all, and returning a dict of
+            key to list of objects, keys missing from it load `default`
+        :param primes: loader primed with the pks of the loaded objects
+        """
+        self.batch_load = batch_load
+        self.primes = primes
+        self.cache = {}
+        self.primed = {}
+
+    def prime(self, keys):
+        """Add keys to load with the next batch of every limit"""
+        self.primed.update(dict.fromkeys(keys))
+
+    def load(self, key, default=None, limit=None):
+        if (key, limit) not in self.cache:
+            keys = [k for k in dict.fromkeys([*self.primed, key])
+                    if (k, limit) not in self.cache]
+            values = self.batch_load(keys, limit)
+            for k in keys:
+                self.cache[k, limit] = values.get(k, default)
+            if self.primes:
+                self.primes.prime([obj.pk for objects in values.values()
+                                   for obj in objects])
+        return self.cache[key, limit]
+
+
+def load_album_images(album_ids, limit=None):
+    images = Image.objects.filter(album_id__in=album_ids)
+    if limit is not None:
+        # id of the limit-th image of each album, none when it has fewer,
+        # so a page of a large album doesn't load all of its images
+        last_ids = Album.objects.filter(id__in=album_ids).annotate(
+            last_id=Subquery(Image.objects.filter(album_id=OuterRef('pk'))
+                             .order_by('id').values('id')[limit - 1:limit])) \
+            .values_list('id', 'last_id')
+        condition = Q(pk__in=[])
+        for album_id, last_id in last_ids:
+            condition |= Q(album_id=album_id) if last_id is None \
+                else Q(album_id=album_id, id__lte=last_id)
+        images = images.filter(condition)
+    result = defaultdict(list)
+    for image in images.order_by('id'):
+        result[image.album_id].append(image)
+    return result
+
+
+def load_image_files(image_ids, limit=None):
+    # an image has a few files, its page is never limited
+    files = defaultdict(list)
+    for imagetofile in ImageToFile.objects.filter(image_id__in=image_ids) \
+            .select_related('file').order_by('id'):
+        files[imagetofile.image_id].append(imagetofile.file)
+    return files
+
+
+# name: (batch load, name of the loader primed with the loaded objects)
+BATCH_LOADS = {
+    'album_images': (load_album_images, 'image_files'),
+    'image_files': (load_image_files, None),
+}
+
+
+def get_loader(context, name) -> BatchLoader:
+    """The loader of the name for the request"""
+    if not hasattr(context, 'ims_loaders'):
+        context.ims_loaders = {}
+    if name not in context.ims_loaders:
+        batch_load, primes = BATCH_LOADS[name]
+        context.ims_loaders[name] = BatchLoader(
+            batch_load, primes and get_loader(context, primes))
+    return context.ims_loaders[name]
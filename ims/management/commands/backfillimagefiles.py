@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Subquery, Max
+from ...models import Image, ImageToFile, IMAGE_FILE_SHAPES
+
+
+class Command(BaseCommand):
+    help = "Set images' origin/md/sm file pointers from their ImageToFile rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='images updated per statement, by id range')
+        parser.add_argument('--dry-run', action='store_const', const=True)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options.get('dry_run', False)
+        max_id = Image.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+
+        for shape in IMAGE_FILE_SHAPES:
+            field = shape + '_file'
+            imagetofiles = ImageToFile.objects.filter(image=OuterRef('pk'),
+                                                      shape=shape)
+            # images with a file of the shape which the pointer doesn't match
+            stale_images = Image.objects \
+                .filter(Exists(imagetofiles)) \
+                .exclude(Exists(imagetofiles.filter(file=OuterRef(field))))
+            updated = 0
+            for start in range(0, max_id + 1, batch_size):
+                batch = stale_images.filter(id__gte=start,
+                                            id__lt=start + batch_size)
+                if dry_run:
+                    updated += batch.count()
+                    continue
+                with transaction.atomic():
+                    updated += batch.update(**{
+                        field: Subquery(imagetofiles.values('file')[:1])
+                    })
+            self.stdout.write(f'{shape}: {updated} images '
+                              f'{"to update" if dry_run else "updated"}.')
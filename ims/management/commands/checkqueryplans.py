@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from ...queryplans import VENDORS, check_query_plans
+
+
+class Command(BaseCommand):
+    help = 'Explain the hot queries and fail on full table scans.'
+
+    def handle(self, *args, **options):
+        if connection.vendor not in VENDORS:
+            raise CommandError(f'Unsupported database {connection.vendor}, '
+                               f'query plans are checked on '
+                               f'{" or ".join(VENDORS)} only.')
+        failed = []
+        for name, (plan, scans) in check_query_plans().items():
+            if scans:
+                failed.append(name)
+                self.stdout.write(f'{name}: full scan of {", ".join(scans)}')
+            else:
+                self.stdout.write(f'{name}: ok')
+            if scans or options['verbosity'] > 1:
+                self.stdout.write(plan)
+        if failed:
+            raise CommandError(f'{len(failed)} queries scan full tables.')
+        self.stdout.write('All query plans use indexes.')
@@ -1,30 +1,124 @@
 import os
-from django.conf import settings
+import json
+import time
 from django.core.management.base import BaseCommand
-from django.contrib.auth.models import User
 from django.core.files.storage import DefaultStorage
-from ...models import ImageFile, ImageToFile, Image
+from ...models import ImageFile, Image, touch_albums
+from ...storage import SHARDS, get_shard, list_files, find_missing
 
 
 class Command(BaseCommand):
+    help = 'Remove image files missing from the storage, and their images.'
+
     def add_arguments(self, parser):
         parser.add_argument('--dry-run', action='store_const', const=True)
+        parser.add_argument('--mode', choices=['list', 'exists'], default='list',
+                            help='list: diff a listing of each shard against '
+                                 'the database, exists: check every file')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--workers', type=int, default=16,
+                            help='threads checking file existence')
+        parser.add_argument('--checkpoint',
+                            help='file recording the progress, the run '
+                                 'resumes from it when it exists')
 
     def handle(self, *args, **options):
-        dry_run = options.pop('dry_run', False)
-        storage = DefaultStorage()
-        for image_file in ImageFile.objects.all():
-            if storage.exists(image_file.photo.name):
+        self.dry_run = options.get('dry_run', False)
+        self.batch_size = options['batch_size']
+        self.workers = options['workers']
+        self.checkpoint = options.get('checkpoint')
+        self.storage = DefaultStorage()
+        self.checked = self.missing = 0
+        self.start_time = time.monotonic()
+
+        state = self.load_checkpoint()
+        if options['mode'] == 'list':
+            self.check_by_listing(state.get('shard'))
+        else:
+            self.check_by_exists(state.get('last_id', 0))
+
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        self.report()
+
+    def load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return {}
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        self.stdout.write(f'resume from {state}')
+        return state
+
+    def save_checkpoint(self, **state):
+        if not self.checkpoint:
+            return
+        with open(self.checkpoint + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.checkpoint + '.tmp', self.checkpoint)
+
+    def report(self):
+        elapsed = time.monotonic() - self.start_time
+        rate = self.checked / elapsed if elapsed else 0
+        self.stdout.write(f'{self.checked} files checked, {self.missing} missing, '
+                          f'{rate:.0f} files/s')
+
+    def check_by_listing(self, last_shard=None):
+        for shard in SHARDS:
+            if last_shard and shard <= last_shard:
                 continue
+            stored_names = list_files(self.storage, shard)
+            image_files = ImageFile.objects.filter(sha1__startswith=shard) \
+                .order_by('id').values_list('id', 'photo')
+            batch = []
+            for image_file in image_files.iterator(chunk_size=self.batch_size):
+                batch.append(image_file)
+                if len(batch) >= self.batch_size:
+                    self.check_batch(batch, stored_names, shard)
+                    batch = []
+            self.check_batch(batch, stored_names, shard)
+            self.save_checkpoint(mode='list', shard=shard)
+            self.report()
+
+    def check_by_exists(self, last_id=0):
+        image_files = ImageFile.objects.filter(id__gt=last_id) \
+            .order_by('id').values_list('id', 'photo')
+        batch = []
+        for image_file in image_files.iterator(chunk_size=self.batch_size):
+            batch.append(image_file)
+            if len(batch) >= self.batch_size:
+                self.check_batch(batch)
+                self.save_checkpoint(mode='exists', last_id=batch[-1][0])
+                self.report()
+                batch = []
+        self.check_batch(batch)
+
+    def check_batch(self, image_files, stored_names=None, shard=None):
+        """
+        :param image_files: list of (id, name)
+        :param stored_names: names listed from the shard, files of other
+        layouts are checked one by one
+        """
+        ids_by_name = {name: file_id for file_id, name in image_files}
+        to_check = [name for name in ids_by_name
+                    if stored_names is None or get_shard(name) != shard]
+        missing = find_missing(self.storage, to_check, self.workers)
+        if stored_names is not None:
+            missing += [name for name in ids_by_name
+                        if get_shard(name) == shard and name not in stored_names]
+
+        self.checked += len(image_files)
+        self.missing += len(missing)
+        if missing:
+            self.remove_image_files({name: ids_by_name[name] for name in missing})
 
-            print(f'{image_file.photo.name} not found, remove imagefile {image_file.id}')
-
-            for image_to_file in ImageToFile.objects.filter(file=image_file):
-                try:
-                    print(f'delete image {image_to_file.image.id}')
-                    if not dry_run:
-                        image_to_file.image.delete()
-                except Image.DoesNotExist:
-                    pass
-            if not dry_run:
-                image_file.delete()
+    def remove_image_files(self, missing):
+        for name, file_id in missing.items():
+            self.stdout.write(f'{name} not found, remove imagefile {file_id}')
+        if self.dry_run:
+            return
+        file_ids = list(missing.values())
+        images = Image.objects.filter(imagetofile__file_id__in=file_ids)
+        album_ids = set(images.values_list('album_id', flat=True))
+        images.delete()
+        ImageFile.objects.filter(id__in=file_ids).delete()
+        touch_albums(album_ids)
@@ -0,0 +1,15 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from ...uploads import delete_stale_sessions
+
+
+class Command(BaseCommand):
+    help = 'Remove chunked uploads abandoned by their clients.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeout', type=int, default=86400,
+                            help='seconds since the last received chunk')
+
+    def handle(self, *args, **options):
+        count = delete_stale_sessions(timedelta(seconds=options['timeout']))
+        self.stdout.write(f'{count} upload sessions removed.')
@@ -0,0 +1,34 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from ...jobs import run_pending_jobs, requeue_stale_jobs
+
+
+class Command(BaseCommand):
+    help = 'Generate derivative image files queued by uploads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_const', const=True,
+                            help='process the pending jobs then exit')
+        parser.add_argument('--batch-size', type=int, default=10)
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help='seconds to wait when the queue is empty')
+        parser.add_argument('--stale-timeout', type=int, default=600,
+                            help='seconds before a running job is requeued')
+
+    def handle(self, *args, **options):
+        once = options.get('once', False)
+        batch_size = options['batch_size']
+        stale_timeout = timedelta(seconds=options['stale_timeout'])
+
+        requeue_stale_jobs(stale_timeout)
+        while True:
+            processed = run_pending_jobs(batch_size)
+            if processed:
+                self.stdout.write(f'{processed} jobs processed.')
+                continue
+
+            if once:
+                return
+            requeue_stale_jobs(stale_timeout)
+            time.sleep(options['sleep'])
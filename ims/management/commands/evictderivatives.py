@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from ...derivatives import evict_derivatives
+
+
+class Command(BaseCommand):
+    help = 'Evict least recently used derivatives from the derivative cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-size', type=int,
+                            help='cache size limit in bytes, '
+                                 'default to IMS_DERIVATIVE_CACHE_MAX_SIZE')
+
+    def handle(self, *args, **options):
+        max_size = options.get('max_size')
+        if max_size is None:
+            max_size = settings.IMS_DERIVATIVE_CACHE_MAX_SIZE
+        deleted_count, deleted_size = evict_derivatives(max_size)
+        self.stdout.write(f'{deleted_count} derivatives evicted, '
+                          f'{deleted_size} bytes freed.')
@@ -0,0 +1,30 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from ...duplicates import get_near_duplicates, hash_image_files, MAX_DISTANCE
+
+
+class Command(BaseCommand):
+    help = 'List the clusters of near-duplicate images of each owner.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--owner', help='username, default to all owners')
+        parser.add_argument('--distance', type=int,
+                            help='bits the hashes of near duplicates differ by')
+        parser.add_argument('--hash', action='store_const', const=True,
+                            help='hash the files uploaded before hashing first')
+
+    def handle(self, *args, **options):
+        distance = options.get('distance')
+        if distance is not None and not 0 <= distance <= MAX_DISTANCE:
+            raise CommandError(f'--distance must be from 0 to {MAX_DISTANCE}.')
+        if options.get('hash'):
+            self.stdout.write(f'{hash_image_files()} files hashed.')
+
+        owners = User.objects.filter(album__isnull=False).distinct()
+        if options.get('owner'):
+            owners = owners.filter(username=options['owner'])
+        for owner in owners.order_by('id'):
+            clusters = get_near_duplicates(owner, distance)
+            self.stdout.write(f'{owner.username}: {len(clusters)} clusters')
+            for cluster in clusters:
+                self.stdout.write(' '.join(str(image_id) for image_id in cluster))
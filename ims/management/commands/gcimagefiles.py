@@ -0,0 +1,25 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from ...gc import get_orphan_image_files_size, sweep_image_files
+
+
+class Command(BaseCommand):
+    help = 'Delete image files not bound to any image, and their blobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=86400,
+                            help='seconds since the last upload of a file '
+                                 'before it can be collected')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_const', const=True)
+
+    def handle(self, *args, **options):
+        grace = timedelta(seconds=options['grace'])
+        if options.get('dry_run', False):
+            count, size = get_orphan_image_files_size(grace)
+            self.stdout.write(f'{count} image files to delete, '
+                              f'{size} bytes to free.')
+            return
+
+        count, size = sweep_image_files(grace, options['batch_size'])
+        self.stdout.write(f'{count} image files deleted, {size} bytes freed.')
@@ -0,0 +1,38 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from django.core.files.storage import DefaultStorage
+from ...packstore import PackedStorage, PACK_DIR
+
+
+class Command(BaseCommand):
+    help = 'Move the small loose files into segment files, or compact the segments.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--compact', action='store_const', const=True,
+                            help='rewrite the segments with deleted files')
+        parser.add_argument('--min-dead-ratio', type=float, default=0.5,
+                            help='share of deleted bytes before a segment '
+                                 'is compacted')
+
+    def handle(self, *args, **options):
+        storage = DefaultStorage()
+        if not isinstance(storage, PackedStorage):
+            raise CommandError('DEFAULT_FILE_STORAGE is not '
+                               'ims.packstore.PackedStorage.')
+
+        if options.get('compact'):
+            removed, freed = storage.compact(options['min_dead_ratio'])
+            self.stdout.write(f'{removed} segments compacted, '
+                              f'{freed} bytes freed.')
+            return
+
+        packed = 0
+        for path, dirs, files in os.walk(storage.location):
+            if os.path.samefile(path, storage.location) and PACK_DIR in dirs:
+                dirs.remove(PACK_DIR)
+            for file in files:
+                name = os.path.relpath(os.path.join(path, file),
+                                       storage.location).replace(os.sep, '/')
+                if storage.pack_file(name):
+                    packed += 1
+        self.stdout.write(f'{packed} files packed.')
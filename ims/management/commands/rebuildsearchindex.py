@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from ...search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the album search tokens of all the albums.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = rebuild_index(options['batch_size'])
+        self.stdout.write(f'{count} albums indexed.')
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ims', '0003_derivativejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedDerivative',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('width', models.IntegerField()),
+                ('height', models.IntegerField()),
+                ('format', models.CharField(max_length=4)),
+                ('photo', models.FileField(upload_to='derivatives')),
+                ('file_size', models.IntegerField()),
+                ('create_at', models.DateTimeField(auto_now_add=True)),
+                ('access_at', models.DateTimeField(db_index=True)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ims.imagefile')),
+            ],
+            options={
+                'unique_together': {('source', 'width', 'height', 'format')},
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.2.25 on 2026-10-18 12:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ims', '0004_cachedderivative'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagefile',
+            name='update_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
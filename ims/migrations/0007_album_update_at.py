@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ims', '0006_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='update_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ims', '0007_album_update_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
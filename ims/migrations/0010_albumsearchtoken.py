@@ -0,0 +1,56 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_tokens(apps, schema_editor):
+    from ims.search import get_album_texts, get_texts_tokens
+    Album = apps.get_model('ims', 'Album')
+    AlbumSearchToken = apps.get_model('ims', 'AlbumSearchToken')
+    albums = Album.objects.order_by('id') \
+        .select_related('category').prefetch_related('tags')
+    last_id = 0
+    while True:
+        batch = list(albums.filter(id__gt=last_id)[:1000])
+        if not batch:
+            return
+        AlbumSearchToken.objects.bulk_create(
+            [AlbumSearchToken(owner_id=album.owner_id, album_id=album.id,
+                              token=token, weight=weight)
+             for album in batch
+             for token, weight in get_texts_tokens(
+                 get_album_texts(album)).items()],
+            batch_size=1000, ignore_conflicts=True)
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('ims', '0009_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlbumSearchToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=3)),
+                ('weight', models.SmallIntegerField()),
+                ('album', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ims.album')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='albumsearchtoken',
+            index=models.Index(fields=['owner', 'token', '-weight', '-album'], name='ims_searchtoken_rank_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='albumsearchtoken',
+            unique_together={('album', 'token')},
+        ),
+        migrations.RunPython(fill_tokens, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ims', '0010_albumsearchtoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PackedBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('segment', models.IntegerField(db_index=True)),
+                ('offset', models.BigIntegerField()),
+                ('size', models.IntegerField()),
+                ('create_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
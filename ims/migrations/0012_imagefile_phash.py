@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ims', '0011_packedblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagefile',
+            name='phash',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
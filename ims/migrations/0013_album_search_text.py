@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:19
+
+from django.db import migrations, models
+
+
+def fill_search_text(apps, schema_editor):
+    from ims.search import get_album_texts, get_search_text
+    Album = apps.get_model('ims', 'Album')
+    albums = Album.objects.order_by('id') \
+        .select_related('category').prefetch_related('tags')
+    last_id = 0
+    while True:
+        batch = list(albums.filter(id__gt=last_id)[:1000])
+        if not batch:
+            return
+        for album in batch:
+            album.search_text = get_search_text(get_album_texts(album))
+        Album.objects.bulk_update(batch, ['search_text'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ims', '0012_imagefile_phash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='search_text',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.RunPython(fill_search_text, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,10 @@
-from django.db import models
+import threading
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.dispatch import receiver
-from django.db.models import signals
+from django.db.models import signals, F
+from django.utils import timezone
+from .cache import bump_album_version
 
 
 class Category(models.Model):
@@ -30,6 +33,12 @@ class Album(models.Model):
                                  null=True, blank=True)
     title = models.CharField(max_length=255, null=False)
     create_at = models.DateTimeField(auto_now_add=True)
+    # touched by writes to the album's images
+    update_at = models.DateTimeField(auto_now=True)
+    # bumped with update_at, keys the album's ETag and cached output
+    version = models.IntegerField(default=0)
+    # the normalized texts of ims.search, rechecking its trigram matches
+    search_text = models.TextField(default='', editable=False)
     is_public = models.BooleanField(default=False)
     tags = models.ManyToManyField(Tag, blank=True)
 
@@ -37,10 +46,25 @@ class Album(models.Model):
         unique_together = [
             ['owner', 'title']
         ]
+        indexes = [
+            # the album index, ordered by -create_at, -id
+            models.Index(fields=['owner', '-create_at', '-id'],
+                         name='ims_album_owner_create_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
+    @property
+    def cache_version(self):
+        return self.make_cache_version(self.version, self.create_at)
+
+    @staticmethod
+    def make_cache_version(version, create_at):
+        """Version of the album's cached output, the creation time tells
+        apart albums reusing the id of a deleted album."""
+        return '%s.%x' % (version, int(create_at.timestamp() * 1000000))
+
 
 class ImageFile(models.Model):
     sha1 = models.CharField(max_length=40, unique=True)
@@ -50,6 +74,11 @@ class ImageFile(models.Model):
     file_size = models.IntegerField(null=False)
     origin_filename = models.CharField(max_length=255)
     format = models.CharField(max_length=4, null=True)
+    # dHash of uploaded images, near duplicates differ by a few bits,
+    # see ims.duplicates
+    phash = models.BigIntegerField(null=True)
+    # touched by every upload deduplicated to the file, see ims.gc
+    update_at = models.DateTimeField(auto_now=True, db_index=True)
 
     @property
     def size(self):
@@ -68,6 +97,13 @@ class Image(models.Model):
                                 on_delete=models.SET_NULL, related_name='sm')
     files = models.ManyToManyField(ImageFile, through='ImageToFile')
 
+    class Meta:
+        indexes = [
+            # images of an album by origin file, the upload deduplication
+            models.Index(fields=['album', 'origin_file'],
+                         name='ims_image_album_origin_idx'),
+        ]
+
 
 class ImageToFile(models.Model):
     image = models.ForeignKey(Image, null=False, on_delete=models.CASCADE)
@@ -80,16 +116,166 @@ class ImageToFile(models.Model):
         ]
 
 
+class CachedDerivative(models.Model):
+    source = models.ForeignKey(ImageFile, null=False, on_delete=models.CASCADE)
+    width = models.IntegerField(null=False)
+    height = models.IntegerField(null=False)
+    format = models.CharField(max_length=4)
+    photo = models.FileField(upload_to='derivatives')
+    file_size = models.IntegerField(null=False)
+    create_at = models.DateTimeField(auto_now_add=True)
+    access_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = [
+            ['source', 'width', 'height', 'format'],
+        ]
+
+
+class DerivativeJob(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_FAILED = 'failed'
+
+    image = models.ForeignKey(Image, null=False, on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, default=STATUS_PENDING,
+                              db_index=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    create_at = models.DateTimeField(auto_now_add=True)
+    update_at = models.DateTimeField(auto_now=True)
+
+
+class UploadSession(models.Model):
+    """A chunked upload in progress, see ims.uploads"""
+    owner = models.ForeignKey(User, null=False, on_delete=models.CASCADE)
+    album = models.ForeignKey(Album, null=False, on_delete=models.CASCADE)
+    title = models.CharField(max_length=255, null=True)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    create_at = models.DateTimeField(auto_now_add=True)
+    update_at = models.DateTimeField(auto_now=True, db_index=True)
+
+
+class AlbumSearchToken(models.Model):
+    """A trigram of the album's searchable texts, see ims.search"""
+    owner = models.ForeignKey(User, null=False, on_delete=models.CASCADE)
+    album = models.ForeignKey(Album, null=False, on_delete=models.CASCADE)
+    token = models.CharField(max_length=3)
+    # of the most relevant text containing the token
+    weight = models.SmallIntegerField()
+
+    class Meta:
+        unique_together = [
+            ['album', 'token'],
+        ]
+        indexes = [
+            # the albums of a token read by rank
+            models.Index(fields=['owner', 'token', '-weight', '-album'],
+                         name='ims_searchtoken_rank_idx'),
+        ]
+
+
+class PackedBlob(models.Model):
+    """A stored file appended to a segment file, see ims.packstore"""
+    name = models.CharField(max_length=255, unique=True)
+    segment = models.IntegerField(db_index=True)
+    offset = models.BigIntegerField()
+    size = models.IntegerField()
+    create_at = models.DateTimeField(auto_now_add=True)
+
+
+IMAGE_FILE_SHAPES = ('origin', 'md', 'sm')
+
+
 @receiver(signals.post_save, sender=ImageToFile)
 def update_image_files(sender, instance: ImageToFile = None, **kwargs):
-    if instance.shape == 'origin':
-        instance.image.origin_file = instance.file
-        instance.image.save()
+    """Keep the image's file pointer of a built-in shape in sync, with a
+    single column update instead of saving the whole image row."""
+    if instance.shape in IMAGE_FILE_SHAPES:
+        Image.objects.filter(pk=instance.image_id) \
+            .update(**{instance.shape + '_file': instance.file_id})
+
+
+def touch_album(album_id):
+    """Mark the album changed, for writes which don't save the album."""
+    touch_albums([album_id])
+
+
+def touch_albums(album_ids):
+    Album.objects.filter(pk__in=album_ids) \
+        .update(update_at=timezone.now(), version=F('version') + 1)
+    for album_id in album_ids:
+        bump_album_version(album_id)
+
+
+@receiver(signals.post_save, sender=Album)
+def touch_saved_album(sender, instance: Album = None, created=False, **kwargs):
+    if not created:
+        touch_album(instance.pk)
+
+
+# deleted rows of the albums to touch once the delete commits, a cascade
+# sends a signal per row
+_deleted = threading.local()
+
+
+def _touch_deleted_later(album_ids=(), image_ids=()):
+    if not hasattr(_deleted, 'album_ids'):
+        _deleted.album_ids, _deleted.image_ids = set(), set()
+    _deleted.album_ids.update(album_ids)
+    _deleted.image_ids.update(image_ids)
+    # the first callback touches them all, the others find nothing left
+    transaction.on_commit(_touch_deleted)
+
+
+def _touch_deleted():
+    album_ids, image_ids = _deleted.album_ids, _deleted.image_ids
+    if not album_ids and not image_ids:
+        return
+    _deleted.album_ids, _deleted.image_ids = set(), set()
+    if image_ids:
+        album_ids |= set(Image.objects.filter(id__in=image_ids)
+                         .values_list('album_id', flat=True))
+    touch_albums(album_ids)
+
+
+@receiver(signals.post_delete, sender=Album)
+def forget_album(sender, instance: Album = None, **kwargs):
+    bump_album_version(instance.pk)
+
+
+@receiver(signals.post_save, sender=Image)
+def touch_image_album(sender, instance: Image = None, **kwargs):
+    touch_album(instance.album_id)
+
+
+@receiver(signals.post_delete, sender=Image)
+def touch_deleted_image_album(sender, instance: Image = None, **kwargs):
+    _touch_deleted_later(album_ids=[instance.album_id])
+
+
+@receiver(signals.post_delete, sender=ImageToFile)
+def touch_deleted_file_album(sender, instance: ImageToFile = None, **kwargs):
+    _touch_deleted_later(image_ids=[instance.image_id])
+
+
+@receiver(signals.post_save, sender=Category)
+def touch_category_albums(sender, instance: Category = None, created=False,
+                          raw=False, **kwargs):
+    if not created and not raw:
+        touch_albums(list(instance.album_set.values_list('id', flat=True)))
+
+
+@receiver(signals.pre_delete, sender=Category)
+def touch_uncategorized_albums(sender, instance: Category = None, **kwargs):
+    """The albums lose the category by an update, without signals"""
+    _touch_deleted_later(
+        album_ids=instance.album_set.values_list('id', flat=True))
 
-    if instance.shape == 'md':
-        instance.image.md_file = instance.file
-        instance.image.save()
 
-    if instance.shape == 'sm':
-        instance.image.sm_file = instance.file
-        instance.image.save()
+@receiver(signals.m2m_changed, sender=Album.tags.through)
+def touch_tagged_album(sender, instance=None, reverse=False, **kwargs):
+    if not reverse and kwargs.get('action', '').startswith('post_'):
+        touch_album(instance.pk)
@@ -0,0 +1,264 @@
+"""
+File system storage packing small files into segment files.
+Files smaller than IMS_PACK_MAX_BLOB_SIZE, the sm/md thumbnails and small
+derivatives, are appended to {MEDIA_ROOT}/packs/{segment}.pack and indexed
+by PackedBlob rows of their name, segment, offset and size, so they cost
+no inode of their own. Larger files are stored loose like
+FileSystemStorage. A segment takes appends until it reaches
+IMS_PACK_SEGMENT_SIZE, appends are serialized by a lock file so processes
+sharing MEDIA_ROOT can write.
+Packed files are read from an mmap of their segment, the pages are shared
+by the processes and cached by the kernel.
+Deleted files leave holes in their segment, `manage.py packfiles
+--compact` copies the files left in the sparse segments and removes them.
+"""
+import io
+import os
+import mmap
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db.models import Sum
+from django.utils.deconstruct import deconstructible
+from .models import PackedBlob
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+PACK_DIR = 'packs'
+DEFAULT_MAX_BLOB_SIZE = 64 * 1024
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+
+# segment path: mmap of the segment, shared by the threads of the process
+_maps = {}
+_maps_lock = threading.Lock()
+
+
+def _map_segment(path, end):
+    """An mmap of the segment covering `end`, mapped again after appends"""
+    with _maps_lock:
+        mapped = _maps.get(path)
+        if mapped is None or len(mapped) < end:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # a previous map is released by its last reader
+            _maps[path] = mapped
+        return mapped
+
+
+def _forget_segment(path):
+    with _maps_lock:
+        _maps.pop(path, None)
+
+
+@contextmanager
+def _locked(path):
+    """Hold the lock file at path, waiting for the other processes"""
+    with open(path, 'a') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+            return
+        # the first byte, LK_LOCK gives up after 10 seconds
+        while True:
+            try:
+                msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                continue
+        try:
+            yield
+        finally:
+            msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@deconstructible
+class PackedStorage(FileSystemStorage):
+    def __init__(self, location=None, base_url=None, file_permissions_mode=None,
+                 directory_permissions_mode=None, max_blob_size=None,
+                 segment_size=None):
+        super().__init__(location, base_url, file_permissions_mode,
+                         directory_permissions_mode)
+        self._max_blob_size = max_blob_size
+        self._segment_size = segment_size
+
+    @property
+    def max_blob_size(self):
+        return self._max_blob_size or getattr(
+            settings, 'IMS_PACK_MAX_BLOB_SIZE', DEFAULT_MAX_BLOB_SIZE)
+
+    @property
+    def segment_size(self):
+        return self._segment_size or getattr(
+            settings, 'IMS_PACK_SEGMENT_SIZE', DEFAULT_SEGMENT_SIZE)
+
+    @property
+    def pack_dir(self):
+        return self.path(PACK_DIR)
+
+    def segment_path(self, segment):
+        return os.path.join(self.pack_dir, '%08d.pack' % segment)
+
+    def list_segments(self) -> list:
+        try:
+            names = os.listdir(self.pack_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-5]) for name in names
+                      if name.endswith('.pack') and name[:-5].isdigit())
+
+    def append(self, data) -> tuple:
+        """
+        Append data to the last segment, or a new one when it's full
+        :return: (segment, offset)
+        """
+        os.makedirs(self.pack_dir, exist_ok=True)
+        with _locked(os.path.join(self.pack_dir, 'lock')):
+            segments = self.list_segments()
+            segment = segments[-1] if segments else 1
+            path = self.segment_path(segment)
+            offset = os.path.getsize(path) if os.path.exists(path) else 0
+            if offset and offset + len(data) > self.segment_size:
+                segment += 1
+                path = self.segment_path(segment)
+                offset = 0
+            with open(path, 'ab') as f:
+                f.write(data)
+        return segment, offset
+
+    def get_blob(self, name):
+        return PackedBlob.objects.filter(name=name).first()
+
+    def read_blob(self, blob: PackedBlob) -> memoryview:
+        try:
+            mapped = _map_segment(self.segment_path(blob.segment),
+                                  blob.offset + blob.size)
+        except FileNotFoundError:
+            # the segment was compacted since the blob was read
+            blob = PackedBlob.objects.filter(pk=blob.pk).first()
+            if blob is None:
+                raise
+            mapped = _map_segment(self.segment_path(blob.segment),
+                                  blob.offset + blob.size)
+        return memoryview(mapped)[blob.offset:blob.offset + blob.size]
+
+    def read_packed(self, name):
+        """:return: content of a packed file, None for a loose file"""
+        blob = self.get_blob(name)
+        return self.read_blob(blob) if blob else None
+
+    def _save(self, name, content):
+        if not 0 < content.size < self.max_blob_size:
+            return super()._save(name, content)
+        data = b''.join(content.chunks())
+        segment, offset = self.append(data)
+        PackedBlob.objects.update_or_create(name=name, defaults={
+            'segment': segment, 'offset': offset, 'size': len(data)})
+        return name
+
+    def _open(self, name, mode='rb'):
+        blob = self.get_blob(name)
+        if blob is None:
+            return super()._open(name, mode)
+        return File(io.BytesIO(self.read_blob(blob)), name=name)
+
+    def exists(self, name):
+        return PackedBlob.objects.filter(name=name).exists() \
+            or super().exists(name)
+
+    def delete(self, name):
+        PackedBlob.objects.filter(name=name).delete()
+        super().delete(name)
+
+    def size(self, name):
+        blob = self.get_blob(name)
+        return blob.size if blob else super().size(name)
+
+    def get_created_time(self, name):
+        blob = self.get_blob(name)
+        return blob.create_at if blob else super().get_created_time(name)
+
+    def get_modified_time(self, name):
+        blob = self.get_blob(name)
+        return blob.create_at if blob else super().get_modified_time(name)
+
+    def listdir(self, path):
+        try:
+            dirs, files = super().listdir(path)
+        except FileNotFoundError:
+            dirs, files = [], []
+        prefix = path.strip('/') + '/' if path.strip('/') else ''
+        if not prefix:
+            dirs = [d for d in dirs if d != PACK_DIR]
+        dirs = set(dirs)
+        names = PackedBlob.objects.filter(name__startswith=prefix) \
+            .values_list('name', flat=True)
+        for name in names.iterator():
+            rest = name[len(prefix):]
+            if '/' in rest:
+                dirs.add(rest.split('/', 1)[0])
+            else:
+                files.append(rest)
+        return sorted(dirs), files
+
+    def list_names(self, prefix) -> set:
+        """Names of the loose and packed files under prefix"""
+        prefix = prefix.strip('/') + '/'
+        names = set(PackedBlob.objects.filter(name__startswith=prefix)
+                    .values_list('name', flat=True).iterator())
+        root = self.path(prefix)
+        for path, dirs, files in os.walk(root):
+            names.update(os.path.relpath(os.path.join(path, file),
+                                         self.location).replace(os.sep, '/')
+                         for file in files)
+        return names
+
+    def pack_file(self, name) -> bool:
+        """Move a small loose file into a segment"""
+        path = self.path(name)
+        size = os.path.getsize(path)
+        if not 0 < size < self.max_blob_size:
+            return False
+        with open(path, 'rb') as f:
+            data = f.read()
+        segment, offset = self.append(data)
+        PackedBlob.objects.update_or_create(name=name, defaults={
+            'segment': segment, 'offset': offset, 'size': len(data)})
+        os.remove(path)
+        return True
+
+    def compact(self, min_dead_ratio=0.5) -> tuple:
+        """
+        Copy the files of the segments having at least min_dead_ratio of
+        deleted bytes to the last segment, and remove those segments
+        :return: (segments removed, bytes freed)
+        """
+        segments = self.list_segments()
+        removed = freed = 0
+        # the last segment takes the appends
+        for segment in segments[:-1]:
+            path = self.segment_path(segment)
+            total = os.path.getsize(path)
+            blobs = PackedBlob.objects.filter(segment=segment)
+            live = blobs.aggregate(size=Sum('size'))['size'] or 0
+            if total and (total - live) / total < min_dead_ratio:
+                continue
+            for blob in blobs.iterator():
+                new_segment, offset = self.append(bytes(self.read_blob(blob)))
+                # unless the file was deleted meanwhile
+                PackedBlob.objects \
+                    .filter(pk=blob.pk, segment=segment, offset=blob.offset) \
+                    .update(segment=new_segment, offset=offset)
+            if blobs.exists():
+                continue
+            _forget_segment(path)
+            os.remove(path)
+            removed += 1
+            freed += total - live
+        return removed, freed
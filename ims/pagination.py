@@ -0,0 +1,32 @@
+"""
+Opaque cursors for keyset pagination.
+A cursor wraps the id of the last row of a page, the next page continues
+from it with an indexed id comparison instead of an OFFSET scan.
+"""
+import json
+import binascii
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from .exceptions import InvalidParameter
+
+
+def encode_cursor(last_id: int) -> str:
+    data = json.dumps({'id': last_id}).encode()
+    return urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        data = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        return int(json.loads(data)['id'])
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        raise InvalidParameter('cursor')
+
+
+def parse_page_size(value, default=100, max_size=1000) -> int:
+    """:return: value clamped to 1..max_size, default when it is None"""
+    if value is None:
+        return default
+    try:
+        return max(1, min(max_size, int(value)))
+    except ValueError:
+        raise InvalidParameter('page_size')
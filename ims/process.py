@@ -2,37 +2,157 @@ import os
 import logging
 from io import BytesIO
 from hashlib import sha1
+from tempfile import SpooledTemporaryFile
 import requests
 from PIL import Image as PImage
 from PIL import UnidentifiedImageError
+from django.conf import settings
 from django.core.files.storage import DefaultStorage
-from .models import ImageFile
-from .exceptions import InvalidImageFile
+from django.db.models import Exists, OuterRef
+from .models import ImageFile, ImageToFile, IMAGE_FILE_SHAPES, touch_album
+from .exceptions import InvalidImageFile, ImageFileTooLarge, ImageFileNotFound
 
 
 SM_SIZE = (150, 150)
 MD_SIZE = (500, 500)
 
+DERIVATIVE_SHAPES = {'md': MD_SIZE, 'sm': SM_SIZE}
+
 logger = logging.getLogger(__name__)
 
-FORMAT_EXT = {'JPEG': 'jpg', "GIF": 'gif', "PNG": 'png'}
+FORMAT_EXT = {'JPEG': 'jpg', "GIF": 'gif', "PNG": 'png', 'WEBP': 'webp',
+              'AVIF': 'avif'}
+EXT_FORMAT = {ext: image_format for image_format, ext in FORMAT_EXT.items()}
+EXT_FORMAT['jpeg'] = 'JPEG'
+FORMAT_MIME = {'JPEG': 'image/jpeg', 'GIF': 'image/gif', 'PNG': 'image/png',
+               'WEBP': 'image/webp', 'AVIF': 'image/avif'}
+
+# encoder options by format, updated by IMS_ENCODE_OPTIONS
+ENCODE_OPTIONS = {
+    'WEBP': {'quality': 80, 'method': 4},
+    'AVIF': {'quality': 60},
+}
+# formats served to clients accepting them, in order of preference
+NEGOTIATED_FORMATS = ['AVIF', 'WEBP']
+
+
+CHUNK_SIZE = 64 * 1024
 
+# dHash of 8 rows of 8 differences between neighbouring pixels, 64 bits
+HASH_SIZE = 8
 
-class DownloadStream(BytesIO):
-    def __init__(self, initial_bytes: bytes, url):
+
+class DownloadStream(SpooledTemporaryFile):
+    """Downloaded content, kept in memory until it outgrows
+    FILE_UPLOAD_MAX_MEMORY_SIZE and then spooled to a temporary file."""
+    def __init__(self, url):
         self.url = url
-        super(DownloadStream, self).__init__(initial_bytes)
+        self.sha1 = None
+        super(DownloadStream, self).__init__(
+            max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
 
     @property
     def name(self):
         return os.path.basename(self.url)
 
 
+def get_max_upload_size():
+    return getattr(settings, 'IMS_MAX_UPLOAD_SIZE', None)
+
+
+def check_upload_size(size):
+    max_size = get_max_upload_size()
+    if max_size and size > max_size:
+        raise ImageFileTooLarge()
+
+
+def copy_chunks(chunks, stream) -> str:
+    """
+    Write chunks into stream and hash them on the way
+    :return: sha1 hexdigest of the content
+    """
+    s = sha1()
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        check_upload_size(size)
+        s.update(chunk)
+        stream.write(chunk)
+    return s.hexdigest()
+
+
+def hash_stream(stream) -> str:
+    """Hash a stream from its beginning in chunks of CHUNK_SIZE."""
+    stream.seek(0)
+    s = sha1()
+    size = 0
+    if hasattr(stream, 'chunks'):
+        check_upload_size(stream.size)
+        chunks = stream.chunks()
+    else:
+        chunks = iter(lambda: stream.read(CHUNK_SIZE), b'')
+    for chunk in chunks:
+        size += len(chunk)
+        check_upload_size(size)
+        s.update(chunk)
+    return s.hexdigest()
+
+
+def dhash(image: PImage.Image):
+    """
+    Perceptual difference hash of an opened image, which changes by a few
+    bits only when the image is resized or encoded again
+    The image is decoded at the smallest JPEG draft scale.
+    :return: the 64 bits as a signed integer, None if it can't be decoded
+    """
+    try:
+        image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+        pixels = list(image.convert('L')
+                      .resize((HASH_SIZE + 1, HASH_SIZE), PImage.BOX)
+                      .getdata())
+    except (OSError, ValueError):
+        logger.warning('can not hash image %s', image)
+        return None
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            index = row * (HASH_SIZE + 1) + col
+            value = value << 1 | (pixels[index] > pixels[index + 1])
+    # stored in a signed 64 bits column
+    return value - (1 << 64) if value >> 63 else value
+
+
+def hash_image_file(image_file: ImageFile) -> bool:
+    """
+    Hash a stored image file and save its hash
+    :return: False if the file can't be read or decoded
+    """
+    try:
+        with image_file.photo.open() as f:
+            image_file.phash = dhash(PImage.open(f))
+    except OSError:
+        return False
+    if image_file.phash is None:
+        return False
+    ImageFile.objects.filter(pk=image_file.pk).update(phash=image_file.phash)
+    return True
+
+
 def get_stream_from_source(source: str):
-    response = requests.get(source)
-    response.raise_for_status()
-    logger.info('upload from file %s', source)
-    file_stream = DownloadStream(response.content, source)
+    with requests.get(source, stream=True) as response:
+        response.raise_for_status()
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit():
+            check_upload_size(int(content_length))
+        logger.info('upload from file %s', source)
+        file_stream = DownloadStream(source)
+        try:
+            file_stream.sha1 = copy_chunks(
+                response.iter_content(CHUNK_SIZE), file_stream)
+        except ImageFileTooLarge:
+            file_stream.close()
+            raise
+    file_stream.seek(0)
     return file_stream
 
 
@@ -40,16 +160,30 @@ def get_stream_from_upload_file(file):
     return file
 
 
-def get_or_create_image_file(stream) -> ImageFile:
+def get_derivative_shapes() -> dict:
+    """Derivative shape sizes, built-in md/sm plus `IMS_EXTRA_SHAPES`."""
+    shapes = dict(DERIVATIVE_SHAPES)
+    shapes.update(getattr(settings, 'IMS_EXTRA_SHAPES', {}))
+    return shapes
+
+
+def fits_in(image_size: tuple, size: tuple) -> bool:
+    return image_size[0] <= size[0] and image_size[1] <= size[1]
+
+
+def get_or_create_image_file(stream, image_info: tuple = None,
+                             sha1_hash: str = None) -> ImageFile:
+    """
+    Save the stream content as an ImageFile, deduplicated by its sha1
+    :param stream: the image file content
+    :param image_info: (width, height, format) of the content if it is
+        already known, the content won't be decoded again then.
+    :param sha1_hash: sha1 of the content if it is already hashed
+    :return: ImageFile
+    """
     logger.debug('begin save_image_file')
-    stream.seek(0)
-    s = sha1()
-    if hasattr(stream, 'chunks'):
-        for chunk in stream.chunks():
-            s.update(chunk)
-    else:
-        s.update(stream.read())
-    sha1_hash = s.hexdigest()
+    sha1_hash = sha1_hash or getattr(stream, 'sha1', None) \
+        or hash_stream(stream)
     storage = DefaultStorage()
     try:
         image_file = ImageFile.objects.get(sha1=sha1_hash)
@@ -58,21 +192,32 @@ def get_or_create_image_file(stream) -> ImageFile:
             storage.save(image_file.photo.name, stream)
     except ImageFile.DoesNotExist:
         stream.seek(0)
-        try:
-            image = PImage.open(stream)
-        except (UnidentifiedImageError, OSError):
-            raise InvalidImageFile()
+        # derivatives come with their info and need no perceptual hash
+        phash = None
+        if image_info:
+            width, height, image_format = image_info
+        else:
+            try:
+                image = PImage.open(stream)
+            except (UnidentifiedImageError, OSError):
+                raise InvalidImageFile()
+            width, height, image_format = image.width, image.height, image.format
+            # hashed by the derivative job instead, off the upload request
+            if not getattr(settings, 'IMS_ASYNC_DERIVATIVES', False):
+                phash = dhash(image)
 
         image_file = ImageFile()
         image_file.sha1 = sha1_hash
-        image_file.width = image.width
-        image_file.height = image.height
-        image_file_ext = '.' + FORMAT_EXT[image.format] if image.format else ''
+        image_file.width = width
+        image_file.height = height
+        image_file_ext = '.' + FORMAT_EXT.get(image_format, image_format.lower()) \
+            if image_format else ''
         image_file.photo.name = '%s/%s/%s%s' % (sha1_hash[0:2],
                                                 sha1_hash[2:4],
                                                 sha1_hash[4:],
                                                 image_file_ext)
-        image_file.format = image.format
+        image_file.format = image_format
+        image_file.phash = phash
         stream.seek(0, 2)
         image_file.file_size = stream.tell()
         stream.seek(0)
@@ -83,14 +228,200 @@ def get_or_create_image_file(stream) -> ImageFile:
     return image_file
 
 
+def get_owned_image_files(owner):
+    """
+    Image files of the owner's images. A sha1 alone is no proof of holding
+    the content, so files are only reused and disclosed to their owners.
+    """
+    return ImageFile.objects.filter(Exists(ImageToFile.objects.filter(
+        file=OuterRef('pk'), image__album__owner=owner)))
+
+
+def get_image_file(sha1_hash, owner) -> ImageFile:
+    """
+    An existing image file of the owner's images by its sha1, touched like a
+    deduplicated upload so it's kept by the garbage collection
+    """
+    try:
+        image_file = get_owned_image_files(owner).get(sha1=sha1_hash.lower())
+    except ImageFile.DoesNotExist:
+        raise ImageFileNotFound(sha1_hash)
+    image_file.save(update_fields=['update_at'])
+    return image_file
+
+
 def generate_thumbnail_file(file, size: tuple) -> ImageFile:
-    image = PImage.open(file)
-    image.thumbnail(size)
+    return generate_thumbnail_files(PImage.open(file), [size])[0]
+
+
+def can_encode(image_format: str) -> bool:
+    """Whether the Pillow build has an encoder for the format."""
+    PImage.init()
+    return image_format in PImage.SAVE
+
+
+def get_encode_options(image_format: str) -> dict:
+    options = dict(ENCODE_OPTIONS.get(image_format, {}))
+    options.update(getattr(settings, 'IMS_ENCODE_OPTIONS', {})
+                   .get(image_format, {}))
+    return options
+
+
+def get_derivative_format(image_format: str) -> str:
+    """Format of derivative files, `IMS_DERIVATIVE_FORMAT` or the source format."""
+    derivative_format = getattr(settings, 'IMS_DERIVATIVE_FORMAT', None)
+    if derivative_format and can_encode(derivative_format):
+        return derivative_format
+    return image_format
+
+
+def negotiate_format(accept: str, image_format: str) -> str:
+    """
+    Pick the output format from an Accept header
+    :param accept: value of the Accept header
+    :param image_format: the format to fall back to
+    """
+    accepted = set()
+    for media_range in (accept or '').split(','):
+        media_type, *params = media_range.split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if quality > 0:
+            accepted.add(media_type.strip().lower())
+    for negotiated_format in getattr(settings, 'IMS_NEGOTIATED_FORMATS',
+                                     NEGOTIATED_FORMATS):
+        if FORMAT_MIME[negotiated_format] in accepted \
+                and can_encode(negotiated_format):
+            return negotiated_format
+    return image_format
+
+
+def convert_for_format(image: PImage.Image, image_format: str) -> PImage.Image:
+    if image_format == 'JPEG':
+        if image.mode not in ('RGB', 'L', 'CMYK'):
+            return image.convert('RGB')
+    elif image_format in ('WEBP', 'AVIF'):
+        if image.mode not in ('RGB', 'RGBA'):
+            has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+            return image.convert('RGBA' if has_alpha else 'RGB')
+    elif image.mode == 'CMYK':
+        return image.convert('RGB')
+    return image
+
+
+def make_thumbnail(image: PImage.Image, size: tuple, image_format: str):
+    """
+    Resize a copy of the image to fit in size and encode it
+    :return: (thumbnail image, encoded content buffer)
+    """
+    thumbnail = image.copy()
+    thumbnail.thumbnail(size)
+    thumbnail = convert_for_format(thumbnail, image_format)
     buffer = BytesIO()
-    image.save(buffer, format=image.format)
+    thumbnail.save(buffer, format=image_format,
+                   **get_encode_options(image_format))
+    buffer.seek(0)
+    return thumbnail, buffer
+
+
+def generate_thumbnail_files(image: PImage.Image, sizes: list,
+                             image_format: str = None) -> list:
+    """
+    Generate thumbnails of several sizes from one decoded image
+    The source is decoded once, JPEG sources are DCT-downscaled while
+    decoding, and each thumbnail is resized from the previous larger one.
+    :param image: opened PIL image, not loaded yet
+    :param sizes: list of (width, height) bounding boxes
+    :param image_format: encoding format, default to the source format
+    :return: list of ImageFile in the same order of sizes
+    """
+    image_format = image_format or image.format
+    # keep twice the largest box like Image.thumbnail's reducing_gap does
+    image.draft(None, (max(size[0] for size in sizes) * 2,
+                       max(size[1] for size in sizes) * 2))
+    image.load()
+
+    image_files = [None] * len(sizes)
+    source, source_size = image, image.size
+    for index in sorted(range(len(sizes)),
+                        key=lambda i: sizes[i][0] * sizes[i][1],
+                        reverse=True):
+        size = sizes[index]
+        # only cascade when the previous box contains this one
+        if not fits_in(size, source_size):
+            source = image
+        thumbnail, buffer = make_thumbnail(source, size, image_format)
+        image_files[index] = get_or_create_image_file(
+            buffer, (thumbnail.width, thumbnail.height, image_format))
+        source, source_size = thumbnail, size
     image.close()
-    image_file = get_or_create_image_file(buffer)
-    return image_file
+    return image_files
+
+
+def generate_derivative_files(origin_image_file: ImageFile) -> dict:
+    """
+    Generate the derivative image files of an origin image file
+    :param origin_image_file: the origin ImageFile
+    :return: dict of shape name to ImageFile
+    """
+    shape_files = {}
+    shape_sizes = {}
+    for shape, size in get_derivative_shapes().items():
+        if fits_in(origin_image_file.size, size):
+            shape_files[shape] = origin_image_file
+        else:
+            shape_sizes[shape] = size
+
+    if shape_sizes:
+        image_format = get_derivative_format(origin_image_file.format)
+        with origin_image_file.photo.open() as f:
+            image_files = generate_thumbnail_files(PImage.open(f),
+                                                   list(shape_sizes.values()),
+                                                   image_format)
+        shape_files.update(zip(shape_sizes.keys(), image_files))
+    return shape_files
+
+
+def attach_image_files(image, shape_files: dict, touch=True):
+    """
+    Bind image files to an image by shape name
+    ImageToFile rows are written in bulk, and the image's origin/md/sm
+    pointers are updated in one statement limited to the changed columns.
+    :param image: the Image the files belong to
+    :param shape_files: dict of shape name to ImageFile
+    :param touch: False when the caller saved the image, which touched the
+        album already
+    """
+    existing = {imagetofile.shape: imagetofile for imagetofile in
+                ImageToFile.objects.filter(image=image, shape__in=shape_files)}
+    created = ImageToFile.objects.bulk_create(
+        [ImageToFile(image=image, shape=shape, file=image_file)
+         for shape, image_file in shape_files.items()
+         if shape not in existing])
+    updated = False
+    for shape, imagetofile in existing.items():
+        if imagetofile.file_id != shape_files[shape].id:
+            ImageToFile.objects.filter(pk=imagetofile.pk) \
+                .update(file=shape_files[shape])
+            updated = True
+
+    update_fields = []
+    for shape in IMAGE_FILE_SHAPES:
+        field = shape + '_file'
+        if shape in shape_files \
+                and getattr(image, field + '_id') != shape_files[shape].id:
+            setattr(image, field, shape_files[shape])
+            update_fields.append(field)
+    if update_fields:
+        image.save(update_fields=update_fields)
+    elif touch and (created or updated):
+        touch_album(image.album_id)
 
 
 def crop_image(imagefile_or_id: [ImageFile, int], positions: tuple) -> ImageFile:
@@ -0,0 +1,106 @@
+"""
+GraphQL query limits, checked when the query is validated so a
+pathological query is rejected before any resolver runs.
+The depth is the nesting of fields. The cost is the count of nodes the
+query can return: each connection counts the nodes of a page, its
+`first` or `last` argument or the relay max limit, times the nodes of
+the connections it is nested in.
+"""
+from django.conf import settings
+from graphene_django.settings import graphene_settings
+from graphql import GraphQLError, GraphQLObjectType, get_named_type
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode
+from graphql.language import IntValueNode
+from graphql.validation import ValidationRule
+
+DEFAULT_MAX_DEPTH = 12
+DEFAULT_MAX_COST = 20000
+
+
+def get_max_depth():
+    return getattr(settings, 'IMS_GRAPHQL_MAX_DEPTH', DEFAULT_MAX_DEPTH)
+
+
+def get_max_cost():
+    return getattr(settings, 'IMS_GRAPHQL_MAX_COST', DEFAULT_MAX_COST)
+
+
+def is_connection(graphql_type):
+    return isinstance(graphql_type, GraphQLObjectType) \
+        and 'edges' in graphql_type.fields
+
+
+def get_page_size(field_node: FieldNode):
+    max_limit = graphene_settings.RELAY_CONNECTION_MAX_LIMIT
+    for argument in field_node.arguments:
+        if argument.name.value in ('first', 'last') \
+                and isinstance(argument.value, IntValueNode):
+            return min(int(argument.value.value), max_limit or float('inf'))
+    # a variable is unknown before the execution
+    return max_limit or 1
+
+
+class QueryCostRule(ValidationRule):
+    def enter_operation_definition(self, node, *args):
+        schema = self.context.schema
+        root_type = getattr(schema, '%s_type' % node.operation.value)
+        depth, cost = self.measure(node.selection_set, root_type, 1, 1, ())
+
+        max_depth = get_max_depth()
+        if depth > max_depth:
+            self.report_error(GraphQLError(
+                'Query depth %s exceeds the maximum depth %s.'
+                % (depth, max_depth), node))
+        max_cost = get_max_cost()
+        if cost > max_cost:
+            self.report_error(GraphQLError(
+                'Query cost %s exceeds the maximum cost %s, '
+                'request smaller pages with `first`.' % (cost, max_cost), node))
+
+    def measure(self, selection_set, parent_type, depth, scale, fragments):
+        """
+        :param scale: nodes of the parent type the selections apply to
+        :param fragments: names of the fragments spread on the way
+        :return: (depth, cost) of the selections
+        """
+        max_depth = depth
+        cost = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                field = getattr(parent_type, 'fields', {}) \
+                    .get(selection.name.value)
+                # introspection and unknown fields, reported by other rules
+                if field is None or not selection.selection_set:
+                    continue
+                field_type = get_named_type(field.type)
+                field_scale = scale
+                if is_connection(field_type):
+                    field_scale = scale * get_page_size(selection)
+                    cost += field_scale
+                field_depth, field_cost = self.measure(
+                    selection.selection_set, field_type, depth + 1,
+                    field_scale, fragments)
+            elif isinstance(selection, InlineFragmentNode):
+                fragment_type = parent_type
+                if selection.type_condition:
+                    fragment_type = self.context.schema.get_type(
+                        selection.type_condition.name.value)
+                field_depth, field_cost = self.measure(
+                    selection.selection_set, fragment_type, depth, scale,
+                    fragments)
+            elif isinstance(selection, FragmentSpreadNode):
+                name = selection.name.value
+                fragment = self.context.get_fragment(name)
+                # cycles are reported by NoFragmentCyclesRule
+                if fragment is None or name in fragments:
+                    continue
+                fragment_type = self.context.schema.get_type(
+                    fragment.type_condition.name.value)
+                field_depth, field_cost = self.measure(
+                    fragment.selection_set, fragment_type, depth, scale,
+                    fragments + (name,))
+            else:
+                continue
+            max_depth = max(max_depth, field_depth)
+            cost += field_cost
+        return max_depth, cost
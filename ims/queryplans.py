@@ -0,0 +1,97 @@
+"""
+Query plans of the hot lookup paths.
+Each query is explained on the default database and its plan checked for
+full table scans, so a dropped or unused index fails the check instead of
+slowing the lookups down as the tables grow.
+"""
+import json
+from django.db import connection
+from django.db.models import Q
+from .models import Album, Image, ImageFile, ImageToFile
+from .gc import get_orphan_image_files
+from .search import RARE_PREFIX_LIMIT, get_prefix_albums, get_token_albums
+from .search import search_prefix, search_tokens
+
+# databases whose plans are parsed for full scans
+VENDORS = ('sqlite', 'mysql')
+
+
+def get_hot_queries() -> dict:
+    """:return: dict of name to queryset, built with placeholder values"""
+    from .views import with_cover_photo
+    return {
+        'image by album and origin file':
+            Image.objects.filter(album_id=0, origin_file_id=0),
+        'image file by sha1':
+            ImageFile.objects.filter(sha1=''),
+        'image files of image': ImageToFile.objects.filter(image_id=0),
+        'images of image file': ImageToFile.objects.filter(file_id=0),
+        'album index':
+            with_cover_photo(Album.objects.filter(owner_id=0))
+            .order_by('-create_at', '-id'),
+        'album search token count': get_token_albums(0, 'que'),
+        'album search': search_tokens(0, ['que', 'ery'])
+            .filter(search_text__contains='query'),
+        'album search prefix albums': get_prefix_albums(0, 'q'),
+        'album search rare prefix': search_prefix(0, 'q', [0]),
+        'album search common prefix':
+            search_prefix(0, 'q', range(RARE_PREFIX_LIMIT + 1)),
+        'file access': ImageToFile.objects.filter(file__sha1='').filter(
+            Q(image__album__is_public=True) | Q(image__album__owner_id=0)),
+        'near duplicate hashes': Image.objects.filter(
+            album__owner_id=0, origin_file__phash__isnull=False),
+        'orphan image files': get_orphan_image_files(),
+    }
+
+
+def _sqlite_full_scans(plan):
+    """
+    Tables scanned without an index, from lines such as
+    `2 0 0 SCAN ims_album` or `SCAN TABLE ims_album` of older versions
+    """
+    scans = []
+    for line in plan.splitlines():
+        words = line.split()
+        if 'SCAN' not in words or 'INDEX' in words:
+            continue
+        table = words[words.index('SCAN') + 1:]
+        if table and table[0] == 'TABLE':
+            table = table[1:]
+        if table and not table[0].startswith('CONSTANT'):
+            scans.append(table[0])
+    return scans
+
+
+def _mysql_full_scans(plan):
+    """Tables of `"access_type": "ALL"` in a MySQL or MariaDB JSON plan"""
+    scans = []
+
+    def walk(node):
+        if isinstance(node, dict):
+            if node.get('access_type') == 'ALL':
+                scans.append(node.get('table_name'))
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(json.loads(plan))
+    return scans
+
+
+def explain(queryset) -> tuple:
+    """:return: (plan, tables scanned in full)"""
+    if connection.vendor == 'sqlite':
+        plan = queryset.explain()
+        return plan, _sqlite_full_scans(plan)
+    if connection.vendor == 'mysql':
+        plan = queryset.explain(format='json')
+        return plan, _mysql_full_scans(plan)
+    raise NotImplementedError(connection.vendor)
+
+
+def check_query_plans(queries=None) -> dict:
+    """:return: dict of name to (plan, tables scanned in full)"""
+    queries = queries or get_hot_queries()
+    return {name: explain(queryset) for name, queryset in queries.items()}
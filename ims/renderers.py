@@ -0,0 +1,15 @@
+from rest_framework.renderers import BaseRenderer
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Newline delimited json, one object per line.
+    Views build the streaming response themselves, the renderer only lets
+    the content negotiation accept `application/x-ndjson` and `?format=ndjson`.
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
@@ -1,8 +1,43 @@
 from graphene import relay, ObjectType, Schema, String
 from graphene_django import DjangoObjectType
 from graphene_django.filter import DjangoFilterConnectionField
+from graphene_django.settings import graphene_settings
+from graphql import specified_rules
+from graphql_relay import get_offset_with_default
 
 from .models import Album, Category, Image, ImageFile
+from .loaders import get_loader
+from .querycost import QueryCostRule
+from .storage import get_file_url
+
+
+def get_page_stop(args):
+    """
+    Count of the first nodes a connection needs for the page of args, with
+    one more telling it has a next page
+    :return: None when the page is counted from the end
+    """
+    if args.get('last') is not None or args.get('before'):
+        return None
+    first = args.get('first')
+    if first is None:
+        first = graphene_settings.RELAY_CONNECTION_MAX_LIMIT
+    if first is None:
+        return None
+    start = get_offset_with_default(args.get('after'), -1) + 1
+    return start + (args.get('offset') or 0) + first + 1
+
+
+class PrimingConnection(relay.Connection):
+    """Primes the loaders of its node type with the nodes of the page"""
+    class Meta:
+        abstract = True
+
+    def resolve_edges(self, info):
+        prime = getattr(self._meta.node, 'prime_loaders', None)
+        if prime:
+            prime(info, [edge.node for edge in self.edges])
+        return self.edges
 
 
 class CategoryNode(DjangoObjectType):
@@ -25,17 +60,40 @@ class AlbumNode(DjangoObjectType):
             'category__title': ['exact'],
         }
         interfaces = (relay.Node,)
+        connection_class = PrimingConnection
 
     @classmethod
     def get_queryset(cls, queryset, info):
         return queryset.filter(owner=info.context.user)
 
+    @classmethod
+    def prime_loaders(cls, info, albums):
+        get_loader(info.context, 'album_images') \
+            .prime([album.id for album in albums])
+
+    def resolve_image_set(self, info, **kwargs):
+        stop = get_page_stop(kwargs)
+        if stop is None:
+            # the last images need the count of the album's images
+            return self.image_set.order_by('id')
+        return get_loader(info.context, 'album_images') \
+            .load(self.id, [], stop)
+
 
 class ImageNode(DjangoObjectType):
     class Meta:
         model = Image
         fields = ['title', 'files']
         interfaces = (relay.Node, )
+        connection_class = PrimingConnection
+
+    @classmethod
+    def prime_loaders(cls, info, images):
+        get_loader(info.context, 'image_files') \
+            .prime([image.id for image in images])
+
+    def resolve_files(self, info, **kwargs):
+        return get_loader(info.context, 'image_files').load(self.id, [])
 
 
 class ImageFileNode(DjangoObjectType):
@@ -47,7 +105,7 @@ class ImageFileNode(DjangoObjectType):
         fields = ['url', 'width', 'height']
 
     def resolve_url(self, info):
-        return self.photo.url
+        return get_file_url(self.photo.name)
 
 
 class Query(ObjectType):
@@ -59,3 +117,4 @@ class Query(ObjectType):
 
 
 schema = Schema(query=Query)
+validation_rules = (*specified_rules, QueryCostRule)
@@ -0,0 +1,270 @@
+"""
+Album search on a table of trigrams.
+The title, category title and tag texts of each album are cut into the
+trigrams starting at each of their characters, the last ones shorter, and
+stored in AlbumSearchToken with the weight of the text they come from.
+A query of 3 characters or more matches the albums having the trigrams
+covering it, ranked by the weight of the rarest one and rechecked on
+Album.search_text, the normalized texts one per line, to have the query in one
+of them. A shorter query matches the most recent albums having a token
+starting with it: the few albums of a rare
+prefix are read from the token index, the albums of a common one are found
+early reading the most recent albums.
+The tokens are rebuilt by the signals of the writes to albums, categories
+and tags, `manage.py rebuildsearchindex` rebuilds all of them.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Subquery
+from django.db.models import signals
+from django.dispatch import receiver
+from .models import Album, AlbumSearchToken, Category, Tag
+
+TOKEN_SIZE = 3
+TITLE_WEIGHT = 3
+CATEGORY_WEIGHT = 2
+TAG_WEIGHT = 1
+DEFAULT_TYPEAHEAD_LIMIT = 20
+# tokens of more albums are as common as each other to sort them
+RAREST_COUNT_LIMIT = 200
+# prefixes of more albums are found reading the most recent albums
+RARE_PREFIX_LIMIT = 200
+
+
+def normalize(text):
+    return ' '.join((text or '').casefold().split())
+
+
+def get_tokens(text) -> set:
+    """Trigrams starting at each character, the last two shorter"""
+    text = normalize(text)
+    return {text[i:i + TOKEN_SIZE] for i in range(len(text))}
+
+
+def get_query_tokens(q) -> set:
+    """
+    Full trigrams covering q, side by side and the last one ending q,
+    the overlapping ones would only filter the same matches again
+    """
+    starts = list(range(0, len(q) - TOKEN_SIZE + 1, TOKEN_SIZE))
+    starts.append(len(q) - TOKEN_SIZE)
+    return {q[i:i + TOKEN_SIZE] for i in starts}
+
+
+def get_album_texts(album: Album, tagged=True) -> list:
+    """
+    :param tagged: False for a new album, which can't have tags yet
+    :return: list of (weight, text)
+    """
+    texts = [(TAG_WEIGHT, tag.text) for tag in album.tags.all()] \
+        if tagged else []
+    if album.category_id:
+        texts.append((CATEGORY_WEIGHT, album.category.title))
+    texts.append((TITLE_WEIGHT, album.title))
+    return texts
+
+
+def get_texts_tokens(texts) -> dict:
+    """:return: dict of token to weight"""
+    tokens = {}
+    for weight, text in texts:
+        for token in get_tokens(text):
+            tokens[token] = max(weight, tokens.get(token, 0))
+    return tokens
+
+
+def get_album_tokens(album: Album, tagged=True) -> dict:
+    return get_texts_tokens(get_album_texts(album, tagged))
+
+
+def get_search_text(texts) -> str:
+    """The normalized texts one per line, a normalized query has no line
+    break so it only matches inside one of them"""
+    return '\n'.join(normalize(text) for _, text in texts)
+
+
+def _create_tokens(album, texts):
+    return [AlbumSearchToken(owner_id=album.owner_id, album_id=album.id,
+                             token=token, weight=weight)
+            for token, weight in get_texts_tokens(texts).items()]
+
+
+def index_albums(albums):
+    albums = list(albums)
+    tokens = []
+    for album in albums:
+        texts = get_album_texts(album)
+        album.search_text = get_search_text(texts)
+        tokens += _create_tokens(album, texts)
+    with transaction.atomic():
+        AlbumSearchToken.objects \
+            .filter(album_id__in=[album.id for album in albums]).delete()
+        # tokens equal under a case or accent insensitive collation collide
+        AlbumSearchToken.objects.bulk_create(tokens, batch_size=1000,
+                                             ignore_conflicts=True)
+        Album.objects.bulk_update(albums, ['search_text'], batch_size=1000)
+
+
+def index_album_ids(album_ids):
+    index_albums(Album.objects.filter(id__in=album_ids)
+                 .select_related('category').prefetch_related('tags'))
+
+
+def rebuild_index(batch_size=1000) -> int:
+    """:return: count of albums indexed"""
+    count = 0
+    last_id = 0
+    while True:
+        album_ids = list(Album.objects.filter(id__gt=last_id).order_by('id')
+                         .values_list('id', flat=True)[:batch_size])
+        if not album_ids:
+            return count
+        index_album_ids(album_ids)
+        count += len(album_ids)
+        last_id = album_ids[-1]
+
+
+def search_albums(owner, q):
+    """
+    Albums of the owner matching q, annotated with `search_score`, the
+    weight of the text matching q, and ordered by it then the most recent
+    first. The albums are read in the order of an index so the database
+    stops at the first page of matches, the albums having the trigrams of q
+    in other places are filtered out on the way.
+    """
+    q = normalize(q)
+    if not q:
+        return Album.objects.none()
+    if len(q) < TOKEN_SIZE:
+        return search_prefix(owner, q)
+    tokens = sort_tokens(owner, get_query_tokens(q))
+    if not tokens:
+        return Album.objects.none()
+    return search_tokens(owner, tokens).filter(search_text__contains=q)
+
+
+def get_prefix_albums(owner, prefix):
+    """Ids of the albums having a token starting with prefix, one more than
+    a rare prefix has at most"""
+    return AlbumSearchToken.objects \
+        .filter(owner=owner, token__gte=prefix,
+                token__lt=prefix + '\U0010ffff') \
+        .order_by().values_list('album_id', flat=True) \
+        .distinct()[:RARE_PREFIX_LIMIT + 1]
+
+
+def search_prefix(owner, prefix, album_ids=None):
+    """
+    The most recent albums having a token starting with prefix
+    :param album_ids: of get_prefix_albums, read when None
+    """
+    if album_ids is None:
+        album_ids = list(get_prefix_albums(owner, prefix))
+    # the range of tokens starting with the prefix, which an index can seek
+    prefixed = AlbumSearchToken.objects.filter(
+        album=OuterRef('pk'), token__gte=prefix,
+        token__lt=prefix + '\U0010ffff')
+    albums = Album.objects.filter(owner=owner) \
+        .annotate(search_score=Subquery(prefixed.order_by('-weight')
+                                        .values('weight')[:1]))
+    if len(album_ids) > RARE_PREFIX_LIMIT:
+        albums = albums.filter(search_score__isnull=False)
+    else:
+        albums = albums.filter(id__in=album_ids)
+    return albums.order_by('-create_at', '-id')
+
+
+def get_token_albums(owner, token):
+    """Albums of the token, as many as counting the rarest token needs"""
+    return AlbumSearchToken.objects.filter(owner=owner, token=token) \
+        .values('album_id')[:RAREST_COUNT_LIMIT]
+
+
+def sort_tokens(owner, tokens) -> list:
+    """:return: tokens from the rarest, empty if a token has no album"""
+    counts = {}
+    for token in sorted(tokens):
+        counts[token] = get_token_albums(owner, token).count()
+        if not counts[token]:
+            return []
+    return sorted(counts, key=counts.get)
+
+
+def search_tokens(owner, tokens):
+    """
+    The albums of the first token having the other tokens, by rank
+    :param tokens: from the rarest, so the fewest albums are checked
+    """
+    albums = Album.objects.filter(albumsearchtoken__owner=owner,
+                                  albumsearchtoken__token=tokens[0])
+    for token in tokens[1:]:
+        albums = albums.filter(Exists(AlbumSearchToken.objects.filter(
+            album=OuterRef('pk'), token=token)))
+    # ordered by the columns of the token index, album_id is the album id
+    return albums.annotate(search_score=F('albumsearchtoken__weight'),
+                           token_album_id=F('albumsearchtoken__album_id')) \
+        .order_by('-search_score', '-token_album_id')
+
+
+def get_typeahead_limit():
+    return getattr(settings, 'IMS_SEARCH_TYPEAHEAD_LIMIT',
+                   DEFAULT_TYPEAHEAD_LIMIT)
+
+
+@receiver(signals.pre_save, sender=Album)
+def set_search_text(sender, instance: Album = None, raw=False, **kwargs):
+    """The search text of a new album, written by its insert"""
+    if instance._state.adding and not raw:
+        instance.search_text = get_search_text(
+            get_album_texts(instance, tagged=False))
+
+
+@receiver(signals.post_save, sender=Album)
+def index_saved_album(sender, instance: Album = None, created=False,
+                      raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        AlbumSearchToken.objects.bulk_create(
+            _create_tokens(instance, get_album_texts(instance, tagged=False)),
+            ignore_conflicts=True)
+    else:
+        index_albums([instance])
+
+
+@receiver(signals.m2m_changed, sender=Album.tags.through)
+def index_tagged_albums(sender, instance=None, reverse=False, action=None,
+                        pk_set=None, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            index_album_ids([instance.pk])
+    elif action == 'pre_clear':
+        # tag.album_set.clear(), the albums are gone after
+        instance._cleared_album_ids = list(
+            instance.album_set.values_list('id', flat=True))
+    elif action == 'post_clear':
+        index_album_ids(instance._cleared_album_ids)
+    elif action in ('post_add', 'post_remove'):
+        index_album_ids(pk_set)
+
+
+@receiver(signals.post_save, sender=Category)
+@receiver(signals.post_save, sender=Tag)
+def index_renamed_albums(sender, instance=None, created=False, raw=False,
+                         **kwargs):
+    if not created and not raw:
+        index_album_ids(instance.album_set.values_list('id', flat=True))
+
+
+@receiver(signals.pre_delete, sender=Category)
+@receiver(signals.pre_delete, sender=Tag)
+def remember_albums(sender, instance=None, **kwargs):
+    """The albums lose the category or tag without signals of their own"""
+    instance._deleted_album_ids = list(
+        instance.album_set.values_list('id', flat=True))
+
+
+@receiver(signals.post_delete, sender=Category)
+@receiver(signals.post_delete, sender=Tag)
+def index_albums_of_deleted(sender, instance=None, **kwargs):
+    index_album_ids(instance._deleted_album_ids)
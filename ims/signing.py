@@ -0,0 +1,52 @@
+"""
+Signed, expiring urls of image files.
+A url /s/{expires}/{signature}/{name} carries the stored name of the file,
+which is derived from its sha1, and the time it expires; the signature is
+an HMAC of both with the SECRET_KEY. It is checked with the secret only,
+so serving a shared file needs neither a session nor a database query.
+Expiry times are rounded up to IMS_SHARE_URL_BUCKET, so the urls signed
+within a bucket are the same and the responses having them stay cacheable.
+"""
+import time
+from django.conf import settings
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+SALT = 'ims.signing.file'
+DEFAULT_EXPIRE = 7 * 24 * 3600
+DEFAULT_BUCKET = 3600
+
+
+def get_expires(now=None) -> int:
+    """Expiry time of the urls signed now, at least IMS_SHARE_URL_EXPIRE
+    seconds ahead"""
+    expire = getattr(settings, 'IMS_SHARE_URL_EXPIRE', DEFAULT_EXPIRE)
+    bucket = getattr(settings, 'IMS_SHARE_URL_BUCKET', DEFAULT_BUCKET)
+    now = int(time.time() if now is None else now)
+    return (now + expire + bucket - 1) // bucket * bucket
+
+
+def get_signature(name, expires) -> str:
+    return salted_hmac(SALT, '%s:%s' % (name, expires),
+                       algorithm='sha256').hexdigest()[:32]
+
+
+def sign_names(names, expires=None) -> dict:
+    """:return: dict of name to its signed url path, all expiring at once"""
+    expires = expires or get_expires()
+    # reversed once, only the signature and the name differ
+    prefix = reverse('ims.signed_file', args=(expires, 'signature', 'name'))
+    prefix = prefix[:-len('signature/name')]
+    return {name: '%s%s/%s' % (prefix, get_signature(name, expires), name)
+            for name in names}
+
+
+def sign_name(name, expires=None) -> str:
+    return sign_names([name], expires)[name]
+
+
+def verify(name, expires, signature, now=None) -> bool:
+    """True when the signature is the name's and it isn't expired yet"""
+    now = time.time() if now is None else now
+    return int(expires) > now \
+        and constant_time_compare(signature, get_signature(name, expires))
@@ -0,0 +1,98 @@
+"""
+Bulk helpers over the file storage.
+Image files are stored as {sha1[0:2]}/{sha1[2:4]}/{sha1[4:]}.{ext}, the
+first two hex digits of the sha1 split the files into 256 shards.
+"""
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from django.urls import reverse
+
+SHARDS = ['%02x' % i for i in range(256)]
+
+
+def get_shard(name):
+    """The shard of a stored image file name, None for other layouts."""
+    shard = name[0:2]
+    if shard in SHARDS and name[2:3] == '/':
+        return shard
+    return None
+
+
+def _walk_storage(storage, path):
+    try:
+        dirs, files = storage.listdir(path)
+    except FileNotFoundError:
+        return
+    for file in files:
+        yield posixpath.join(path, file)
+    for directory in dirs:
+        yield from _walk_storage(storage, posixpath.join(path, directory))
+
+
+def list_files(storage, prefix) -> set:
+    """
+    Names of all the files under prefix.
+    On S3 the keys are read from a flat bucket listing, 1000 per request,
+    instead of walking the directories, storages indexing their files
+    list them with `list_names`.
+    """
+    list_names = getattr(storage, 'list_names', None)
+    if list_names is not None:
+        return list_names(prefix)
+    bucket = getattr(storage, 'bucket', None)
+    if bucket is None:
+        return set(_walk_storage(storage, prefix))
+
+    # django-storages S3Boto3Storage, keys are prefixed by its location
+    key_prefix = storage._normalize_name(prefix.rstrip('/') + '/')
+    strip = len(key_prefix) - len(prefix.rstrip('/') + '/')
+    return set(obj.key[strip:] for obj in bucket.objects.filter(Prefix=key_prefix))
+
+
+def get_file_url(name):
+    """
+    Url of a stored file on every storage, /files/ checks the access to it
+    and sends it, the urls of the storage may be unsigned or expire
+    """
+    return reverse('ims.file', args=(name,))
+
+
+def get_signed_url(storage, name, expire):
+    """
+    Url of a file of a private S3 bucket, signed for `expire` seconds even
+    when the storage's urls aren't (AWS_QUERYSTRING_AUTH = False, or
+    AWS_S3_CUSTOM_DOMAIN without a CloudFront signer)
+    """
+    if getattr(storage, 'cloudfront_signer', None) is not None:
+        return storage.url(name, expire=expire)
+    return storage.bucket.meta.client.generate_presigned_url(
+        'get_object', ExpiresIn=expire,
+        Params={'Bucket': storage.bucket.name,
+                'Key': storage._normalize_name(name)})
+
+
+def find_missing(storage, names, workers=8) -> list:
+    """Names which don't exist in the storage, checked by a thread pool."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        exists = executor.map(storage.exists, names)
+        return [name for name, found in zip(names, exists) if not found]
+
+
+def delete_files(storage, names, batch_size=1000):
+    """
+    Delete files from the storage.
+    On S3 up to 1000 keys are deleted by a single request.
+    """
+    names = list(names)
+    bucket = getattr(storage, 'bucket', None)
+    if bucket is None:
+        for name in names:
+            storage.delete(name)
+        return
+
+    for i in range(0, len(names), batch_size):
+        bucket.delete_objects(Delete={
+            'Objects': [{'Key': storage._normalize_name(name)}
+                        for name in names[i:i + batch_size]],
+            'Quiet': True,
+        })
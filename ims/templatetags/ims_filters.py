@@ -1,4 +1,11 @@
 from django import template
 from ..models import Album
+from ..storage import get_file_url
 
 register = template.Library()
+
+
+@register.filter
+def media_url(name):
+    """Url of a stored file by its name, through /files/"""
+    return get_file_url(name)
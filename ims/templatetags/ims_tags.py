@@ -1,5 +1,6 @@
 from django import template
 from ..models import Category
+from .. import cache
 
 register = template.Library()
 
@@ -14,4 +15,33 @@ def user_categories(context):
 
 @register.simple_tag(takes_context=True)
 def full_url(context, url):
-    return context.request.build_absolute_uri(url)
\ No newline at end of file
+    return context.request.build_absolute_uri(url)
+
+
+class AlbumCacheNode(template.Node):
+    def __init__(self, nodelist, album, name):
+        self.nodelist = nodelist
+        self.album = album
+        self.name = name
+
+    def render(self, context):
+        album = self.album.resolve(context)
+        return cache.get_or_build('fragment:%s' % self.name.resolve(context),
+                                  album.id, album.cache_version,
+                                  lambda: self.nodelist.render(context))
+
+
+@register.tag
+def albumcache(parser, token):
+    """
+    Cache the enclosed fragment until the album changes
+    {% albumcache album 'name' %} ... {% endalbumcache %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 3:
+        raise template.TemplateSyntaxError(
+            "'%s' tag requires an album and a fragment name." % bits[0])
+    nodelist = parser.parse(('endalbumcache',))
+    parser.delete_first_token()
+    return AlbumCacheNode(nodelist, parser.compile_filter(bits[1]),
+                          parser.compile_filter(bits[2]))
@@ -1,20 +1,74 @@
 import os
 import re
-from io import BytesIO
+from io import BytesIO, StringIO
 import json
-from django.test import TestCase, Client
+import time
+import tempfile
+import asyncio
+from hashlib import sha1
+from urllib.parse import parse_qs, urlparse
+from datetime import timedelta
+import requests
+import httpx
+import numpy as np
+from unittest import mock, skipUnless
+from django.test import TestCase, Client, RequestFactory, override_settings
+from django.conf import settings
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.core.cache import cache
+from django.utils import timezone
 from django.contrib.auth.models import User
-from ims.views import upload_file_images, SM_SIZE, MD_SIZE
-from ims.models import Image, Album
+from ims.views import upload_file_images, serve_media, with_cover_photo
+from ims.views import SM_SIZE, MD_SIZE
+from ims.models import Image, Album, DerivativeJob, ImageToFile, CachedDerivative
+from ims.models import ImageFile, UploadSession, Tag, Category, AlbumSearchToken
+from ims.models import PackedBlob
 from ims.process import crop_image, get_or_create_image_file
+from ims.process import generate_thumbnail_files, generate_derivative_files
+from ims.process import get_stream_from_source, negotiate_format
+from ims.exceptions import ImageFileTooLarge
+from PIL import Image as PImage
+from ims.jobs import run_pending_jobs, claim_jobs, enqueue_derivatives
+from ims.derivatives import evict_derivatives
+from ims.queryplans import check_query_plans
+from ims.packstore import PackedStorage
+from ims.storage import list_files, SHARDS
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.base import ContentFile
+from graphql_relay import to_global_id
+from ims.search import search_albums, get_tokens, get_query_tokens, rebuild_index
+from ims import derivatives, uploads, signing, duplicates
+from ims.aioclient import AsyncImageBankClient
+from ims.client import ImageBankClient
+from ims.exceptions import IMAGE_FILE_NOT_FOUND
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 
 BASE_DIR = os.path.dirname(__file__)
 
+RUN_BENCHMARKS = bool(os.environ.get('IMS_BENCHMARK'))
+
+
+def create_album_images(album, count):
+    """Bulk create images sharing one image file for all their shapes."""
+    with open(os.path.join(BASE_DIR, '..', 'static/img/sample1.jpg'), 'rb') as f:
+        image_file = get_or_create_image_file(BytesIO(f.read()))
+    Image.objects.bulk_create(
+        [Image(album=album, title='image_%s' % i, origin_file=image_file,
+               md_file=image_file, sm_file=image_file)
+         for i in range(count)], batch_size=500)
+    ImageToFile.objects.bulk_create(
+        [ImageToFile(image_id=image_id, file=image_file, shape=shape)
+         for image_id in album.image_set.values_list('id', flat=True)
+         for shape in ('origin', 'md', 'sm')], batch_size=500)
+
 
 class ApiTestBase(TestCase):
     def setUp(self) -> None:
+        # cached album output outlives the rolled back rows
+        cache.clear()
         user, _ = User.objects.get_or_create(username='testuser')
         token, _ = Token.objects.get_or_create(user=user)
         Album.objects.filter(owner=user).delete()
@@ -26,6 +80,7 @@ class ApiTestBase(TestCase):
 
 class WebViewTestBase(TestCase):
     def setUp(self) -> None:
+        cache.clear()
         user, _ = User.objects.get_or_create(username='testuser')
         self.client.force_login(user)
         self.user = user
@@ -75,6 +130,7 @@ class UploadViewTest(TestCase):
 
 class APIUploadTest(TestCase):
     def setUp(self):
+        cache.clear()
         user, _ = User.objects.get_or_create(username='testuser')
         token, _ = Token.objects.get_or_create(user=user)
         Album.objects.filter(owner=user).delete()
@@ -104,6 +160,50 @@ class APIUploadTest(TestCase):
         self.assertIn('md', image_files)
         self.assertIn('sm', image_files)
 
+    def test_post_sha1(self):
+        with open(os.path.join(BASE_DIR, '..', 'static/img/wallpaper_tree.jpg'), 'rb') as f:
+            response = self.client.post('/api/v1/image/upload', {'file': f})
+        image = Image.objects.get(pk=response.json()['image_id'])
+        album = Album.objects.create(owner=self.user, title='test_post_sha1')
+
+        response = self.client.post('/api/v1/image/upload', {
+            'sha1': image.origin_file.sha1.upper(), 'album_id': album.id})
+        self.assertEqual(200, response.status_code)
+        new_image = Image.objects.get(pk=response.json()['image_id'])
+        self.assertEqual(album, new_image.album)
+        self.assertEqual('wallpaper_tree.jpg', new_image.title)
+        self.assertEqual(image.md_file, new_image.md_file)
+
+        response = self.client.post('/api/v1/image/upload', {'sha1': '0' * 40})
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(IMAGE_FILE_NOT_FOUND, response.json()['error_code'])
+
+        # the file of another user's image can't be claimed by its sha1
+        other_user, _ = User.objects.get_or_create(username='otheruser')
+        self.client.force_authenticate(other_user)
+        response = self.client.post('/api/v1/image/upload', {
+            'sha1': image.origin_file.sha1, 'album': 'stolen'})
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(IMAGE_FILE_NOT_FOUND, response.json()['error_code'])
+
+    def test_files_exists(self):
+        other_user, _ = User.objects.get_or_create(username='otheruser')
+        other_album = Album.objects.create(owner=other_user, title='other')
+        create_album_images(other_album, 1)
+        image_file = other_album.image_set.get().origin_file
+        response = self.client.post('/api/v1/files/exists', {
+            'sha1': ['0' * 40, image_file.sha1]}, format='json')
+        self.assertEqual({'exists': []}, response.json())
+
+        create_album_images(Album.objects.create(owner=self.user, title='own'), 1)
+        response = self.client.post('/api/v1/files/exists', {
+            'sha1': ['0' * 40, image_file.sha1]}, format='json')
+        self.assertEqual({'exists': [image_file.sha1]}, response.json())
+
+        response = self.client.post('/api/v1/files/exists', {'sha1': '0' * 40},
+                                    format='json')
+        self.assertEqual(400, response.status_code)
+
     def test_noauth(self):
         self.client.credentials()
         file_to_upload = open(
@@ -198,6 +298,189 @@ class APIUploadTest(TestCase):
         response_json = response.json()
         self.assertEqual(10003, response_json['error_code'])
 
+    def _get_updated_tables(self, post_data):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/api/v1/image/upload', post_data)
+        self.assertEqual(200, response.status_code)
+        return [q['sql'].split()[1].strip('"') for q in context.captured_queries
+                if q['sql'].startswith('UPDATE ')]
+
+    def test_upload_image_updates(self):
+        with open(os.path.join(BASE_DIR, '..', 'static/img/wallpaper_tree.jpg'), 'rb') as f:
+            self.assertEqual(['ims_album'], self._get_updated_tables(
+                {'file': f, 'title': '1.jpg'}))
+            # the deduplicated files are stamped for gcimagefiles
+            f.seek(0)
+            self.assertEqual(['ims_imagefile'] * 3, self._get_updated_tables(
+                {'file': f, 'title': '1.jpg'}))
+            f.seek(0)
+            self.assertEqual(['ims_imagefile'] * 3 + ['ims_image', 'ims_album'],
+                             self._get_updated_tables({'file': f, 'title': '2.jpg'}))
+
+    @override_settings(IMS_MAX_UPLOAD_SIZE=1024)
+    def test_upload_too_large(self):
+        with open(os.path.join(BASE_DIR, '..', 'static/img/wallpaper_tree.jpg'), 'rb') as f:
+            response = self.client.post('/api/v1/image/upload', {'file': f})
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(10004, response.json()['error_code'])
+
+
+class ApiBatchUploadTest(ApiTestBase):
+    def _open(self, name):
+        return open(os.path.join(BASE_DIR, '..', 'static/img', name), 'rb')
+
+    def test_post(self):
+        album = Album.objects.create(title='ApiBatchUploadTest', owner=self.user)
+        with self._open('wallpaper_tree.jpg') as f1, self._open('sample1.jpg') as f2, \
+                self._open('sample1.jpg') as f3:
+            response = self.client.post('/api/v1/images/batch', {
+                'album_id': album.id,
+                'file': [f1, f2, f3, BytesIO(b'not an image')],
+            })
+        self.assertEqual(200, response.status_code)
+        results = response.json()['results']
+        self.assertEqual(['created', 'created', 'exists', 'error'],
+                         [x['status'] for x in results])
+        self.assertEqual(results[1]['image']['id'], results[2]['image']['id'])
+        self.assertEqual(10003, results[3]['error_code'])
+
+        image = Image.objects.get(pk=results[0]['image']['id'])
+        self.assertEqual(album, image.album)
+        self.assertEqual('wallpaper_tree.jpg', image.title)
+        self.assertTrue(image.md_file.size <= MD_SIZE)
+        self.assertTrue(image.sm_file.size <= SM_SIZE)
+        self.assertEqual({'origin', 'md', 'sm'},
+                         set(image.imagetofile_set.values_list('shape', flat=True)))
+        self.assertEqual(2, album.image_set.count())
+
+    def test_post_existing_files(self):
+        with self._open('wallpaper_tree.jpg') as f:
+            self.client.post('/api/v1/images/batch', {'album': 'first', 'file': [f]})
+        with self._open('wallpaper_tree.jpg') as f1, self._open('sample1.jpg') as f2:
+            self.client.post('/api/v1/images/batch', {'album': 'second', 'file': [f1, f2]})
+
+        with self._open('wallpaper_tree.jpg') as f1, self._open('sample1.jpg') as f2:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post('/api/v1/images/batch',
+                                            {'album': 'third', 'file': [f1, f2]})
+        self.assertEqual(['created', 'created'],
+                         [x['status'] for x in response.json()['results']])
+        # the derivative files are reused, nothing is generated or saved one by one
+        self.assertFalse([q for q in context.captured_queries
+                          if 'INSERT INTO "ims_imagefile"' in q['sql']])
+        images = Image.objects.filter(album__title='third')
+        self.assertEqual(2, len(images))
+        for image in images:
+            self.assertIsNotNone(image.md_file)
+            self.assertEqual(3, image.imagetofile_set.count())
+
+    @override_settings(IMS_ASYNC_DERIVATIVES=True)
+    def test_post_async(self):
+        with self._open('wallpaper_tree.jpg') as f:
+            response = self.client.post('/api/v1/images/batch', {'file': [f]})
+        image_id = response.json()['results'][0]['image']['id']
+        self.assertEqual(1, DerivativeJob.objects.filter(image_id=image_id).count())
+        run_pending_jobs()
+        self.assertIsNotNone(Image.objects.get(pk=image_id).md_file)
+
+    def test_post_source_error(self):
+        with mock.patch('ims.process.requests.get', side_effect=requests.ConnectionError()):
+            response = self.client.post('/api/v1/images/batch',
+                                        {'source': ['http://example.com/1.jpg']})
+        result = response.json()['results'][0]
+        self.assertEqual('error', result['status'])
+        self.assertEqual(10006, result['error_code'])
+
+    def test_post_empty(self):
+        response = self.client.post('/api/v1/images/batch', {})
+        self.assertEqual(400, response.status_code)
+
+    def test_post_derivatives_outside_transaction(self):
+        # the test case's own transactions
+        depth = len(connection.savepoint_ids)
+        depths = []
+
+        def generate(origin_file):
+            depths.append(len(connection.savepoint_ids))
+            return generate_derivative_files(origin_file)
+        with mock.patch('ims.views.generate_derivative_files', side_effect=generate), \
+                self._open('wallpaper_tree.jpg') as f:
+            response = self.client.post('/api/v1/images/batch', {'file': [f]})
+        self.assertEqual('created', response.json()['results'][0]['status'])
+        self.assertEqual([depth], depths)
+
+    def test_post_touches_reused_files(self):
+        with self._open('wallpaper_tree.jpg') as f:
+            self.client.post('/api/v1/images/batch', {'album': 'first', 'file': [f]})
+        old = timezone.now() - timedelta(days=2)
+        ImageFile.objects.update(update_at=old)
+        with self._open('wallpaper_tree.jpg') as f:
+            self.client.post('/api/v1/images/batch', {'album': 'second', 'file': [f]})
+        self.assertFalse(ImageFile.objects.filter(update_at=old).exists())
+
+    @override_settings(IMS_BATCH_UPLOAD_MAX_ITEMS=2)
+    def test_post_too_many(self):
+        with mock.patch('ims.process.requests.get') as get:
+            response = self.client.post('/api/v1/images/batch', {
+                'source': ['http://example.com/%s.jpg' % i for i in range(3)]})
+        self.assertEqual(400, response.status_code)
+        get.assert_not_called()
+
+
+@override_settings(IMS_ASYNC_DERIVATIVES=True)
+class AsyncDerivativesTest(ApiTestBase):
+    def test_upload_pending(self):
+        with open(os.path.join(BASE_DIR, '..', 'static/img/wallpaper_tree.jpg'), 'rb') as f:
+            response = self.client.post('/api/v1/image/upload', {'file': f})
+        self.assertEqual(200, response.status_code)
+        image_info = response.json()['image']
+        self.assertEqual(['md', 'sm'], image_info['pending_shapes'])
+
+        new_image = Image.objects.get(pk=image_info['id'])
+        self.assertIsNotNone(new_image.origin_file)
+        self.assertIsNone(new_image.md_file)
+        self.assertIsNone(new_image.sm_file)
+        self.assertEqual(1, DerivativeJob.objects.filter(image=new_image).count())
+
+        response = self.client.get('/api/v1/album/%s' % new_image.album_id)
+        self.assertEqual(200, response.status_code)
+        self.assertIsNone(response.json()['album']['images'][0]['md'])
+
+    def test_run_pending_jobs(self):
+        with open(os.path.join(BASE_DIR, '..', 'static/img/wallpaper_tree.jpg'), 'rb') as f:
+            response = self.client.post('/api/v1/image/upload', {'file': f})
+        image_id = response.json()['image']['id']
+
+        self.assertEqual(1, run_pending_jobs())
+        self.assertEqual(0, run_pending_jobs())
+        new_image = Image.objects.get(pk=image_id)
+        self.assertTrue(new_image.md_file.size <= MD_SIZE)
+        self.assertTrue(new_image.sm_file.size <= SM_SIZE)
+        self.assertFalse(DerivativeJob.objects.filter(image=new_image).exists())
+
+    def test_hash_in_job(self):
+        with open(os.path.join(BASE_DIR, '..', 'static/img/wallpaper_tree.jpg'), 'rb') as f:
+            response = self.client.post('/api/v1/image/upload', {'file': f})
+        origin_file = Image.objects.get(pk=response.json()['image']['id']).origin_file
+        self.assertIsNone(origin_file.phash)
+        run_pending_jobs()
+        origin_file.refresh_from_db()
+        self.assertIsNotNone(origin_file.phash)
+
+    def test_claim_jobs_once(self):
+        with open(os.path.join(BASE_DIR, '..', 'static/img/wallpaper_tree.jpg'), 'rb') as f:
+            self.client.post('/api/v1/image/upload', {'file': f})
+        self.assertEqual(1, len(claim_jobs()))
+        self.assertEqual(0, len(claim_jobs()))
+
+    def test_enqueue_running(self):
+        with open(os.path.join(BASE_DIR, '..', 'static/img/wallpaper_tree.jpg'), 'rb') as f:
+            response = self.client.post('/api/v1/image/upload', {'file': f})
+        new_image = Image.objects.get(pk=response.json()['image']['id'])
+        job, = claim_jobs()
+        self.assertEqual(job, enqueue_derivatives(new_image))
+        self.assertEqual(1, DerivativeJob.objects.filter(image=new_image).count())
+
 
 class ApiImageCropTest(ApiTestBase):
     def test_post(self):
@@ -211,6 +494,7 @@ class ApiImageCropTest(ApiTestBase):
                                     })
         self.assertEqual(200, response.status_code)
         new_image_id = json.loads(response.content)['image']['id']
+        version = Image.objects.get(pk=new_image_id).album.version
 
         response = self.client.post('/api/v1/image/crop', {
             'image_id': new_image_id,
@@ -221,6 +505,7 @@ class ApiImageCropTest(ApiTestBase):
         new_image = Image.objects.get(pk=new_image_id)
         image_files = {imagetofile.shape: imagetofile.file for imagetofile in new_image.imagetofile_set.all()}
         self.assertIn('square', image_files)
+        self.assertEqual(version + 1, new_image.album.version)
 
     def test_post_overwrite(self):
         Image.objects.filter(album__owner=self.user).delete()
@@ -376,6 +661,85 @@ class ProcessTest(TestCase):
         self.assertTrue(cropped_imagefile.size == (350, 350))
 
 
+    def test_generate_thumbnail_files(self):
+        image = PImage.open(os.path.join(BASE_DIR, '..', 'static/img/wallpaper_tree.jpg'))
+        sm_imagefile, md_imagefile = generate_thumbnail_files(image, [SM_SIZE, MD_SIZE])
+
+        self.assertEqual((150, 93), sm_imagefile.size)
+        self.assertEqual((500, 311), md_imagefile.size)
+        for imagefile in (sm_imagefile, md_imagefile):
+            self.assertEqual('JPEG', imagefile.format)
+            with PImage.open(imagefile.photo.path) as thumbnail:
+                self.assertEqual(imagefile.size, thumbnail.size)
+
+    @override_settings(IMS_EXTRA_SHAPES={'lg': (1000, 1000)})
+    def test_extra_shapes(self):
+        with open(os.path.join(BASE_DIR, '..', 'static/img/wallpaper_tree.jpg'), 'rb') as f:
+            buffer = BytesIO(f.read())
+        origin_imagefile = get_or_create_image_file(buffer)
+        shape_files = generate_derivative_files(origin_imagefile)
+
+        self.assertEqual({'md', 'sm', 'lg'}, set(shape_files))
+        self.assertEqual((1000, 622), shape_files['lg'].size)
+        self.assertEqual((500, 311), shape_files['md'].size)
+
+    @override_settings(IMS_DERIVATIVE_FORMAT='WEBP')
+    def test_derivative_format(self):
+        with open(os.path.join(BASE_DIR, '..', 'static/img/wallpaper_tree.jpg'), 'rb') as f:
+            origin_imagefile = get_or_create_image_file(BytesIO(f.read()))
+        shape_files = generate_derivative_files(origin_imagefile)
+
+        for shape in ('md', 'sm'):
+            self.assertEqual('WEBP', shape_files[shape].format)
+            self.assertTrue(shape_files[shape].photo.name.endswith('.webp'))
+            with PImage.open(shape_files[shape].photo.path) as thumbnail:
+                self.assertEqual('WEBP', thumbnail.format)
+
+    def test_negotiate_format(self):
+        self.assertEqual('WEBP', negotiate_format('image/webp,*/*', 'JPEG'))
+        self.assertEqual('AVIF', negotiate_format('image/avif,image/webp,*/*', 'PNG'))
+        self.assertEqual('JPEG', negotiate_format('image/webp;q=0, */*', 'JPEG'))
+        self.assertEqual('PNG', negotiate_format('*/*', 'PNG'))
+        self.assertEqual('PNG', negotiate_format(None, 'PNG'))
+        with override_settings(IMS_NEGOTIATED_FORMATS=['WEBP']):
+            self.assertEqual('WEBP', negotiate_format('image/avif,image/webp', 'PNG'))
+
+    @override_settings(IMS_MAX_UPLOAD_SIZE=1024)
+    def test_max_upload_size(self):
+        with open(os.path.join(BASE_DIR, '..', 'static/img/sample1.jpg'), 'rb') as f:
+            buffer = BytesIO(f.read())
+        with self.assertRaises(ImageFileTooLarge):
+            get_or_create_image_file(buffer)
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=1024)
+    def test_get_stream_from_source(self):
+        with open(os.path.join(BASE_DIR, '..', 'static/img/sample1.jpg'), 'rb') as f:
+            content = f.read()
+        response = mock.MagicMock()
+        response.__enter__.return_value = response
+        response.headers = {}
+        response.iter_content.side_effect = lambda size: (
+            content[i:i + size] for i in range(0, len(content), size))
+        with mock.patch('ims.process.requests.get', return_value=response) as get:
+            stream = get_stream_from_source('http://example.com/sample1.jpg')
+
+        get.assert_called_once_with('http://example.com/sample1.jpg', stream=True)
+        self.assertEqual('sample1.jpg', stream.name)
+        self.assertEqual(content, stream.read())
+        image_file = get_or_create_image_file(stream)
+        self.assertEqual(stream.sha1, image_file.sha1)
+        self.assertEqual(len(content), image_file.file_size)
+
+    @override_settings(IMS_MAX_UPLOAD_SIZE=1024)
+    def test_get_stream_from_source_too_large(self):
+        response = mock.MagicMock()
+        response.__enter__.return_value = response
+        response.headers = {'Content-Length': '4096'}
+        with mock.patch('ims.process.requests.get', return_value=response):
+            with self.assertRaises(ImageFileTooLarge):
+                get_stream_from_source('http://example.com/sample1.jpg')
+        response.iter_content.assert_not_called()
+
     def test_save_filecontent_if_not_exist(self):
         with open(os.path.join(BASE_DIR, '..', 'static/img/sample1.jpg'), 'rb') as f:
             buffer = BytesIO(f.read())
@@ -391,6 +755,570 @@ class ProcessTest(TestCase):
         self.assertTrue(os.path.exists(origin_imagefile.photo.path))
 
 
+class DerivativeViewTest(TestCase):
+    def setUp(self):
+        with open(os.path.join(BASE_DIR, '..', 'static/img/wallpaper_tree.jpg'), 'rb') as f:
+            self.image_file = get_or_create_image_file(BytesIO(f.read()))
+        user, _ = User.objects.get_or_create(username='testuser')
+        self.album = Album.objects.create(title='DerivativeViewTest', owner=user)
+        image = Image.objects.create(album=self.album, title='tree',
+                                     origin_file=self.image_file)
+        ImageToFile.objects.create(image=image, file=self.image_file,
+                                   shape='origin')
+        self.client.force_login(user)
+
+    def test_get(self):
+        url = '/r/%s/500x500.jpg' % self.image_file.sha1
+        with mock.patch('ims.derivatives.render_derivative',
+                        wraps=derivatives.render_derivative) as render:
+            response = self.client.get(url)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('image/jpeg', response['Content-Type'])
+            content = b''.join(response.streaming_content)
+            self.assertEqual((500, 311), PImage.open(BytesIO(content)).size)
+
+            response = self.client.get(url)
+            self.assertEqual(content, b''.join(response.streaming_content))
+        self.assertEqual(1, render.call_count)
+
+    def test_get_png(self):
+        response = self.client.get('/r/%s/150x150.png' % self.image_file.sha1)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/png', response['Content-Type'])
+
+    def test_get_negotiated(self):
+        url = '/r/%s/150x150' % self.image_file.sha1
+        response = self.client.get(url, HTTP_ACCEPT='image/webp,*/*')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/webp', response['Content-Type'])
+        self.assertIn('Accept', response['Vary'])
+        content = b''.join(response.streaming_content)
+        self.assertEqual('WEBP', PImage.open(BytesIO(content)).format)
+
+        response = self.client.get(url, HTTP_ACCEPT='image/*')
+        self.assertEqual('image/jpeg', response['Content-Type'])
+
+    def test_get_access(self):
+        url = '/r/%s/150x150.jpg' % self.image_file.sha1
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertIn('private', response['Cache-Control'])
+
+        other, _ = User.objects.get_or_create(username='other')
+        self.client.force_login(other)
+        self.assertEqual(404, self.client.get(url).status_code)
+        self.client.logout()
+        self.assertEqual(404, self.client.get(url).status_code)
+
+        self.album.is_public = True
+        self.album.save()
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_get_conditional(self):
+        url = '/r/%s/150x150.jpg' % self.image_file.sha1
+        response = self.client.get(url)
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        etag = response['ETag']
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        # the access check only, the file isn't looked up
+        self.assertEqual(1, len([q for q in context.captured_queries
+                                 if 'ims_' in q['sql']]))
+
+        url = '/r/%s/150x150' % self.image_file.sha1
+        response = self.client.get(url, HTTP_ACCEPT='image/webp')
+        response = self.client.get(url, HTTP_ACCEPT='image/webp',
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+        self.assertIn('Accept', response['Vary'])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(200, response.status_code)
+
+    def test_serve_media(self):
+        request = RequestFactory().get('/images/' + self.image_file.photo.name)
+        response = serve_media(request, self.image_file.photo.name,
+                               document_root=settings.MEDIA_ROOT)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('"%s"' % self.image_file.sha1, response['ETag'])
+        self.assertIn('immutable', response['Cache-Control'])
+
+        request = RequestFactory().get('/images/' + self.image_file.photo.name,
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+        response = serve_media(request, self.image_file.photo.name,
+                               document_root=settings.MEDIA_ROOT)
+        self.assertEqual(304, response.status_code)
+
+    def test_get_size_not_allowed(self):
+        response = self.client.get('/r/%s/123x123.jpg' % self.image_file.sha1)
+        self.assertEqual(404, response.status_code)
+
+    def test_get_not_exist(self):
+        response = self.client.get('/r/%s/150x150.jpg' % ('0' * 40))
+        self.assertEqual(404, response.status_code)
+
+    def test_evict(self):
+        for size in ((150, 150), (500, 500), (1000, 1000)):
+            self.client.get('/r/%s/%sx%s.jpg' % ((self.image_file.sha1,) + size))
+        oldest = CachedDerivative.objects.get(width=150)
+        newest = CachedDerivative.objects.get(width=1000)
+        deleted_count, _ = evict_derivatives(newest.file_size)
+
+        self.assertEqual(2, deleted_count)
+        self.assertEqual([newest.id], list(CachedDerivative.objects.values_list('id', flat=True)))
+        self.assertFalse(os.path.exists(oldest.photo.path))
+        self.assertTrue(os.path.exists(newest.photo.path))
+
+
+class BackfillImageFilesTest(TestCase):
+    def test_handle(self):
+        user, _ = User.objects.get_or_create(username='testuser')
+        album = Album.objects.create(title='BackfillImageFilesTest', owner=user)
+        create_album_images(album, 3)
+        Image.objects.filter(album=album).update(md_file=None, sm_file=None)
+        first_image = album.image_set.order_by('id').first()
+        sm_file = first_image.origin_file
+        ImageToFile.objects.filter(image=first_image, shape='sm').delete()
+
+        call_command('backfillimagefiles', batch_size=2, stdout=StringIO())
+
+        for image in album.image_set.all():
+            self.assertEqual(image.origin_file, image.md_file)
+            if image == first_image:
+                self.assertIsNone(image.sm_file)
+            else:
+                self.assertEqual(sm_file, image.sm_file)
+
+
+class CleanMissFilesTest(TestCase):
+    def setUp(self):
+        user, _ = User.objects.get_or_create(username='testuser')
+        self.album = Album.objects.create(title='CleanMissFilesTest', owner=user)
+        create_album_images(self.album, 2)
+        self.missing_images = []
+        for sha1_hash, name in [('ff' + '0' * 38, 'ff/00/%s.jpg' % ('0' * 36)),
+                                ('fe' + '0' * 38, 'legacy/missing.jpg')]:
+            image_file = ImageFile.objects.create(sha1=sha1_hash, photo=name,
+                                                  width=1, height=1, file_size=1)
+            image = Image.objects.create(album=self.album, title=name,
+                                         origin_file=image_file)
+            ImageToFile.objects.create(image=image, file=image_file,
+                                       shape='origin')
+            self.missing_images.append(image)
+
+    def assertCleaned(self):
+        self.assertEqual(2, self.album.image_set.count())
+        self.assertFalse(ImageFile.objects.filter(sha1__in=['ff' + '0' * 38,
+                                                            'fe' + '0' * 38]).exists())
+
+    def test_list_mode(self):
+        out = StringIO()
+        call_command('cleanmissfiles', stdout=out)
+        self.assertCleaned()
+        self.assertIn('2 missing', out.getvalue())
+
+    def test_exists_mode(self):
+        call_command('cleanmissfiles', mode='exists', batch_size=1,
+                     stdout=StringIO())
+        self.assertCleaned()
+
+    def test_dry_run(self):
+        call_command('cleanmissfiles', dry_run=True, stdout=StringIO())
+        self.assertEqual(4, self.album.image_set.count())
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            checkpoint = os.path.join(temp_dir, 'checkpoint.json')
+            with open(checkpoint, 'w') as f:
+                json.dump({'mode': 'list', 'shard': 'fe'}, f)
+            call_command('cleanmissfiles', checkpoint=checkpoint,
+                         stdout=StringIO())
+            self.assertFalse(os.path.exists(checkpoint))
+        # the legacy file in shard fe is skipped
+        self.assertEqual(3, self.album.image_set.count())
+        self.assertTrue(ImageFile.objects.filter(sha1='fe' + '0' * 38).exists())
+
+
+@override_settings(IMS_PACK_MAX_BLOB_SIZE=1024, IMS_PACK_SEGMENT_SIZE=4096)
+class PackedStorageTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.storage = PackedStorage(location=self.media_root.name)
+
+    def tearDown(self):
+        self.media_root.cleanup()
+
+    def save(self, name, size):
+        content = bytes([len(name) % 256]) * size
+        self.assertEqual(name, self.storage.save(name, ContentFile(content)))
+        return content
+
+    def test_save(self):
+        small = self.save('ab/cd/small.jpg', 100)
+        large = self.save('ab/cd/large.jpg', 2000)
+
+        self.assertFalse(os.path.exists(self.storage.path('ab/cd/small.jpg')))
+        self.assertTrue(os.path.exists(self.storage.path('ab/cd/large.jpg')))
+        self.assertEqual([1], self.storage.list_segments())
+        for name, content in [('ab/cd/small.jpg', small),
+                              ('ab/cd/large.jpg', large)]:
+            self.assertTrue(self.storage.exists(name))
+            self.assertEqual(len(content), self.storage.size(name))
+            with self.storage.open(name) as f:
+                self.assertEqual(content, f.read())
+        self.assertEqual(small, bytes(self.storage.read_packed('ab/cd/small.jpg')))
+        self.assertIsNone(self.storage.read_packed('ab/cd/large.jpg'))
+
+        self.assertEqual((['ab'], []), self.storage.listdir(''))
+        self.assertEqual((['cd'], []), self.storage.listdir('ab'))
+        self.assertEqual(['large.jpg', 'small.jpg'],
+                         sorted(self.storage.listdir('ab/cd')[1]))
+        self.assertEqual({'ab/cd/large.jpg', 'ab/cd/small.jpg'},
+                         list_files(self.storage, 'ab'))
+
+        self.storage.delete('ab/cd/small.jpg')
+        self.assertFalse(self.storage.exists('ab/cd/small.jpg'))
+        with self.assertRaises(FileNotFoundError):
+            self.storage.open('ab/cd/small.jpg')
+
+    def test_segments(self):
+        contents = {'ab/cd/%s' % i: self.save('ab/cd/%s' % i, 1000)
+                    for i in range(10)}
+        self.assertEqual([1, 2, 3], self.storage.list_segments())
+
+        for i in range(8):
+            self.storage.delete('ab/cd/%s' % i)
+        out = StringIO()
+        with mock.patch('ims.management.commands.packfiles.DefaultStorage',
+                        return_value=self.storage):
+            call_command('packfiles', compact=True, stdout=out)
+        self.assertEqual('2 segments compacted, 8000 bytes freed.\n',
+                         out.getvalue())
+        self.assertEqual([3], self.storage.list_segments())
+        for name in ['ab/cd/8', 'ab/cd/9']:
+            with self.storage.open(name) as f:
+                self.assertEqual(contents[name], f.read())
+
+    def test_pack_files(self):
+        os.makedirs(self.storage.path('ab/cd'))
+        for name, size in [('ab/cd/small', 100), ('ab/cd/large', 2000)]:
+            with open(self.storage.path(name), 'wb') as f:
+                f.write(b'x' * size)
+        out = StringIO()
+        with mock.patch('ims.management.commands.packfiles.DefaultStorage',
+                        return_value=self.storage):
+            call_command('packfiles', stdout=out)
+        self.assertEqual('1 files packed.\n', out.getvalue())
+        self.assertFalse(os.path.exists(self.storage.path('ab/cd/small')))
+        self.assertEqual(b'x' * 100, self.storage.open('ab/cd/small').read())
+
+    @skipUnless(RUN_BENCHMARKS, 'set IMS_BENCHMARK=1 to run benchmarks')
+    def test_benchmark(self):
+        names = ['%02x/%02x/%036x.jpg' % (i % 256, i // 256 % 256, i)
+                 for i in range(5000)]
+        content = b'x' * 800
+        for storage in [FileSystemStorage(location=self.media_root.name + '/fs'),
+                        PackedStorage(location=self.media_root.name + '/packed',
+                                      max_blob_size=64 * 1024,
+                                      segment_size=256 * 1024 * 1024)]:
+            start = time.perf_counter()
+            for name in names:
+                storage.save(name, ContentFile(content))
+            saved = time.perf_counter() - start
+            start = time.perf_counter()
+            listed = sum(len(list_files(storage, shard)) for shard in SHARDS)
+            elapsed = time.perf_counter() - start
+            inodes = sum(len(dirs) + len(files)
+                         for _, dirs, files in os.walk(storage.location))
+            print('%s: %d files saved in %.2fs, listed in %.2fs, %d inodes'
+                  % (type(storage).__name__, listed, saved, elapsed, inodes))
+
+    def test_serve_media(self):
+        with override_settings(DEFAULT_FILE_STORAGE='ims.packstore.PackedStorage',
+                               MEDIA_ROOT=self.media_root.name,
+                               IMS_PACK_MAX_BLOB_SIZE=4096):
+            with open(os.path.join(BASE_DIR, '..', 'static/img/loading.gif'), 'rb') as f:
+                image_file = get_or_create_image_file(BytesIO(f.read()))
+            self.assertTrue(PackedBlob.objects.filter(
+                name=image_file.photo.name).exists())
+
+            request = RequestFactory().get('/images/' + image_file.photo.name)
+            response = serve_media(request, image_file.photo.name,
+                                   document_root=self.media_root.name)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/gif', response['Content-Type'])
+        self.assertEqual('"%s"' % image_file.sha1, response['ETag'])
+        self.assertEqual(image_file.file_size, len(response.content))
+
+
+class CheckQueryPlansTest(TestCase):
+    def test_check(self):
+        out = StringIO()
+        call_command('checkqueryplans', stdout=out)
+        self.assertIn('album index: ok', out.getvalue())
+        self.assertIn('All query plans use indexes.', out.getvalue())
+
+    def test_full_scan(self):
+        queries = {'image by title': Image.objects.filter(title='x')}
+        plan, scans = check_query_plans(queries)['image by title']
+        self.assertEqual(['ims_image'], scans)
+
+        with mock.patch('ims.queryplans.get_hot_queries', return_value=queries):
+            with self.assertRaises(CommandError):
+                call_command('checkqueryplans', stdout=StringIO())
+
+    def test_unsupported_database(self):
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            with self.assertRaisesMessage(CommandError,
+                                          'Unsupported database postgresql'):
+                call_command('checkqueryplans', stdout=StringIO())
+
+
+class GcImageFilesTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root.name)
+        self.settings_override.enable()
+        user, _ = User.objects.get_or_create(username='testuser')
+        album = Album.objects.create(title='GcImageFilesTest', owner=user)
+        create_album_images(album, 1)
+        self.image_files = []
+        for name in ['wallpaper_tree.jpg', 'loading.gif']:
+            with open(os.path.join(BASE_DIR, '..', 'static/img', name), 'rb') as f:
+                self.image_files.append(get_or_create_image_file(BytesIO(f.read())))
+        ImageFile.objects.filter(id=self.image_files[0].id) \
+            .update(update_at=timezone.now() - timedelta(days=2))
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.media_root.cleanup()
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('gcimagefiles', dry_run=True, stdout=out)
+        self.assertEqual('1 image files to delete, %s bytes to free.\n'
+                         % self.image_files[0].file_size, out.getvalue())
+        self.assertEqual(3, ImageFile.objects.count())
+
+    def test_sweep(self):
+        orphan = self.image_files[0]
+        path = os.path.join(self.media_root.name, orphan.photo.name)
+        self.assertTrue(os.path.exists(path))
+        call_command('gcimagefiles', stdout=StringIO())
+        self.assertFalse(ImageFile.objects.filter(id=orphan.id).exists())
+        self.assertFalse(os.path.exists(path))
+        # bound and recently uploaded files are kept
+        self.assertEqual(2, ImageFile.objects.count())
+
+    def test_grace(self):
+        call_command('gcimagefiles', grace=0, stdout=StringIO())
+        self.assertEqual(1, ImageFile.objects.count())
+
+
+class AsyncImageBankClientTest(TestCase):
+    def test_upload_many(self):
+        paths = [os.path.join(BASE_DIR, '..', 'static/img', name)
+                 for name in ['sample1.jpg', 'loading.gif', 'missing.jpg']]
+        with open(paths[1], 'rb') as f:
+            existing_sha1 = sha1(f.read()).hexdigest()
+        requests_seen = []
+
+        def handler(request):
+            body = request.read()
+            requests_seen.append(body)
+            if len(requests_seen) == 1:
+                return httpx.Response(503)
+            if request.headers['Content-Type'].startswith('multipart'):
+                title = re.search(rb'name="title"\r\n\r\n([^\r]+)', body).group(1)
+                return httpx.Response(200, json={'image': {'title': title.decode()}})
+            data = parse_qs(body.decode())
+            if data['sha1'] == [existing_sha1]:
+                return httpx.Response(200, json={'image': {'sha1': existing_sha1}})
+            return httpx.Response(400, json={'error_code': IMAGE_FILE_NOT_FOUND})
+
+        async def upload():
+            async with AsyncImageBankClient(
+                    'http://testserver', 'token', concurrency=1, backoff=0,
+                    transport=httpx.MockTransport(handler)) as client:
+                return await client.upload_many(paths, album_title='trip')
+
+        results = asyncio.run(upload())
+        self.assertEqual({'title': 'sample1.jpg'}, results[0])
+        self.assertEqual({'sha1': existing_sha1}, results[1])
+        self.assertIsInstance(results[2], FileNotFoundError)
+        # retry, sha1 not found, upload, sha1 found
+        self.assertEqual(4, len(requests_seen))
+        with open(paths[0], 'rb') as f:
+            self.assertIn(f.read(), requests_seen[2])
+        self.assertEqual(['trip'], parse_qs(requests_seen[1].decode())['album'])
+        self.assertIn(b'name="album"\r\n\r\ntrip', requests_seen[2])
+
+
+class TestClientAdapter(requests.adapters.BaseAdapter):
+    """Send the requests of a requests session to a django test client."""
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        path = request.url[len('http://testserver'):]
+        response = self.client.generic(
+            request.method, path, request.body or b'',
+            content_type=request.headers.get('Content-Type', ''))
+        client_response = requests.Response()
+        client_response.status_code = response.status_code
+        client_response._content = response.content
+        client_response.request = request
+        return client_response
+
+    def close(self):
+        pass
+
+
+class ImageBankClientTest(ApiTestBase):
+    def setUp(self):
+        super().setUp()
+        self.album = Album.objects.create(owner=self.user,
+                                          title='ImageBankClientTest')
+
+    def get_client(self, **kwargs):
+        client = ImageBankClient('http://testserver', 'token', **kwargs)
+        adapter = TestClientAdapter(self.client)
+        client._session.mount('http://testserver', adapter)
+        return client, adapter
+
+    def test_upload_images(self):
+        paths = [os.path.join(BASE_DIR, '..', 'static/img', name)
+                 for name in ['sample1.jpg', 'loading.gif']]
+        with open(paths[1], 'rb') as f:
+            existing_sha1 = sha1(f.read()).hexdigest()
+            f.seek(0)
+            existing = get_or_create_image_file(BytesIO(f.read()))
+        # a file of the user's images, the only ones the server discloses
+        other_album = Album.objects.create(title='other', owner=self.album.owner)
+        image = Image.objects.create(album=other_album, title='existing',
+                                     origin_file=existing)
+        ImageToFile.objects.create(image=image, file=existing, shape='origin')
+        client, adapter = self.get_client()
+
+        images = client.upload_images(paths, album_id=self.album.id)
+        self.assertEqual(2, len(images))
+        # the hash lookup, then sample1.jpg uploaded and loading.gif attached
+        self.assertEqual(3, len(adapter.requests))
+        self.assertIn(b'filename="sample1.jpg"', adapter.requests[1].body)
+        self.assertIn('sha1=' + existing_sha1, adapter.requests[2].body)
+        image = Image.objects.get(id=images[1]['id'])
+        self.assertEqual(existing_sha1, image.origin_file.sha1)
+        self.assertEqual('loading.gif', image.title)
+
+    def test_upload_album_title(self):
+        path = os.path.join(BASE_DIR, '..', 'static/img', 'sample1.jpg')
+        client, _ = self.get_client()
+        images = client.upload_images([path], album_title='by title')
+        image = Image.objects.get(id=images[0]['id'])
+        self.assertEqual('by title', image.album.title)
+
+    def test_upload_chunked(self):
+        path = os.path.join(BASE_DIR, '..', 'static/img/wallpaper_tree.jpg')
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                override_settings(IMS_UPLOAD_CHUNK_SIZE=64 * 1024,
+                                  IMS_UPLOAD_SESSION_DIR=temp_dir):
+            client, adapter = self.get_client(chunked_threshold=100 * 1024)
+            image = client.upload_image(path, album_id=self.album.id)
+            self.assertEqual([], os.listdir(temp_dir))
+
+        # hash lookup, session, 3 chunks and commit
+        self.assertEqual(['POST', 'POST', 'PUT', 'PUT', 'PUT', 'POST'],
+                         [request.method for request in adapter.requests])
+        image = Image.objects.get(id=image['id'])
+        self.assertEqual('wallpaper_tree.jpg', image.title)
+        self.assertEqual(self.album, image.album)
+        self.assertIsNotNone(image.sm_file)
+
+
+@override_settings(IMS_UPLOAD_CHUNK_SIZE=64 * 1024)
+class ApiUploadSessionTest(ApiTestBase):
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(
+            IMS_UPLOAD_SESSION_DIR=self.temp_dir.name)
+        self.settings_override.enable()
+        with open(os.path.join(BASE_DIR, '..', 'static/img/wallpaper_tree.jpg'), 'rb') as f:
+            self.content = f.read()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.temp_dir.cleanup()
+
+    def put_chunk(self, upload_id, index):
+        chunk_size = 64 * 1024
+        return self.client.put(
+            f'/api/v1/uploads/{upload_id}/chunks/{index}',
+            self.content[index * chunk_size:(index + 1) * chunk_size],
+            content_type='application/octet-stream')
+
+    def create_upload(self):
+        response = self.client.post('/api/v1/uploads', {
+            'filename': 'tree.jpg', 'size': len(self.content), 'album': 'uploads'})
+        self.assertEqual(200, response.status_code)
+        return response.json()['upload']
+
+    def test_upload(self):
+        upload = self.create_upload()
+        self.assertEqual(0, upload['next_index'])
+        self.assertEqual(400, self.put_chunk(upload['id'], 1).status_code)
+        self.assertEqual(200, self.put_chunk(upload['id'], 0).status_code)
+        # a chunk sent again is ignored
+        response = self.put_chunk(upload['id'], 0)
+        self.assertEqual(64 * 1024, response.json()['upload']['received'])
+        self.assertEqual(1, response.json()['upload']['next_index'])
+
+        response = self.client.post(f'/api/v1/uploads/{upload["id"]}/commit')
+        self.assertEqual(400, response.status_code)
+
+        self.put_chunk(upload['id'], 1)
+        self.put_chunk(upload['id'], 2)
+        response = self.client.get(f'/api/v1/uploads/{upload["id"]}')
+        self.assertEqual(len(self.content), response.json()['upload']['received'])
+        response = self.client.post(f'/api/v1/uploads/{upload["id"]}/commit')
+        self.assertEqual(200, response.status_code)
+
+        image = Image.objects.get(id=response.json()['image_id'])
+        self.assertEqual('tree.jpg', image.title)
+        self.assertEqual('uploads', image.album.title)
+        self.assertEqual(sha1(self.content).hexdigest(), image.origin_file.sha1)
+        self.assertIsNotNone(image.md_file)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual([], os.listdir(self.temp_dir.name))
+
+    def test_commit_in_other_process(self):
+        upload = self.create_upload()
+        for index in range(3):
+            self.put_chunk(upload['id'], index)
+        uploads._hashes.clear()
+        response = self.client.post(f'/api/v1/uploads/{upload["id"]}/commit')
+        image = Image.objects.get(id=response.json()['image_id'])
+        self.assertEqual(sha1(self.content).hexdigest(), image.origin_file.sha1)
+
+    def test_other_user(self):
+        upload = self.create_upload()
+        other_user, _ = User.objects.get_or_create(username='otheruser')
+        self.client.force_authenticate(other_user)
+        self.assertEqual(404, self.put_chunk(upload['id'], 0).status_code)
+
+    def test_clean_stale(self):
+        upload = self.create_upload()
+        UploadSession.objects.update(update_at=timezone.now() - timedelta(days=2))
+        call_command('cleanuploadsessions', stdout=StringIO())
+        self.assertFalse(UploadSession.objects.filter(id=upload['id']).exists())
+        self.assertEqual([], os.listdir(self.temp_dir.name))
+
+
 class HomeViewTest(TestCase):
     def setUp(self):
         user, _ = User.objects.get_or_create(username='testuser')
@@ -430,6 +1358,27 @@ class AlbumViewTest(WebViewTestBase):
         response = self.client.get('/album/%s' % album.id)
         self.assertEqual(200, response.status_code)
 
+    def test_get_cached(self):
+        album = Album.objects.create(title='test_get_cached', owner=self.user)
+        create_album_images(album, 3)
+        response = self.client.get('/album/%s' % album.id)
+        self.assertContains(response, 'image_2')
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/album/%s' % album.id)
+        self.assertContains(response, 'image_2')
+        self.assertFalse([q for q in context.captured_queries
+                          if 'ims_image' in q['sql']])
+
+        image = album.image_set.get(title='image_2')
+        image.title = 'renamed'
+        image.save()
+        response = self.client.get('/album/%s' % album.id)
+        self.assertContains(response, 'renamed')
+
+        response = self.client.get('/albums')
+        self.assertContains(response, 'test_get_cached')
+
 
 class APIAlbumsTest(ApiTestBase):
     def setUp(self) -> None:
@@ -453,6 +1402,30 @@ class APIAlbumsTest(ApiTestBase):
                 seen_ids.add(album['id'])
 
 
+    def test_get_cursor(self):
+        seen_ids = set()
+        cursor = None
+        pages = 0
+        while True:
+            url = '/api/v1/albums?page_size=100'
+            if cursor:
+                url += '&cursor=' + cursor
+            response_data = self.client.get(url).json()
+            for album in response_data['albums']:
+                self.assertNotIn(album['id'], seen_ids)
+                seen_ids.add(album['id'])
+            pages += 1
+            cursor = response_data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(1000, len(seen_ids))
+        self.assertEqual(11, pages)
+
+    def test_get_invalid_cursor(self):
+        response = self.client.get('/api/v1/albums?cursor=xx')
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(10005, response.json()['error_code'])
+
     def test_post(self):
         response = self.client.post('/api/v1/albums', {'title': 'ApiAlbumInfoTest'})
         self.assertEqual(200, response.status_code)
@@ -537,6 +1510,226 @@ class ApiAlbumInfoTest(ApiTestBase):
         response = self.client.get('/api/v1/album/%s' % album_id)
         self.assertEqual(404, response.status_code)
 
+    def test_get_conditional(self):
+        album = Album.objects.create(title='test_get_conditional', owner=self.user)
+        create_album_images(album, 2)
+        response = self.client.get('/api/v1/album/%s' % album.id)
+        etag = response['ETag']
+        self.assertEqual('private, no-cache', response['Cache-Control'])
+        response = self.client.get('/api/v1/album/%s' % album.id,
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+
+        image = album.image_set.first()
+        response = self.client.get('/api/v1/image/%s' % image.id)
+        self.assertEqual(200, response.status_code)
+        image_etag = response['ETag']
+        response = self.client.get('/api/v1/image/%s' % image.id,
+                                   HTTP_IF_NONE_MATCH=image_etag)
+        self.assertEqual(304, response.status_code)
+
+        with open(os.path.join(BASE_DIR, '..', 'static/img/loading.gif'), 'rb') as f, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/v1/image/upload', {'file': f, 'album_id': album.id})
+        response = self.client.get('/api/v1/album/%s' % album.id,
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, len(response.json()['album']['images']))
+        response = self.client.get('/api/v1/image/%s' % image.id,
+                                   HTTP_IF_NONE_MATCH=image_etag)
+        self.assertEqual(200, response.status_code)
+
+        etag = response['ETag']
+        album.tags.add(Tag.objects.create(text='tag'))
+        response = self.client.get('/api/v1/image/%s' % image.id,
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+
+    def test_get_cached(self):
+        album = Album.objects.create(title='test_get_cached', owner=self.user)
+        create_album_images(album, 2)
+        content = self.client.get('/api/v1/album/%s' % album.id).content
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/v1/album/%s' % album.id)
+        self.assertEqual(content, response.content)
+        self.assertFalse([q for q in context.captured_queries
+                          if 'ims_' in q['sql']])
+
+        with open(os.path.join(BASE_DIR, '..', 'static/img/loading.gif'), 'rb') as f, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/v1/image/upload', {'file': f, 'album_id': album.id})
+        response = self.client.get('/api/v1/album/%s' % album.id)
+        self.assertEqual(3, len(response.json()['album']['images']))
+
+        other_user, _ = User.objects.get_or_create(username='otheruser')
+        self.client.force_authenticate(other_user)
+        response = self.client.get('/api/v1/album/%s' % album.id)
+        self.assertEqual(404, response.status_code)
+
+    def run_callbacks(self, callbacks):
+        """Run on_commit callbacks as a commit would, with the ones they add"""
+        while callbacks:
+            with self.captureOnCommitCallbacks() as added:
+                for callback in callbacks:
+                    callback()
+            callbacks = added
+
+    def test_get_cached_deleted(self):
+        category = Category.objects.create(owner=self.user, title='category')
+        album = Album.objects.create(title='test_get_cached_deleted',
+                                     owner=self.user, category=category)
+        create_album_images(album, 3)
+
+        def get_album():
+            return self.client.get('/api/v1/album/%s' % album.id).json()['album']
+
+        get_album()
+        with self.captureOnCommitCallbacks() as callbacks:
+            album.image_set.first().delete()
+        # the cached version is kept until the delete commits
+        self.assertEqual(3, len(get_album()['images']))
+        with CaptureQueriesContext(connection) as context:
+            self.run_callbacks(callbacks)
+        # the album of the image and its files touched once
+        self.assertEqual(2, len(context.captured_queries))
+        self.assertEqual(2, len(get_album()['images']))
+
+        image = album.image_set.first()
+        with self.captureOnCommitCallbacks() as callbacks:
+            ImageToFile.objects.filter(image=image, shape='md').delete()
+        self.run_callbacks(callbacks)
+        files = {image_data['id']: image_data['files']
+                 for image_data in get_album()['images']}
+        self.assertEqual({'origin', 'sm'}, set(files[image.id]))
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            category.title = 'renamed'
+            category.save()
+        self.run_callbacks(callbacks)
+        self.assertEqual('renamed', get_album()['category'])
+        with self.captureOnCommitCallbacks() as callbacks:
+            category.delete()
+        self.run_callbacks(callbacks)
+        self.assertIsNone(get_album()['category'])
+
+    def test_get_signed(self):
+        album = Album.objects.create(title='test_get_signed', owner=self.user)
+        create_album_images(album, 3)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/v1/album/%s?signed=1' % album.id)
+        self.assertEqual(200, response.status_code)
+        # the album and its images, whatever their count
+        self.assertEqual(2, len([q for q in context.captured_queries
+                                 if 'ims_image' in q['sql']]))
+        images = response.json()['album']['images']
+        self.assertEqual(3, len(images))
+        url = images[0]['origin']['url']
+        self.assertIn('/s/%s/' % signing.get_expires(), url)
+        self.assertEqual(url, images[0]['files']['origin']['url'])
+        self.assertIn('-s%s"' % signing.get_expires(), response['ETag'])
+
+        response = self.client.get('/api/v1/album/%s' % album.id)
+        self.assertNotIn('/s/', response.json()['album']['images'][0]['origin']['url'])
+
+        anonymous = APIClient()
+        response = anonymous.get(urlparse(url).path)
+        self.assertEqual(200, response.status_code)
+
+    def test_cache_stats(self):
+        album = Album.objects.create(title='test_cache_stats', owner=self.user)
+        self.client.get('/api/v1/album/%s' % album.id)
+        self.client.get('/api/v1/album/%s' % album.id)
+        response = self.client.get('/api/v1/cache/stats')
+        self.assertEqual(403, response.status_code)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get('/api/v1/cache/stats')
+        self.assertEqual({'hits': 1, 'misses': 1, 'hit_rate': 0.5},
+                         response.json()['cache'])
+
+    def _count_get_queries(self, album):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/v1/album/%s' % album.id)
+        self.assertEqual(200, response.status_code)
+        return len(context.captured_queries), response.json()['album']
+
+    def test_get_query_count(self):
+        small_album = Album.objects.create(title='small', owner=self.user)
+        create_album_images(small_album, 2)
+        large_album = Album.objects.create(title='large', owner=self.user)
+        create_album_images(large_album, 50)
+
+        small_queries, small_info = self._count_get_queries(small_album)
+        large_queries, large_info = self._count_get_queries(large_album)
+        self.assertEqual(small_queries, large_queries)
+        self.assertEqual(50, len(large_info['images']))
+        image_info = large_info['images'][0]
+        self.assertEqual({'origin', 'md', 'sm'}, set(image_info['files']))
+        self.assertTrue(image_info['md']['url'].startswith('http://testserver/files/'))
+
+    @skipUnless(RUN_BENCHMARKS, 'set IMS_BENCHMARK=1 to run benchmarks')
+    def test_get_benchmark(self):
+        for count in (10, 1000, 10000):
+            album = Album.objects.create(title='bench_%s' % count, owner=self.user)
+            create_album_images(album, count)
+            start = time.perf_counter()
+            queries, album_info = self._count_get_queries(album)
+            elapsed = time.perf_counter() - start
+            self.assertEqual(count, len(album_info['images']))
+            print('ApiAlbumInfo %5d images: %d queries, %.3fs' % (count, queries, elapsed))
+
+
+class ApiAlbumImagesTest(ApiTestBase):
+    def setUp(self) -> None:
+        super(ApiAlbumImagesTest, self).setUp()
+        self.album = Album.objects.create(title='ApiAlbumImagesTest', owner=self.user)
+        create_album_images(self.album, 25)
+
+    def test_get_pages(self):
+        url = '/api/v1/album/%s/images?page_size=10' % self.album.id
+        seen_ids = []
+        cursor = None
+        while True:
+            response = self.client.get(url + ('&cursor=' + cursor if cursor else ''))
+            self.assertEqual(200, response.status_code)
+            response_data = response.json()
+            seen_ids.extend(image['id'] for image in response_data['images'])
+            cursor = response_data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(list(self.album.image_set.order_by('id').values_list('id', flat=True)),
+                         seen_ids)
+
+    def test_get_page_size(self):
+        url = '/api/v1/album/%s/images?page_size=' % self.album.id
+        self.assertEqual(1, len(self.client.get(url + '0').json()['images']))
+        self.assertEqual(25, len(self.client.get(url + '5000').json()['images']))
+        response = self.client.get(url + 'x')
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(10005, response.json()['error_code'])
+
+    def test_get_shapes(self):
+        response = self.client.get('/api/v1/album/%s/images?shapes=sm' % self.album.id)
+        image_info = response.json()['images'][0]
+        self.assertEqual({'sm'}, set(image_info['files']))
+        self.assertIn('url', image_info['files']['sm'])
+
+    def test_get_ndjson(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/v1/album/%s/images' % self.album.id,
+                                       HTTP_ACCEPT='application/x-ndjson')
+            self.assertEqual('application/x-ndjson', response['Content-Type'])
+            lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(25, len(lines))
+        self.assertEqual({'origin', 'md', 'sm'}, set(json.loads(lines[0])['files']))
+        self.assertLess(len(context.captured_queries), 10)
+
+    def test_get_not_exist(self):
+        response = self.client.get('/api/v1/album/9999/images')
+        self.assertEqual(404, response.status_code)
+
 
 class ImageViewTest(WebViewTestBase):
     def test_get(self):
@@ -556,6 +1749,597 @@ class ImageViewTest(WebViewTestBase):
         response = self.client.get('/image/%s' % new_image_id)
         self.assertEqual(404, response.status_code)
 
+    def test_get_conditional(self):
+        album = Album.objects.create(title='ImageViewTest', owner=self.user)
+        create_album_images(album, 1)
+        image = album.image_set.get()
+        response = self.client.get('/image/%s' % image.id)
+        self.assertIn('no-cache', response['Cache-Control'])
+        response = self.client.get('/image/%s' % image.id,
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+
+
+class AlbumIndexViewTest(WebViewTestBase):
+    def _count_get_queries(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/albums')
+        self.assertEqual(200, response.status_code)
+        return len(context.captured_queries), response
+
+    def test_get_query_count(self):
+        for i in range(2):
+            create_album_images(Album.objects.create(title='album_%s' % i,
+                                                     owner=self.user), 3)
+        small_queries, _ = self._count_get_queries()
+        for i in range(2, 8):
+            create_album_images(Album.objects.create(title='album_%s' % i,
+                                                     owner=self.user), 3)
+        Album.objects.create(title='empty', owner=self.user)
+        large_queries, response = self._count_get_queries()
+
+        self.assertEqual(small_queries, large_queries)
+        image_file = Image.objects.filter(album__owner=self.user).first().md_file
+        self.assertContains(response, image_file.photo.url, count=8)
+        self.assertContains(response, 'ims/images/empty.png', count=1)
+
+    @skipUnless(RUN_BENCHMARKS, 'set IMS_BENCHMARK=1 to run benchmarks')
+    def test_get_benchmark(self):
+        for i in range(24):
+            create_album_images(Album.objects.create(title='bench_%s' % i,
+                                                     owner=self.user), 5000)
+        albums = Album.objects.filter(owner=self.user).order_by('-create_at', '-id')
+
+        # the cover as album_index.html used to read it
+        start = time.perf_counter()
+        with CaptureQueriesContext(connection) as context:
+            covers = []
+            for album in albums:
+                if album.image_set.all():
+                    covers.append(album.image_set.all()[0].md_file.photo.url)
+        elapsed = time.perf_counter() - start
+        print('AlbumIndex cover before: %d queries, %.3fs'
+              % (len(context.captured_queries), elapsed))
+
+        start = time.perf_counter()
+        with CaptureQueriesContext(connection) as context:
+            covers = [album.cover_photo for album in with_cover_photo(albums)]
+        elapsed = time.perf_counter() - start
+        print('AlbumIndex cover after: %d queries, %.3fs'
+              % (len(context.captured_queries), elapsed))
+        self.assertEqual(24, len(covers))
+
+        start = time.perf_counter()
+        queries, _ = self._count_get_queries()
+        elapsed = time.perf_counter() - start
+        print('AlbumIndex page: %d queries, %.3fs' % (queries, elapsed))
+
+
+class AlbumSearchTest(TestCase):
+    def setUp(self):
+        self.user, _ = User.objects.get_or_create(username='testuser')
+
+    def search(self, q, user=None):
+        return [album.title for album in search_albums(user or self.user, q)]
+
+    def test_get_tokens(self):
+        self.assertEqual({'abc', 'bc ', 'c d', ' d', 'd'}, get_tokens(' ABc   d'))
+        self.assertEqual({'abc', 'def', 'efg'}, get_query_tokens('abcdefg'))
+        self.assertEqual({'abc'}, get_query_tokens('abc'))
+
+    def test_search(self):
+        Album.objects.create(owner=self.user, title='Summer Holiday')
+        Album.objects.create(owner=self.user, title='Holidays at home')
+        Album.objects.create(owner=self.user, title='Winter')
+        other, _ = User.objects.get_or_create(username='other')
+        Album.objects.create(owner=other, title='Holiday')
+
+        self.assertEqual(['Holidays at home', 'Summer Holiday'],
+                         self.search('holiday'))
+        self.assertEqual(['Summer Holiday'], self.search('er hol'))
+        self.assertEqual(['Winter'], self.search('wi'))
+        self.assertEqual(['Summer Holiday', 'Winter'], sorted(self.search('r')))
+        self.assertEqual([], self.search('holly'))
+        self.assertEqual([], self.search(''))
+        self.assertEqual(['Holiday'], self.search('holiday', other))
+
+    def test_search_common_prefix(self):
+        Album.objects.create(owner=self.user, title='Summer')
+        Album.objects.create(owner=self.user, title='Winter')
+        Album.objects.create(owner=self.user, title='Spring')
+        self.assertEqual(['Winter', 'Summer'], self.search('er'))
+        # read from the recent albums, not the token index
+        with mock.patch('ims.search.RARE_PREFIX_LIMIT', 1):
+            self.assertEqual(['Winter', 'Summer'], self.search('er'))
+
+    def test_rank(self):
+        category = Category.objects.create(owner=self.user, title='travel')
+        by_tag = Album.objects.create(owner=self.user, title='a')
+        by_tag.tags.add(Tag.objects.create(text='travel'))
+        Album.objects.create(owner=self.user, title='b', category=category)
+        Album.objects.create(owner=self.user, title='travel')
+        self.assertEqual(['travel', 'b', 'a'], self.search('travel'))
+
+    def test_search_exact(self):
+        Album.objects.create(owner=self.user, title='abcxxdef')
+        Album.objects.create(owner=self.user, title='abc trip') \
+            .tags.add(Tag.objects.create(text='def'))
+        Album.objects.create(owner=self.user, title='x ABC  def')
+        self.assertEqual(['x ABC  def'], self.search('abc def'))
+        self.assertEqual([], self.search('abcdef'))
+        Album.objects.create(owner=self.user, title='xabcdefy')
+        self.assertEqual(['xabcdefy'], self.search('abcdef'))
+
+    def test_sync(self):
+        category = Category.objects.create(owner=self.user, title='cats')
+        tag = Tag.objects.create(text='dogs')
+        album = Album.objects.create(owner=self.user, title='pets',
+                                     category=category)
+        album.tags.add(tag)
+        self.assertEqual(['pets'], self.search('cats'))
+        self.assertEqual(['pets'], self.search('dogs'))
+
+        album.title = 'animals'
+        album.save()
+        self.assertEqual([], self.search('pets'))
+        self.assertEqual(['animals'], self.search('animal'))
+
+        category.title = 'kittens'
+        category.save()
+        self.assertEqual([], self.search('cats'))
+        self.assertEqual(['animals'], self.search('kitten'))
+        category.delete()
+        self.assertEqual([], self.search('kitten'))
+
+        tag.album_set.clear()
+        self.assertEqual([], self.search('dogs'))
+        tag.album_set.add(album)
+        self.assertEqual(['animals'], self.search('dogs'))
+        tag.delete()
+        self.assertEqual([], self.search('dogs'))
+
+    def test_rebuild(self):
+        Album.objects.create(owner=self.user, title='abc')
+        AlbumSearchToken.objects.all().delete()
+        Album.objects.update(search_text='')
+        out = StringIO()
+        call_command('rebuildsearchindex', stdout=out)
+        self.assertEqual('1 albums indexed.\n', out.getvalue())
+        self.assertEqual(['abc'], self.search('abc'))
+
+    @skipUnless(RUN_BENCHMARKS, 'set IMS_BENCHMARK=1 to run benchmarks')
+    def test_typeahead_benchmark(self):
+        words = ['summer', 'winter', 'holiday', 'family', 'travel', 'party',
+                 'beach', 'mountain', 'city', 'garden', 'birthday', 'school']
+        Album.objects.bulk_create(
+            [Album(owner=self.user, title='%s %s %s' % (
+                words[i % 12], words[i // 12 % 12], i))
+             for i in range(100000)], batch_size=1000)
+        rebuild_index()
+
+        for q in ['s', 'zq', 'hol', 'holiday', 'mountain beach', '4242']:
+            start = time.perf_counter()
+            for _ in range(10):
+                list(search_albums(self.user, q)
+                     .values_list('id', 'title')[:20])
+            elapsed = (time.perf_counter() - start) / 10
+            start = time.perf_counter()
+            for _ in range(10):
+                list(Album.objects.filter(owner=self.user, title__contains=q)
+                     .values_list('id', 'title')[:20])
+            contains_elapsed = (time.perf_counter() - start) / 10
+            print('typeahead %r: %.1fms, title__contains %.1fms'
+                  % (q, elapsed * 1000, contains_elapsed * 1000))
+
+
+class NearDuplicateTest(ApiTestBase):
+    @staticmethod
+    def upload_copy(album, size=None, quality=75, flip=False, margin=0):
+        """Upload sample1.jpg into the album, edited or encoded again"""
+        image = PImage.open(os.path.join(BASE_DIR, '..', 'static/img/sample1.jpg'))
+        if margin:
+            image = image.crop((margin, margin, image.width - margin,
+                                image.height - margin))
+        if size:
+            image = image.resize(size)
+        if flip:
+            image = image.transpose(PImage.FLIP_LEFT_RIGHT)
+        buffer = BytesIO()
+        image.save(buffer, format='JPEG', quality=quality)
+        image_file = get_or_create_image_file(buffer)
+        return Image.objects.create(album=album, title='copy',
+                                    origin_file=image_file)
+
+    def test_dhash(self):
+        album = Album.objects.create(title='test_dhash', owner=self.user)
+        origin = self.upload_copy(album).origin_file
+        resized = self.upload_copy(album, (320, 200), quality=50).origin_file
+        cropped = self.upload_copy(album, margin=10).origin_file
+        flipped = self.upload_copy(album, flip=True).origin_file
+        self.assertNotEqual(origin.sha1, resized.sha1)
+
+        def distance(a, b):
+            return bin((a.phash ^ b.phash) & (1 << 64) - 1).count('1')
+        self.assertLessEqual(distance(origin, resized), 4)
+        self.assertIn(distance(origin, cropped), range(1, 5))
+        self.assertGreater(distance(origin, flipped), 8)
+        # derivatives aren't hashed
+        thumbnail = generate_thumbnail_files(
+            PImage.open(origin.photo.open()), [SM_SIZE])[0]
+        self.assertIsNone(thumbnail.phash)
+
+    def test_cluster_hashes(self):
+        rng = np.random.default_rng(42)
+        hashes = rng.integers(-2 ** 63, 2 ** 63, 2000, dtype=np.int64)
+        # near copies of the first 50 hashes, of the highest bits too
+        for i in range(50):
+            bits = rng.choice(64, size=i % 5, replace=False)
+            near = int(hashes[i]) & (1 << 64) - 1
+            for bit in bits:
+                near ^= 1 << int(bit)
+            hashes[-1 - i] = near - (1 << 64) if near >> 63 else near
+        hashes[60] = hashes[61]
+
+        values = hashes.view(np.uint64)
+        distances = duplicates.popcount(values[:, None] ^ values[None, :])
+        expected = {frozenset(np.flatnonzero(row <= 4).tolist())
+                    for row in distances if (row <= 4).sum() > 1}
+        clusters = duplicates.cluster_hashes(hashes.tolist(), 4)
+        self.assertEqual(expected, {frozenset(cluster) for cluster in clusters})
+        self.assertEqual(1, len(duplicates.cluster_hashes(
+            hashes[[60, 61]].tolist(), 0)))
+        self.assertEqual([], duplicates.cluster_hashes([], 4))
+        with self.assertRaises(ValueError):
+            duplicates.cluster_hashes([0, 1], duplicates.MAX_DISTANCE + 1)
+
+    def test_get(self):
+        album = Album.objects.create(title='test_get', owner=self.user)
+        other_album = Album.objects.create(title='other', owner=self.user)
+        origin = self.upload_copy(album)
+        resized = self.upload_copy(other_album, (320, 200))
+        same = self.upload_copy(other_album)
+        cropped = self.upload_copy(album, margin=10)
+        self.upload_copy(album, flip=True)
+        other_user, _ = User.objects.get_or_create(username='otheruser')
+        self.upload_copy(Album.objects.create(title='other', owner=other_user))
+
+        response = self.client.get('/api/v1/duplicates')
+        self.assertEqual(200, response.status_code)
+        clusters = response.json()['clusters']
+        self.assertEqual(1, len(clusters))
+        self.assertEqual([origin.id, resized.id, same.id, cropped.id],
+                         sorted(image['id'] for image in clusters[0]['images']))
+        urls = {image['id']: image['origin']['url']
+                for image in clusters[0]['images']}
+        self.assertIn(resized.origin_file.photo.url, urls[resized.id])
+
+        response = self.client.get('/api/v1/duplicates?distance=0')
+        self.assertEqual([origin.id, resized.id, same.id], sorted(
+            image['id'] for image in response.json()['clusters'][0]['images']))
+        self.assertEqual(400, self.client.get('/api/v1/duplicates?distance=64')
+                         .status_code)
+
+    def test_command(self):
+        album = Album.objects.create(title='test_command', owner=self.user)
+        origin = self.upload_copy(album)
+        resized = self.upload_copy(album, (320, 200))
+        ImageFile.objects.update(phash=None)
+
+        out = StringIO()
+        call_command('findduplicates', owner='testuser', stdout=out)
+        self.assertIn('testuser: 0 clusters', out.getvalue())
+
+        out = StringIO()
+        call_command('findduplicates', owner='testuser', hash=True, stdout=out)
+        self.assertIn('2 files hashed.', out.getvalue())
+        self.assertIn('%s %s' % (origin.id, resized.id), out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('findduplicates', distance=9, stdout=StringIO())
+
+    @skipUnless(RUN_BENCHMARKS, 'set IMS_BENCHMARK=1 to run benchmarks')
+    def test_cluster_benchmark(self):
+        rng = np.random.default_rng(0)
+        for count in (10000, 100000, 1000000):
+            hashes = rng.integers(-2 ** 63, 2 ** 63, count, dtype=np.int64)
+            start = time.perf_counter()
+            duplicates.cluster_hashes(hashes)
+            print('cluster %s hashes: %.2fs'
+                  % (count, time.perf_counter() - start))
+
+
+class GraphQLTest(WebViewTestBase):
+    ALBUMS_QUERY = """{
+      allAlbums(first: 24) { edges { node {
+        title
+        imageSet(first: 100) { edges { node {
+          title
+          files(first: 3) { edges { node { url width } } }
+        } } }
+      } } }
+    }"""
+    ALBUM_QUERY = """query ($id: ID!) {
+      album(id: $id) {
+        title
+        imageSet { edges { node { files { edges { node { url } } } } } }
+      }
+    }"""
+    CATEGORIES_QUERY = """{
+      allCategories { edges { node { title } } }
+    }"""
+
+    def query(self, query, variables=None):
+        response = self.client.post('/graphql', json.dumps({
+            'query': query, 'variables': variables or {}}),
+            content_type='application/json')
+        return json.loads(response.content)
+
+    def create_albums(self, count, images=2):
+        for _ in range(count):
+            album = Album.objects.create(
+                title='album_%s' % Album.objects.count(), owner=self.user)
+            create_album_images(album, images)
+
+    def count_queries(self, query, variables=None):
+        with CaptureQueriesContext(connection) as context:
+            result = self.query(query, variables)
+        self.assertNotIn('errors', result)
+        return len(context.captured_queries), result
+
+    def test_query_counts(self):
+        Category.objects.create(owner=self.user, title='category')
+        self.create_albums(2)
+        album_id = to_global_id('AlbumNode', Album.objects.first().id)
+        counts = {name: self.count_queries(query, {'id': album_id})[0]
+                  for name, query in [('albums', self.ALBUMS_QUERY),
+                                      ('album', self.ALBUM_QUERY),
+                                      ('categories', self.CATEGORIES_QUERY)]}
+
+        self.create_albums(4, images=5)
+        queries, result = self.count_queries(self.ALBUMS_QUERY)
+        self.assertEqual(counts['albums'], queries)
+        albums = result['data']['allAlbums']['edges']
+        self.assertEqual(6, len(albums))
+        images = albums[-1]['node']['imageSet']['edges']
+        self.assertEqual(5, len(images))
+        self.assertEqual(3, len(images[0]['node']['files']['edges']))
+
+        self.assertEqual(counts['album'],
+                         self.count_queries(self.ALBUM_QUERY,
+                                            {'id': album_id})[0])
+        # session, user, count and page of the albums, last image ids,
+        # images, files
+        self.assertEqual(7, counts['albums'])
+
+    def test_image_page(self):
+        self.create_albums(3, images=4)
+        query = """query ($first: Int, $after: String, $last: Int) {
+          allAlbums { edges { node {
+            imageSet(first: $first, after: $after, last: $last) {
+              edges { node { title } }
+              pageInfo { hasNextPage endCursor }
+            }
+          } } }
+        }"""
+        with CaptureQueriesContext(connection) as context:
+            result = self.query(query, {'first': 2})
+        albums = result['data']['allAlbums']['edges']
+        self.assertEqual(3, len(albums))
+        image_set = albums[0]['node']['imageSet']
+        self.assertEqual(2, len(image_set['edges']))
+        self.assertTrue(image_set['pageInfo']['hasNextPage'])
+        # the page and the next image of each album are loaded only
+        images_query, = [q['sql'] for q in context.captured_queries
+                         if q['sql'].startswith('SELECT "ims_image"')]
+        with connection.cursor() as cursor:
+            cursor.execute(images_query)
+            self.assertEqual(3 * 3, len(cursor.fetchall()))
+
+        result = self.query(query, {'first': 2, 'after': image_set[
+            'pageInfo']['endCursor']})
+        image_set = result['data']['allAlbums']['edges'][0]['node']['imageSet']
+        self.assertEqual(2, len(image_set['edges']))
+        self.assertFalse(image_set['pageInfo']['hasNextPage'])
+
+        result = self.query(query, {'last': 1})
+        image_set = result['data']['allAlbums']['edges'][0]['node']['imageSet']
+        self.assertEqual(['image_3'],
+                         [edge['node']['title'] for edge in image_set['edges']])
+
+    def test_depth_limit(self):
+        with self.settings(IMS_GRAPHQL_MAX_DEPTH=6):
+            result = self.query(self.ALBUMS_QUERY)
+        self.assertNotIn('data', result)
+        self.assertEqual('Query depth 10 exceeds the maximum depth 6.',
+                         result['errors'][0]['message'])
+
+    def test_cost_limit(self):
+        self.create_albums(1)
+        # 100 albums of 100 images of 100 files by default
+        query = self.ALBUMS_QUERY.replace('(first: 24)', '') \
+            .replace('(first: 3)', '')
+        with CaptureQueriesContext(connection) as context:
+            result = self.query(query)
+        self.assertNotIn('data', result)
+        self.assertIn('Query cost 1010100 exceeds the maximum cost',
+                      result['errors'][0]['message'])
+        self.assertFalse([q for q in context.captured_queries
+                          if 'ims_' in q['sql']])
+
+        fragment_query = """{
+          allAlbums(first: 10) { edges { node { ...images } } }
+        }
+        fragment images on AlbumNode {
+          imageSet(first: 10) { edges { node { files(first: 3) {
+            edges { node { url } } } } } }
+        }"""
+        self.assertNotIn('errors', self.query(fragment_query))
+        with self.settings(IMS_GRAPHQL_MAX_COST=300):
+            result = self.query(fragment_query)
+        self.assertEqual('Query cost 410 exceeds the maximum cost 300, '
+                         'request smaller pages with `first`.',
+                         result['errors'][0]['message'])
+
+    @skipUnless(RUN_BENCHMARKS, 'set IMS_BENCHMARK=1 to run benchmarks')
+    def test_benchmark(self):
+        self.create_albums(24, images=100)
+        for name, query in [('albums', self.ALBUMS_QUERY),
+                            ('categories', self.CATEGORIES_QUERY)]:
+            start = time.perf_counter()
+            queries, _ = self.count_queries(query)
+            print('graphql %s: %d queries, %.3fs'
+                  % (name, queries, time.perf_counter() - start))
+
+
+class FileViewTest(WebViewTestBase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.album = Album.objects.create(title='FileViewTest', owner=self.user)
+        create_album_images(self.album, 1)
+        self.image_file = Image.objects.get(album=self.album).origin_file
+        self.url = '/files/' + self.image_file.photo.name
+
+    def test_get_owner(self):
+        response = self.client.get(self.url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/jpeg', response['Content-Type'])
+        self.assertEqual(self.image_file.file_size,
+                         len(b''.join(response.streaming_content)))
+        self.assertIn('private', response['Cache-Control'])
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+
+    def test_get_not_allowed(self):
+        other, _ = User.objects.get_or_create(username='other')
+        self.client.force_login(other)
+        self.assertEqual(404, self.client.get(self.url).status_code)
+        self.client.logout()
+        self.assertEqual(404, self.client.get(self.url).status_code)
+        self.assertEqual(404, self.client.get('/files/../settings.py').status_code)
+
+    def test_get_public(self):
+        self.album.is_public = True
+        self.album.save()
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertEqual(200, response.status_code)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('public', response['Cache-Control'])
+
+    def test_get_accel_redirect(self):
+        with self.settings(IMS_X_ACCEL_REDIRECT_PREFIX='/protected/'):
+            response = self.client.get(self.url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('/protected/' + self.image_file.photo.name,
+                         response['X-Accel-Redirect'])
+        self.assertEqual(b'', response.content)
+
+        with self.settings(IMS_X_SENDFILE=True):
+            response = self.client.get(self.url)
+        self.assertEqual(default_storage.path(self.image_file.photo.name),
+                         response['X-Sendfile'])
+
+    def test_get_signed_redirect(self):
+        # an S3 storage whose own urls are unsigned
+        storage = mock.MagicMock(cloudfront_signer=None)
+        storage.bucket.name = 'bucket'
+        storage._normalize_name.side_effect = lambda name: 'media/' + name
+        presign = storage.bucket.meta.client.generate_presigned_url
+        presign.return_value = 'https://bucket.s3/signed'
+        with mock.patch('ims.views.default_storage', storage):
+            response = self.client.get(self.url)
+        self.assertEqual(302, response.status_code)
+        self.assertEqual('https://bucket.s3/signed', response['Location'])
+        presign.assert_called_once_with(
+            'get_object', ExpiresIn=300,
+            Params={'Bucket': 'bucket',
+                    'Key': 'media/' + self.image_file.photo.name})
+        storage.url.assert_not_called()
+        self.assertIn('private', response['Cache-Control'])
+
+        storage.cloudfront_signer = mock.Mock()
+        storage.url.return_value = 'https://cdn/signed'
+        with mock.patch('ims.views.default_storage', storage):
+            response = self.client.get(self.url)
+        self.assertEqual('https://cdn/signed', response['Location'])
+        storage.url.assert_called_once_with(self.image_file.photo.name,
+                                            expire=300)
+
+    def test_urls_through_files(self):
+        # the urls of other storages, e.g. unsigned urls of a private bucket
+        storage_url = mock.patch.object(
+            FileSystemStorage, 'url', autospec=True,
+            side_effect=lambda storage, name: 'https://bucket.s3/' + name)
+        image = Image.objects.get(album=self.album)
+        api_client = APIClient()
+        api_client.force_authenticate(self.user)
+        with storage_url:
+            pages = [self.client.get('/album/%s' % self.album.id),
+                     self.client.get('/image/%s' % image.id),
+                     api_client.get('/api/v1/album/%s' % self.album.id)]
+        for response in pages:
+            self.assertEqual(200, response.status_code)
+            self.assertContains(response, self.url)
+            self.assertNotContains(response, 'https://bucket.s3/'
+                                   + self.image_file.photo.name)
+
+
+class SignedFileViewTest(TestCase):
+    def setUp(self) -> None:
+        user, _ = User.objects.get_or_create(username='testuser')
+        album = Album.objects.create(title='SignedFileViewTest', owner=user)
+        create_album_images(album, 1)
+        self.name = Image.objects.get(album=album).origin_file.photo.name
+
+    def test_sign(self):
+        now = 1700000000
+        expires = signing.get_expires(now)
+        self.assertEqual(0, expires % 3600)
+        self.assertGreaterEqual(expires - now, 7 * 24 * 3600)
+        self.assertEqual(expires, signing.get_expires(now + 1))
+
+        path = signing.sign_name(self.name, expires)
+        _, prefix, signed_expires, signature, name = path.split('/', 4)
+        self.assertEqual(('s', str(expires), self.name),
+                         (prefix, signed_expires, name))
+        self.assertTrue(signing.verify(self.name, expires, signature, now))
+        self.assertFalse(signing.verify(self.name, expires, signature, expires))
+        self.assertFalse(signing.verify(self.name, expires + 1, signature, now))
+        self.assertFalse(signing.verify('a' + self.name[1:], expires,
+                                        signature, now))
+        with self.settings(SECRET_KEY='other'):
+            self.assertFalse(signing.verify(self.name, expires, signature, now))
+
+    def test_get(self):
+        path = signing.sign_name(self.name)
+        with self.assertNumQueries(0):
+            response = self.client.get(path)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/jpeg', response['Content-Type'])
+        self.assertIn('public', response['Cache-Control'])
+        max_age = int(response['Cache-Control'].split('max-age=')[1])
+        self.assertGreaterEqual(max_age, 7 * 24 * 3600 - 1)
+
+        response = self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+
+        with self.settings(IMS_X_ACCEL_REDIRECT_PREFIX='/protected/'):
+            response = self.client.get(path)
+        self.assertEqual('/protected/' + self.name, response['X-Accel-Redirect'])
+
+    def test_get_invalid(self):
+        expires = signing.get_expires()
+        signature = signing.get_signature(self.name, expires)
+        for path in ['/s/%s/%s/%s' % (expires, '0' * 32, self.name),
+                     '/s/%s/%s/%s' % (expires + 3600, signature, self.name),
+                     '/s/%s/%s/%s' % (expires, signature, 'settings.py')]:
+            self.assertEqual(404, self.client.get(path).status_code)
+
+        past = signing.get_expires() - 8 * 24 * 3600
+        path = signing.sign_name(self.name, past)
+        self.assertEqual(404, self.client.get(path).status_code)
+
 
 class AlbumsFindViewTest(WebViewTestBase):
     def test_get(self):
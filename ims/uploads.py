@@ -0,0 +1,146 @@
+"""
+Chunked uploads.
+A session receives the chunks of a file in order, appended to a part file
+in IMS_UPLOAD_SESSION_DIR, then the committed file is saved like a single
+request upload.
+The sha1 is updated as chunks arrive in the process receiving them, a
+commit handled by another process hashes the part file from the disk.
+"""
+import os
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from hashlib import sha1
+from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+from .models import UploadSession, ImageFile
+from .process import CHUNK_SIZE, check_upload_size, hash_stream
+from .process import get_or_create_image_file
+from .exceptions import InvalidParameter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+# sha1 objects of the sessions receiving chunks in this process
+MAX_CACHED_HASHES = 256
+_hashes = OrderedDict()
+_hashes_lock = threading.Lock()
+
+
+def get_chunk_size():
+    return getattr(settings, 'IMS_UPLOAD_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+def get_session_path(session: UploadSession):
+    upload_dir = getattr(settings, 'IMS_UPLOAD_SESSION_DIR', None) \
+        or os.path.join(tempfile.gettempdir(), 'ims-uploads')
+    return os.path.join(upload_dir, '%s.part' % session.id)
+
+
+def _get_cached_hash(session_id, offset):
+    with _hashes_lock:
+        cached = _hashes.get(session_id)
+    if cached and cached[0] == offset:
+        return cached[1].copy()
+    return None
+
+
+def _set_cached_hash(session_id, offset, hash_obj):
+    with _hashes_lock:
+        _hashes[session_id] = (offset, hash_obj)
+        _hashes.move_to_end(session_id)
+        while len(_hashes) > MAX_CACHED_HASHES:
+            _hashes.popitem(last=False)
+
+
+def _pop_cached_hash(session_id):
+    with _hashes_lock:
+        return _hashes.pop(session_id, None)
+
+
+def create_session(owner, album, filename, size, title=None) -> UploadSession:
+    check_upload_size(size)
+    session = UploadSession.objects.create(owner=owner, album=album,
+                                           filename=filename, size=size,
+                                           title=title)
+    path = get_session_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    _set_cached_hash(session.id, 0, sha1())
+    return session
+
+
+def write_chunk(session: UploadSession, index: int, stream) -> UploadSession:
+    """
+    Write the chunk of the index read from stream.
+    Chunks must be written in order, a chunk already received is ignored
+    so clients can resend the chunk whose response was lost.
+    """
+    chunk_size = get_chunk_size()
+    offset = index * chunk_size
+    if offset > session.received or offset >= session.size:
+        raise InvalidParameter('index')
+    expected_size = min(chunk_size, session.size - offset)
+    if offset < session.received:
+        # drain the request of a resent chunk
+        while stream.read(CHUNK_SIZE):
+            pass
+        return session
+
+    hash_obj = _get_cached_hash(session.id, offset)
+    size = 0
+    with open(get_session_path(session), 'r+b') as f:
+        f.seek(offset)
+        for data in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            size += len(data)
+            if size > expected_size:
+                raise InvalidParameter('chunk size')
+            f.write(data)
+            if hash_obj:
+                hash_obj.update(data)
+    if size != expected_size:
+        raise InvalidParameter('chunk size')
+
+    updated = UploadSession.objects \
+        .filter(id=session.id, received=offset) \
+        .update(received=offset + size, update_at=timezone.now())
+    if updated and hash_obj:
+        _set_cached_hash(session.id, offset + size, hash_obj)
+    session.refresh_from_db()
+    return session
+
+
+def commit_session(session: UploadSession) -> ImageFile:
+    """Save the received file as an image file and remove the session."""
+    if session.received != session.size:
+        raise InvalidParameter('upload, %s of %s bytes received'
+                               % (session.received, session.size))
+    path = get_session_path(session)
+    hash_obj = _get_cached_hash(session.id, session.size)
+    with open(path, 'rb') as f:
+        stream = File(f, name=session.filename)
+        sha1_hash = hash_obj.hexdigest() if hash_obj else hash_stream(stream)
+        image_file = get_or_create_image_file(stream, sha1_hash=sha1_hash)
+    delete_session(session)
+    return image_file
+
+
+def delete_session(session: UploadSession):
+    _pop_cached_hash(session.id)
+    path = get_session_path(session)
+    if os.path.exists(path):
+        os.remove(path)
+    session.delete()
+
+
+def delete_stale_sessions(timeout) -> int:
+    """Remove sessions which received nothing within the timeout."""
+    sessions = UploadSession.objects \
+        .filter(update_at__lt=timezone.now() - timeout)
+    count = 0
+    for session in sessions.iterator():
+        delete_session(session)
+        count += 1
+    return count
@@ -1,19 +1,34 @@
 from django.contrib import admin
-from django.urls import path
+from django.urls import path, re_path
 from django.views.decorators.csrf import csrf_exempt
 from graphene_django.views import GraphQLView
 from django.contrib.auth.decorators import login_required
 from . import views
-from .schema import schema
+from .schema import schema, validation_rules
 
 urlpatterns = [
     path('api/v1/image/upload', views.ApiUploadView.as_view(), name='ims_upload'),
+    path('api/v1/images/batch', views.ApiBatchUploadView.as_view()),
+    path('api/v1/files/exists', views.ApiImageFilesExistsView.as_view()),
+    path('api/v1/uploads', views.ApiUploadSessionsView.as_view()),
+    path('api/v1/uploads/<int:upload_id>', views.ApiUploadSessionView.as_view()),
+    path('api/v1/uploads/<int:upload_id>/chunks/<int:index>',
+         views.ApiUploadChunkView.as_view()),
+    path('api/v1/uploads/<int:upload_id>/commit', views.ApiUploadCommitView.as_view()),
     path('api/v1/image/crop', views.ApiImageCropView.as_view()),
     path('api/v1/image/<int:image_id>', views.ApiImageView.as_view()),
     path('api/v1/albums', views.APIAlbumsView.as_view()),
     path('api/v1/album/<int:album_id>', views.ApiAlbumInfo.as_view()),
     path('api/v1/albums/<int:album_id>', views.ApiAlbumInfo.as_view()),
+    path('api/v1/album/<int:album_id>/images', views.ApiAlbumImagesView.as_view()),
+    path('api/v1/cache/stats', views.ApiCacheStatsView.as_view()),
+    path('api/v1/duplicates', views.ApiNearDuplicatesView.as_view()),
     path('image/<int:image_id>', views.ImageView.as_view(), name='ims_view_image'),
+    path('files/<path:name>', views.FileView.as_view(), name='ims.file'),
+    path('s/<int:expires>/<str:signature>/<path:name>',
+         views.SignedFileView.as_view(), name='ims.signed_file'),
+    re_path(r'^r/(?P<sha1>[0-9a-f]{40})/(?P<width>\d+)x(?P<height>\d+)(?:\.(?P<ext>\w+))?$',
+            views.DerivativeView.as_view(), name='ims_derivative'),
     # path('dashboard', views.dashboard, name='ims.dashboard'),
     path('upload', views.UploadView.as_view(), name='upload'),
     # path('upload?aid=<int:album_id>', views.UploadView.as_view(), name='ims.upload_to_album'),
@@ -22,7 +37,8 @@ urlpatterns = [
     path('albums/find.json', views.AlbumsFindJsonView.as_view(), name='find_album_json'),
     path('albums/search', views.AlbumsSearchView.as_view(), name='ims.search_albums'),
     path('albums', views.AlbumIndexView.as_view(), name='ims.album_list'),
-    path(r'graphql', login_required(GraphQLView.as_view(graphiql=True, schema=schema))),
+    path(r'graphql', login_required(GraphQLView.as_view(
+        graphiql=True, schema=schema, validation_rules=validation_rules))),
     path('', views.HomeView.as_view(), name='ims_home')
     # path('images/<int:image_id>', views.ImageView.as_view(), name='ims_view_image')
 ]
\ No newline at end of file
@@ -1,21 +1,54 @@
-from io import BytesIO
+import re
+import time
+import mimetypes
+import json
 import logging
+from io import BytesIO
+from urllib.parse import urljoin, quote
 import requests
+from django.conf import settings
 from django.shortcuts import render, redirect
 from django.http import JsonResponse, HttpResponseBadRequest, HttpResponseNotFound
+from django.http import HttpResponse, HttpResponseRedirect
+from django.http import StreamingHttpResponse, FileResponse, Http404
 from django.views import View
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib import messages
 from django.views.generic.edit import CreateView
 from django.views import generic
 from django.urls import reverse
+from django.utils.cache import patch_vary_headers, patch_cache_control
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.views.static import serve
+from django.core.files.storage import default_storage
 from django.db import transaction, IntegrityError
+from django.db.models import Prefetch, prefetch_related_objects
+from django.db.models import OuterRef, Subquery, Q
 from rest_framework.views import APIView, Response
-from .models import Album, Image, ImageToFile, Category, Tag
+from rest_framework.renderers import JSONRenderer, BrowsableAPIRenderer
+from rest_framework.permissions import IsAdminUser
+from .models import Album, Image, ImageFile, ImageToFile, Category, Tag
+from .models import DerivativeJob, UploadSession, IMAGE_FILE_SHAPES, touch_album
 from .process import get_or_create_image_file, get_stream_from_source
 from .process import get_stream_from_upload_file, generate_thumbnail_file, MD_SIZE, SM_SIZE
+from .process import generate_derivative_files, attach_image_files
+from .jobs import is_async_derivatives_enabled, enqueue_derivatives
+from .pagination import encode_cursor, decode_cursor, parse_page_size
+from .renderers import NDJSONRenderer
+from .search import search_albums, get_typeahead_limit
+from .packstore import PackedStorage
+from .storage import get_file_url, get_signed_url
 from . import serializers
 from . import process
+from . import cache
+from . import derivatives
+from . import uploads
+from . import signing
+from . import duplicates
 from . import exceptions
 
 logger = logging.getLogger(__name__)
@@ -24,6 +57,87 @@ FORMAT_EXT = {'JPEG': 'jpg', "GIF": 'gif', "PNG": 'png'}
 
 PRESERVED_SHAPES = {'origin', 'md', 'sm'}
 
+# files addressed by their content never change under their url
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+IMAGE_FILE_PATH_RE = re.compile(r'^([0-9a-f]{2})/([0-9a-f]{2})/([0-9a-f]{36})\.\w+$')
+
+
+def get_album_version(request, album_id):
+    """Version of the user's album, from the cache, None if not found"""
+    def load():
+        album = Album.objects.filter(id=album_id) \
+            .values_list('owner_id', 'version', 'create_at').first()
+        if album:
+            return album[0], Album.make_cache_version(*album[1:])
+
+    owner_id, version = cache.get_album_version(album_id, load) or (None, None)
+    return version if owner_id == request.user.id else None
+
+
+def get_album_etag(request, album_id, **kwargs):
+    version = get_album_version(request, album_id)
+    if version and request.GET.get('signed'):
+        # the signed urls change with their expiry
+        return 'album-%s-v%s-s%s' % (album_id, version, signing.get_expires())
+    return version and 'album-%s-v%s' % (album_id, version)
+
+
+def get_image_etag(request, image_id, **kwargs):
+    album = Album.objects.filter(owner=request.user, image__id=image_id) \
+        .only('id', 'version', 'create_at').first()
+    return album and 'image-%s-%s-v%s' % (image_id, album.id,
+                                          album.cache_version)
+
+
+def revalidated(etag_func):
+    """Answer conditional requests of the view method by etag_func, the
+    response is kept by the client and revalidated on every use."""
+    def decorator(view_method):
+        view_method = method_decorator(condition(etag_func=etag_func))(view_method)
+        return method_decorator(cache_control(private=True, no_cache=True))(view_method)
+    return decorator
+
+
+def patch_immutable(response):
+    patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE,
+                        immutable=True)
+
+
+def patch_file_cache(response, is_public):
+    """Files of public albums are cached anywhere, the others by the
+    browser only"""
+    if is_public:
+        patch_immutable(response)
+    else:
+        patch_cache_control(response, private=True, max_age=IMMUTABLE_MAX_AGE)
+
+
+def serve_stored(request, path, document_root=None):
+    """Serve a stored file, from its segment when it's packed"""
+    if isinstance(default_storage, PackedStorage):
+        content = default_storage.read_packed(path)
+        if content is not None:
+            content_type = mimetypes.guess_type(path)[0]
+            return HttpResponse(content, content_type=content_type
+                                or 'application/octet-stream')
+    return serve(request, path, document_root)
+
+
+def serve_media(request, path, document_root=None):
+    """Serve stored files in development, or packed files, image files get
+    their sha1 as ETag and are cached for good."""
+    match = IMAGE_FILE_PATH_RE.match(path)
+    if not match:
+        return serve_stored(request, path, document_root)
+
+    etag = quote_etag(''.join(match.groups()))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = serve_stored(request, path, document_root)
+    response['ETag'] = etag
+    patch_immutable(response)
+    return response
+
 
 def upload_file_images(file=None, source=None):
     """
@@ -33,21 +147,39 @@ def upload_file_images(file=None, source=None):
     :return:
     """
     if source:
-        response = requests.get(source)
-        upload_file = BytesIO(response.content)
+        upload_file = get_stream_from_source(source)
     elif file:
         upload_file = file
     origin_image_file = get_or_create_image_file(upload_file)
-    if origin_image_file.size <= MD_SIZE:
-        md_image_file = origin_image_file
-    else:
-        md_image_file = generate_thumbnail_file(origin_image_file.photo.open(), MD_SIZE)
+    shape_files = generate_derivative_files(origin_image_file)
+    return origin_image_file, shape_files['md'], shape_files['sm']
+
+
+def get_missing_shapes(image):
+    shapes = set(image.imagetofile_set.values_list('shape', flat=True))
+    return [shape for shape in process.get_derivative_shapes()
+            if shape not in shapes]
 
-    if origin_image_file.size <= SM_SIZE:
-        sm_image_file = origin_image_file
+
+def get_pending_shapes(image):
+    """Shapes of the image whose files are still waiting for a worker."""
+    if not image.derivativejob_set.exists():
+        return []
+    return get_missing_shapes(image)
+
+
+def get_upload_album(user, data):
+    """The album to upload into, by `album_id`, `album` title or default."""
+    if 'album_id' in data:
+        album = Album.objects.get(owner=user, id=data['album_id'])
+    elif 'album' in data:
+        album_title = data['album']
+        album, _ = Album.objects.get_or_create(owner=user, title=album_title)
     else:
-        sm_image_file = generate_thumbnail_file(origin_image_file.photo.open(), SM_SIZE)
-    return origin_image_file, md_image_file, sm_image_file
+        album, _ = Album.objects.get_or_create(owner=user, title='default',
+                                               defaults={'owner': user,
+                                                         'title': 'default'})
+    return album
 
 
 def upload_image(request):
@@ -56,52 +188,55 @@ def upload_image(request):
         file_stream = get_stream_from_upload_file(request.FILES['file'])
     elif 'source' in request.POST:
         file_stream = get_stream_from_source(request.POST['source'])
+    elif 'sha1' in request.POST:
+        file_stream = None
 
     title = request.POST.get('title')
 
-    if 'album_id' in request.POST:
-        album = Album.objects.get(owner=user, id=request.POST['album_id'])
-    elif 'album' in request.POST:
-        album_title = request.POST['album']
-        album, _ = Album.objects.get_or_create(owner=user, title=album_title)
+    album = get_upload_album(user, request.POST)
+    if file_stream is None:
+        image_file = process.get_image_file(request.POST['sha1'], user)
+        default_title = image_file.origin_filename
     else:
-        album, _ = Album.objects.get_or_create(owner=user, title='default',
-                                               defaults={'owner': user,
-                                                         'title': 'default'})
-    image_file, medium_imagefile, thumbnail_imagefile = upload_file_images(
-        file_stream)
+        image_file = get_or_create_image_file(file_stream)
+        default_title = file_stream.name
+    return save_album_image(album, image_file, title, default_title)
+
+
+def save_album_image(album, image_file, title=None, default_title=None):
+    """
+    Create the image of an uploaded file in the album, or update the title of
+    the image when the album already has the file
+    :param default_title: title of a new image when title is not given
+    """
+    async_derivatives = is_async_derivatives_enabled()
+    if async_derivatives:
+        shape_files = {}
+    else:
+        shape_files = generate_derivative_files(image_file)
+    shape_files['origin'] = image_file
 
     with transaction.atomic():
+        saved = True
         try:
             new_image = Image.objects.get(album=album,
                                           origin_file=image_file)
-            if title:
+            if title and title != new_image.title:
                 new_image.title = title
+                new_image.save(update_fields=['title'])
+            else:
+                saved = False
         except Image.DoesNotExist:
             new_image = Image()
             new_image.album = album
-            new_image.title = title or file_stream.name
+            new_image.title = title or default_title
+            for shape in IMAGE_FILE_SHAPES:
+                setattr(new_image, shape + '_file', shape_files.get(shape))
             new_image.save()
 
-        origin_imagetofile, created = ImageToFile.objects.get_or_create(image=new_image,
-                                                               shape='origin', defaults={'file':image_file})
-        if not created:
-            origin_imagetofile.file = image_file
-            origin_imagetofile.save()
-
-        md_imagetofile, created = ImageToFile.objects.get_or_create(image=new_image,
-                                                               shape='md', defaults={'file':medium_imagefile})
-        if not created:
-            md_imagetofile.file = medium_imagefile
-            md_imagetofile.save()
-
-        sm_imagetofile, created = ImageToFile.objects.get_or_create(image=new_image,
-                                                               shape='sm', defaults={'file':thumbnail_imagefile})
-        if not created:
-            sm_imagetofile.file = thumbnail_imagefile
-            sm_imagetofile.save()
-
-        new_image.save()
+        attach_image_files(new_image, shape_files, touch=not saved)
+        if async_derivatives and get_missing_shapes(new_image):
+            enqueue_derivatives(new_image)
     return new_image
 
 
@@ -112,7 +247,8 @@ class ApiUploadView(APIView):
             return JsonResponse({
                 'image_id': new_image.id,
                 'image': {
-                    'id': new_image.id
+                    'id': new_image.id,
+                    'pending_shapes': get_pending_shapes(new_image),
                 },
             })
         except exceptions.ImsException as e:
@@ -122,6 +258,281 @@ class ApiUploadView(APIView):
             }, status=400)
 
 
+class ApiImageFilesExistsView(APIView):
+    def post(self, request):
+        if hasattr(request.data, 'getlist'):
+            hashes = request.data.getlist('sha1')
+        else:
+            hashes = request.data.get('sha1', [])
+        max_items = getattr(settings, 'IMS_FILES_EXISTS_MAX_ITEMS', 1000)
+        if not isinstance(hashes, list) or len(hashes) > max_items \
+                or not all(isinstance(x, str) for x in hashes):
+            return JsonResponse({
+                'error_code': exceptions.INVALID_PARAMETER,
+                'error_msg': 'Up to %s sha1 hashes required.' % max_items,
+            }, status=400)
+
+        hashes = [x.lower() for x in hashes]
+        # only the user's files, the others' are not disclosed
+        existing = set(process.get_owned_image_files(request.user)
+                       .filter(sha1__in=hashes).values_list('sha1', flat=True))
+        return JsonResponse({'exists': [x for x in hashes if x in existing]})
+
+
+def serialize_upload_session(session):
+    chunk_size = uploads.get_chunk_size()
+    return {
+        'id': session.id,
+        'size': session.size,
+        'received': session.received,
+        'chunk_size': chunk_size,
+        'next_index': session.received // chunk_size,
+    }
+
+
+class ApiUploadSessionsView(APIView):
+    def post(self, request):
+        try:
+            album = get_upload_album(request.user, request.data)
+        except Album.DoesNotExist:
+            return JsonResponse({'err_code': exceptions.ERROR_OBJECT_NOT_FOUND,
+                                 'err_msg': 'Album not found.'}, status=404)
+        try:
+            size = int(request.data.get('size', ''))
+        except ValueError:
+            size = -1
+        filename = request.data.get('filename')
+        if size <= 0 or not filename:
+            return JsonResponse({
+                'error_code': exceptions.PARAMETER_REQUIRED,
+                'error_msg': 'filename and size are required.',
+            }, status=400)
+
+        try:
+            session = uploads.create_session(request.user, album, filename,
+                                             size, request.data.get('title'))
+        except exceptions.ImsException as e:
+            return JsonResponse({'error_code': e.error_code,
+                                 'error_msg': e.error_msg}, status=400)
+        return JsonResponse({'upload': serialize_upload_session(session)})
+
+
+class UploadSessionAPIView(APIView):
+    def dispatch_session(self, request, upload_id, action):
+        """Call action with the upload session of the user"""
+        try:
+            session = UploadSession.objects.get(owner=request.user,
+                                                id=upload_id)
+        except UploadSession.DoesNotExist:
+            return JsonResponse({'err_code': exceptions.ERROR_OBJECT_NOT_FOUND,
+                                 'err_msg': 'Upload not found.'}, status=404)
+        try:
+            return action(session)
+        except exceptions.ImsException as e:
+            return JsonResponse({'error_code': e.error_code,
+                                 'error_msg': e.error_msg}, status=400)
+
+
+class ApiUploadSessionView(UploadSessionAPIView):
+    def get(self, request, upload_id):
+        return self.dispatch_session(
+            request, upload_id,
+            lambda session: JsonResponse(
+                {'upload': serialize_upload_session(session)}))
+
+    def delete(self, request, upload_id):
+        def delete(session):
+            uploads.delete_session(session)
+            return JsonResponse({})
+        return self.dispatch_session(request, upload_id, delete)
+
+
+class ApiUploadChunkView(UploadSessionAPIView):
+    def put(self, request, upload_id, index):
+        stream = request.stream or BytesIO()
+        return self.dispatch_session(
+            request, upload_id,
+            lambda session: JsonResponse({'upload': serialize_upload_session(
+                uploads.write_chunk(session, index, stream))}))
+
+
+class ApiUploadCommitView(UploadSessionAPIView):
+    def post(self, request, upload_id):
+        def commit(session):
+            image_file = uploads.commit_session(session)
+            new_image = save_album_image(session.album, image_file,
+                                         session.title, session.filename)
+            return JsonResponse({
+                'image_id': new_image.id,
+                'image': {
+                    'id': new_image.id,
+                    'pending_shapes': get_pending_shapes(new_image),
+                },
+            })
+        return self.dispatch_session(request, upload_id, commit)
+
+
+def find_derivative_file_ids(origin_file_ids) -> dict:
+    """
+    Derivative files already generated for origin files by other images
+    :return: dict of origin file id to {shape: file id}
+    """
+    shapes = process.get_derivative_shapes()
+    image_files = {}
+    for origin_file_id, image_id, shape, file_id in ImageToFile.objects \
+            .filter(image__origin_file__in=origin_file_ids, shape__in=shapes) \
+            .values_list('image__origin_file_id', 'image_id', 'shape', 'file_id'):
+        image_files.setdefault((origin_file_id, image_id), {})[shape] = file_id
+
+    derivative_file_ids = {}
+    for (origin_file_id, _), shape_file_ids in image_files.items():
+        if len(shape_file_ids) == len(shapes):
+            derivative_file_ids[origin_file_id] = shape_file_ids
+    return derivative_file_ids
+
+
+def batch_upload_images(album, streams) -> list:
+    """
+    Save many image files into an album at once
+    Files are deduplicated with one query, images and their files are
+    inserted in bulk in one transaction.
+    :param album: the album to upload into
+    :param streams: list of file streams, or ImsException for items which
+        failed before upload
+    :return: list of result dicts in the order of streams
+    """
+    results = [None] * len(streams)
+    hashes = {}
+    for index, stream in enumerate(streams):
+        try:
+            if isinstance(stream, exceptions.ImsException):
+                raise stream
+            hashes[index] = getattr(stream, 'sha1', None) \
+                or process.hash_stream(stream)
+        except exceptions.ImsException as e:
+            results[index] = {'status': 'error',
+                              'error_code': e.error_code,
+                              'error_msg': e.error_msg}
+
+    image_files = ImageFile.objects.in_bulk(set(hashes.values()),
+                                            field_name='sha1')
+    reused_file_ids = {image_file.id for image_file in image_files.values()}
+    for index, sha1_hash in hashes.items():
+        if sha1_hash in image_files:
+            continue
+        try:
+            image_files[sha1_hash] = get_or_create_image_file(
+                streams[index], sha1_hash=sha1_hash)
+        except exceptions.ImsException as e:
+            results[index] = {'status': 'error',
+                              'error_code': e.error_code,
+                              'error_msg': e.error_msg}
+
+    origin_files = {}
+    for index, sha1_hash in hashes.items():
+        if results[index] is None:
+            origin_files.setdefault(image_files[sha1_hash].id, index)
+
+    async_derivatives = is_async_derivatives_enabled()
+    derivative_file_ids = find_derivative_file_ids(origin_files.keys())
+    reused_file_ids.update(file_id for shape_file_ids in derivative_file_ids.values()
+                           for file_id in shape_file_ids.values())
+    shapes = process.get_derivative_shapes()
+    existing_images = dict(
+        Image.objects.filter(album=album, origin_file__in=origin_files.keys())
+        .values_list('origin_file_id', 'id'))
+    # decoded, encoded and stored before the transaction, which only
+    # inserts the rows
+    for origin_file_id, index in origin_files.items():
+        if origin_file_id in existing_images \
+                or origin_file_id in derivative_file_ids or async_derivatives:
+            continue
+        origin_file = image_files[hashes[index]]
+        derivative_file_ids[origin_file_id] = {
+            shape: image_file.id for shape, image_file
+            in generate_derivative_files(origin_file).items()}
+
+    with transaction.atomic():
+        # touched like get_image_file does, so the garbage collection
+        # keeps the files bound below
+        ImageFile.objects.filter(id__in=reused_file_ids) \
+            .update(update_at=timezone.now())
+        new_images = []
+        for origin_file_id, index in origin_files.items():
+            if origin_file_id in existing_images:
+                continue
+            shape_file_ids = derivative_file_ids.get(origin_file_id, {})
+            new_images.append(Image(album=album,
+                                    title=streams[index].name,
+                                    origin_file_id=origin_file_id,
+                                    md_file_id=shape_file_ids.get('md'),
+                                    sm_file_id=shape_file_ids.get('sm')))
+        Image.objects.bulk_create(new_images)
+        created_images = dict(
+            Image.objects.filter(album=album,
+                                 origin_file__in=[x.origin_file_id for x in new_images])
+            .values_list('origin_file_id', 'id'))
+        ImageToFile.objects.bulk_create(
+            [ImageToFile(image_id=image_id, shape=shape, file_id=file_id)
+             for origin_file_id, image_id in created_images.items()
+             for shape, file_id in dict(
+                 derivative_file_ids.get(origin_file_id, {}),
+                 origin=origin_file_id).items()])
+        DerivativeJob.objects.bulk_create(
+            [DerivativeJob(image_id=image_id)
+             for origin_file_id, image_id in created_images.items()
+             if len(derivative_file_ids.get(origin_file_id, {})) < len(shapes)])
+        if new_images:
+            touch_album(album.id)
+
+    for index, sha1_hash in hashes.items():
+        if results[index] is not None:
+            continue
+        origin_file_id = image_files[sha1_hash].id
+        created = origin_file_id in created_images \
+            and origin_files[origin_file_id] == index
+        image_id = created_images.get(origin_file_id) \
+            or existing_images.get(origin_file_id)
+        results[index] = {'status': 'created' if created else 'exists',
+                          'image': {'id': image_id}}
+    return results
+
+
+class ApiBatchUploadView(APIView):
+    def post(self, request):
+        try:
+            album = get_upload_album(request.user, request.data)
+        except Album.DoesNotExist:
+            return JsonResponse({'err_code': exceptions.ERROR_OBJECT_NOT_FOUND,
+                                 'err_msg': 'Album not found.'}, status=404)
+
+        files = request.FILES.getlist('file')
+        if hasattr(request.data, 'getlist'):
+            sources = request.data.getlist('source')
+        else:
+            sources = request.data.get('sources', [])
+        # checked before anything is downloaded
+        max_items = getattr(settings, 'IMS_BATCH_UPLOAD_MAX_ITEMS', 100)
+        if not isinstance(sources, list) \
+                or not 0 < len(files) + len(sources) <= max_items:
+            return JsonResponse({
+                'error_code': exceptions.INVALID_PARAMETER,
+                'error_msg': 'Between 1 and %s files or sources required.' % max_items,
+            }, status=400)
+
+        streams = [get_stream_from_upload_file(f) for f in files]
+        for source in sources:
+            try:
+                streams.append(get_stream_from_source(source))
+            except exceptions.ImsException as e:
+                streams.append(e)
+            except requests.RequestException:
+                streams.append(exceptions.SourceDownloadFailed(source))
+
+        results = batch_upload_images(album, streams)
+        return JsonResponse({'album': {'id': album.id}, 'results': results})
+
+
 class ApiImageCropView(APIView):
     def post(self, request):
         image_id = request.POST['image_id']
@@ -133,7 +544,7 @@ class ApiImageCropView(APIView):
         if 'shape' not in request.POST:
             return HttpResponseBadRequest('shape parameter not provided.')
         shape = request.POST['shape'].lower()
-        if shape in PRESERVED_SHAPES:
+        if shape in PRESERVED_SHAPES or shape in process.get_derivative_shapes():
             return HttpResponseBadRequest('shape name preserved.')
         positions = [int(x) for x in request.POST['pos'].split(',')]
         if len(positions) != 4:
@@ -151,40 +562,125 @@ class ApiImageCropView(APIView):
 
         except ImageToFile.DoesNotExist:
             ImageToFile(image=image, shape=shape, file=new_image_file).save()
+        touch_album(image.album_id)
 
         return JsonResponse({'image': {'id': image.id}})
 
 
+def get_album_images(album):
+    """Images of the album with all their files loaded in constant queries."""
+    return album.image_set \
+        .select_related('origin_file', 'md_file', 'sm_file') \
+        .prefetch_related(Prefetch('imagetofile_set',
+                                   queryset=ImageToFile.objects.select_related('file'))) \
+        .order_by('id')
+
+
+def image_file_url_builder(request):
+    """
+    Build absolute urls of image files
+    The url of each ImageFile is only built once per request.
+    """
+    base_url = request.build_absolute_uri('/')
+    urls = {}
+
+    def get_url(image_file):
+        url = urls.get(image_file.id)
+        if url is None:
+            url = urls[image_file.id] = urljoin(
+                base_url, get_file_url(image_file.photo.name))
+        return url
+    return get_url
+
+
+def signed_file_url_builder(request, image_files, expires):
+    """
+    Build absolute signed urls of image files
+    The files are signed together, so they share one expiry time.
+    """
+    base_url = request.build_absolute_uri('/')
+    paths = signing.sign_names({image_file.photo.name
+                                for image_file in image_files}, expires)
+
+    def get_url(image_file):
+        return urljoin(base_url, paths[image_file.photo.name])
+    return get_url
+
+
+def serialize_image_file(image_file, get_url):
+    return {
+        'url': get_url(image_file),
+        'width': image_file.width,
+        'height': image_file.height,
+        'file_size': image_file.file_size,
+    }
+
+
+def serialize_album_image(image, get_url):
+    return {
+        'id': image.id,
+        'title': image.title,
+        'files': {
+            imagetofile.shape: serialize_image_file(imagetofile.file, get_url)
+            for imagetofile in image.imagetofile_set.all()
+        }
+    }
+
+
+def serialize_image(image, get_url):
+    image_data = serialize_album_image(image, get_url)
+    for shape in IMAGE_FILE_SHAPES:
+        image_file = getattr(image, shape + '_file')
+        image_data[shape] = {'url': get_url(image_file)} if image_file else None
+    return image_data
+
+
+def iter_image_chunks(images, imagetofiles, chunk_size):
+    """
+    Iterate images from the database cursor in chunks
+    Each chunk gets its image files prefetched, memory use depends on the
+    chunk size only.
+    """
+    chunk = []
+    for image in images.iterator(chunk_size=chunk_size):
+        chunk.append(image)
+        if len(chunk) == chunk_size:
+            prefetch_related_objects(chunk, imagetofiles)
+            yield chunk
+            chunk = []
+    if chunk:
+        prefetch_related_objects(chunk, imagetofiles)
+        yield chunk
+
+
 class ApiAlbumInfo(APIView):
+    @revalidated(get_album_etag)
     def get(self, request, album_id):
-        try:
-            album = Album.objects.get(owner=request.user,
-                                     id=album_id)
-        except Album.DoesNotExist:
+        version = get_album_version(request, album_id)
+        if version is None:
             return JsonResponse({'err_code': exceptions.ERROR_OBJECT_NOT_FOUND,
                                  'err_msg': 'Album not found.'}, status=404)
 
-        image_list = [{
-            'id': image.id,
-            'title': image.title,
-            'origin': {
-                'url': request.build_absolute_uri(image.origin_file.photo.url),
-            },
-            'md': {
-                'url': request.build_absolute_uri(image.md_file.photo.url),
-            },
-            'sm': {
-                'url': request.build_absolute_uri(image.sm_file.photo.url),
-            },
-            'files': {
-                imagetofile.shape: {
-                    'url': request.build_absolute_uri(imagetofile.file.photo.url),
-                    'width': imagetofile.file.width,
-                    'height': imagetofile.file.height,
-                    'file_size': imagetofile.file.file_size,
-                } for imagetofile in image.imagetofile_set.all()
-            }
-        } for image in album.image_set.all()]
+        # signed urls are shared without a session, until they expire
+        expires = signing.get_expires() if request.GET.get('signed') else None
+        content = cache.get_or_build(
+            'info', album_id, version,
+            lambda: self.render_album(request, album_id, expires),
+            request.build_absolute_uri('/'), expires or '')
+        return HttpResponse(content, content_type='application/json')
+
+    @staticmethod
+    def render_album(request, album_id, expires=None):
+        album = Album.objects.select_related('category').get(id=album_id)
+        images = list(get_album_images(album))
+        if expires:
+            get_url = signed_file_url_builder(
+                request, [imagetofile.file for image in images
+                          for imagetofile in image.imagetofile_set.all()],
+                expires)
+        else:
+            get_url = image_file_url_builder(request)
+        image_list = [serialize_image(image, get_url) for image in images]
         ret_data = {
             'album': {
                 'id': album.id,
@@ -194,7 +690,7 @@ class ApiAlbumInfo(APIView):
                 'tags': [x.text for x in album.tags.all()],
             }
         }
-        return JsonResponse(ret_data)
+        return JsonResponse(ret_data).content
 
     def delete(self, request, album_id):
         try:
@@ -207,7 +703,59 @@ class ApiAlbumInfo(APIView):
         return JsonResponse({})
 
 
+class ApiAlbumImagesView(APIView):
+    renderer_classes = [JSONRenderer, BrowsableAPIRenderer, NDJSONRenderer]
+    stream_chunk_size = 500
+
+    def get(self, request, album_id):
+        try:
+            album = Album.objects.get(owner=request.user, id=album_id)
+        except Album.DoesNotExist:
+            return JsonResponse({'err_code': exceptions.ERROR_OBJECT_NOT_FOUND,
+                                 'err_msg': 'Album not found.'}, status=404)
+
+        images = album.image_set.order_by('id').only('id', 'album', 'title')
+        imagetofiles = ImageToFile.objects.select_related('file')
+        if request.GET.get('shapes'):
+            shapes = [x.strip() for x in request.GET['shapes'].split(',')]
+            imagetofiles = imagetofiles.filter(shape__in=shapes)
+        imagetofiles = Prefetch('imagetofile_set', queryset=imagetofiles)
+        try:
+            if request.GET.get('cursor'):
+                images = images.filter(
+                    id__gt=decode_cursor(request.GET['cursor']))
+            page_size = parse_page_size(request.GET.get('page_size'))
+        except exceptions.InvalidParameter as e:
+            return JsonResponse({'error_code': e.error_code,
+                                 'error_msg': e.error_msg}, status=400)
+
+        if request.accepted_renderer.format == 'ndjson':
+            return StreamingHttpResponse(
+                self.iter_lines(request, images, imagetofiles),
+                content_type=NDJSONRenderer.media_type)
+
+        get_url = image_file_url_builder(request)
+        images = list(images[:page_size])
+        prefetch_related_objects(images, imagetofiles)
+        next_cursor = None
+        if images and len(images) == page_size:
+            next_cursor = encode_cursor(images[-1].id)
+        return JsonResponse({
+            'images': [serialize_album_image(image, get_url)
+                       for image in images],
+            'next_cursor': next_cursor,
+        })
+
+    def iter_lines(self, request, images, imagetofiles):
+        for chunk in iter_image_chunks(images, imagetofiles,
+                                       self.stream_chunk_size):
+            get_url = image_file_url_builder(request)
+            for image in chunk:
+                yield json.dumps(serialize_album_image(image, get_url)) + '\n'
+
+
 class ImageView(View):
+    @revalidated(get_image_etag)
     def get(self, request, image_id):
         try:
             image = Image.objects.get(album__owner=request.user, id=image_id)
@@ -215,11 +763,179 @@ class ImageView(View):
             return HttpResponseNotFound()
 
         image_link = request.build_absolute_uri(reverse('ims_view_image', args=(image.id, )))
-        image_url = request.build_absolute_uri(image.origin_file.photo.url)
+        image_url = request.build_absolute_uri(
+            get_file_url(image.origin_file.photo.name))
 
         return render(request, 'ims/view_image.html', {'image': image, 'image_link':image_link, 'image_url': image_url})
 
 
+class DerivativeView(View):
+    """
+    Image file resized on first request, served from the cache then.
+    Like /files/, only the owners of the albums having the file may read
+    it, and everyone once one of the albums is public.
+    """
+    def get(self, request, sha1, width, height, ext=None):
+        size = (int(width), int(height))
+        if size not in derivatives.get_allowed_sizes():
+            raise Http404('Derivative not available.')
+        is_public = get_file_access(request.user, sha1)
+        if is_public is None:
+            raise Http404('Image file not found.')
+        if ext:
+            image_format = process.EXT_FORMAT.get(ext.lower())
+            if not image_format or not process.can_encode(image_format):
+                raise Http404('Derivative not available.')
+            # revalidated without looking up the file
+            response = self.get_not_modified(request, sha1, size,
+                                             image_format, is_public)
+            if response:
+                return response
+        try:
+            image_file = ImageFile.objects.get(sha1=sha1)
+        except ImageFile.DoesNotExist:
+            raise Http404('Image file not found.')
+        if not ext:
+            source_format = image_file.format
+            if source_format not in process.FORMAT_MIME:
+                source_format = 'JPEG'
+            image_format = process.negotiate_format(
+                request.META.get('HTTP_ACCEPT'), source_format)
+            response = self.get_not_modified(request, sha1, size,
+                                             image_format, is_public)
+            if response:
+                patch_vary_headers(response, ['Accept'])
+                return response
+
+        derivative = derivatives.get_or_render_derivative(image_file, size,
+                                                          image_format)
+        try:
+            content = derivative.photo.open()
+        except FileNotFoundError:
+            # the file went away under the cache entry, render it again
+            derivative.delete()
+            derivative = derivatives.get_or_render_derivative(
+                image_file, size, image_format)
+            content = derivative.photo.open()
+        response = FileResponse(content,
+                                content_type=process.FORMAT_MIME[image_format])
+        response['ETag'] = self.get_etag(sha1, size, image_format)
+        patch_file_cache(response, is_public)
+        if not ext:
+            patch_vary_headers(response, ['Accept'])
+        return response
+
+    @staticmethod
+    def get_etag(sha1, size, image_format):
+        return quote_etag('%s-%sx%s-%s' % (sha1, size[0], size[1],
+                                           image_format.lower()))
+
+    def get_not_modified(self, request, sha1, size, image_format, is_public):
+        etag = self.get_etag(sha1, size, image_format)
+        response = get_conditional_response(request, etag=etag)
+        if response is not None:
+            response['ETag'] = etag
+            patch_file_cache(response, is_public)
+        return response
+
+
+def get_file_access(user, sha1):
+    """
+    :return: True when an image of a public album has the file, False when
+        only images of the user's albums have it, None otherwise
+    """
+    return ImageToFile.objects \
+        .filter(file__sha1=sha1) \
+        .filter(Q(image__album__is_public=True)
+                | Q(image__album__owner_id=user.id)) \
+        .order_by('-image__album__is_public') \
+        .values_list('image__album__is_public', flat=True).first()
+
+
+def send_stored_file(name):
+    """
+    Response handing the transfer of a stored file to the storage or the
+    web server: a signed redirect on S3, X-Accel-Redirect to the internal
+    location of IMS_X_ACCEL_REDIRECT_PREFIX for nginx, X-Sendfile with
+    IMS_X_SENDFILE. Only packed files and files of development servers
+    are sent by the application.
+    """
+    if getattr(default_storage, 'bucket', None) is not None:
+        return HttpResponseRedirect(get_signed_url(
+            default_storage, name,
+            getattr(settings, 'IMS_SIGNED_URL_EXPIRE', 300)))
+
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if isinstance(default_storage, PackedStorage):
+        content = default_storage.read_packed(name)
+        if content is not None:
+            return HttpResponse(content, content_type=content_type)
+    if not default_storage.exists(name):
+        raise Http404('Image file not found.')
+
+    accel_prefix = getattr(settings, 'IMS_X_ACCEL_REDIRECT_PREFIX', None)
+    if accel_prefix:
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = accel_prefix + quote(name)
+        return response
+    if getattr(settings, 'IMS_X_SENDFILE', False):
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = default_storage.path(name)
+        return response
+    return FileResponse(default_storage.open(name), content_type=content_type)
+
+
+class FileView(View):
+    """
+    Image files readable by the owners of the albums having them, and by
+    everyone once an album having them is public.
+    A file no album of the user has is not found, so its existence isn't
+    disclosed.
+    """
+    def get(self, request, name):
+        match = IMAGE_FILE_PATH_RE.match(name)
+        if not match:
+            raise Http404('Image file not found.')
+        is_public = get_file_access(request.user, ''.join(match.groups()))
+        if is_public is None:
+            raise Http404('Image file not found.')
+
+        etag = quote_etag(''.join(match.groups()))
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = send_stored_file(name)
+        response['ETag'] = etag
+        if isinstance(response, HttpResponseRedirect):
+            # the signed url expires
+            patch_cache_control(response, private=True, max_age=60)
+        else:
+            patch_file_cache(response, is_public)
+        return response
+
+
+class SignedFileView(View):
+    """
+    Image files of signed urls, checked with the secret only: no session
+    and no database query unless the file is packed.
+    """
+    def get(self, request, expires, signature, name):
+        match = IMAGE_FILE_PATH_RE.match(name)
+        if not match or not signing.verify(name, expires, signature):
+            raise Http404('Image file not found.')
+
+        etag = quote_etag(''.join(match.groups()))
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = send_stored_file(name)
+        response['ETag'] = etag
+        # the url is valid until it expires, the file never changes
+        max_age = int(expires - time.time())
+        if isinstance(response, HttpResponseRedirect):
+            max_age = min(max_age, 60)
+        patch_cache_control(response, public=True, max_age=max_age)
+        return response
+
+
 class UploadView(LoginRequiredMixin, View):
     def get(self, request):
         if 'aid' in request.GET:
@@ -246,7 +962,7 @@ class AlbumView(LoginRequiredMixin, View):
         album = Album.objects.get(owner=request.user, id=album_id)
 
         # images = [x.imagetofile_set.all()[0] for x in album.image_set.all()]
-        images = album.image_set.all()
+        images = album.image_set.select_related('origin_file', 'sm_file')
         return render(request, 'ims/album.html', {
             'album': album,
             'images': images
@@ -257,21 +973,35 @@ class APIAlbumsView(APIView):
     def get(self, request):
         page_size = int(request.GET.get('page_size', 100))
         page_size = min(100, page_size)
-        page_index = int(request.GET.get('page_index', 1))
-        query = Album.objects.filter(owner=request.user)
+        query = Album.objects.filter(owner=request.user) \
+            .select_related('category')
         if 'title' in request.GET:
             query = query.filter(title=request.GET['title'])
 
         albums = query.order_by('-id')
-        albums = albums[(page_index-1) * page_size:
-                        page_index * page_size]
+        if 'cursor' in request.GET:
+            try:
+                last_id = decode_cursor(request.GET['cursor'])
+            except exceptions.InvalidParameter as e:
+                return JsonResponse({'error_code': e.error_code,
+                                     'error_msg': e.error_msg}, status=400)
+            albums = albums.filter(id__lt=last_id)[:page_size]
+        else:
+            page_index = int(request.GET.get('page_index', 1))
+            albums = albums[(page_index-1) * page_size:
+                            page_index * page_size]
+        albums = list(albums)
 
         albums_list = [{'id': album.id,
                         'title': album.title,
                         'category': album.category.title if album.category else None}
                        for album in albums]
+        next_cursor = None
+        if albums and len(albums) == page_size:
+            next_cursor = encode_cursor(albums[-1].id)
 
-        return JsonResponse({'albums': albums_list})
+        return JsonResponse({'albums': albums_list,
+                             'next_cursor': next_cursor})
 
     def post(self, request):
         title = request.data['title']
@@ -329,6 +1059,14 @@ class CreateAlbumView(LoginRequiredMixin, CreateView):
             return self.get(self.request)
 
 
+def with_cover_photo(albums):
+    """Annotate albums with `cover_photo`, the md file name of their first
+    image, selected by a subquery of the album list query."""
+    return albums.annotate(cover_photo=Subquery(
+        Image.objects.filter(album=OuterRef('pk')).order_by('id')
+        .values('md_file__photo')[:1]))
+
+
 class AlbumIndexView(LoginRequiredMixin, generic.ListView):
     template_name_suffix = '_index'
     paginate_by = 24
@@ -340,7 +1078,39 @@ class AlbumIndexView(LoginRequiredMixin, generic.ListView):
         category_id = self.request.GET.get('cid')
         if category_id:
             query = query.filter(category_id=category_id)
-        return query
+        return with_cover_photo(query).order_by(*self.ordering)
+
+
+class ApiCacheStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return JsonResponse({'cache': cache.get_stats()})
+
+
+class ApiNearDuplicatesView(APIView):
+    def get(self, request):
+        try:
+            max_distance = int(request.GET.get('distance',
+                                               duplicates.get_max_distance()))
+            if not 0 <= max_distance <= duplicates.MAX_DISTANCE:
+                raise ValueError()
+        except ValueError:
+            e = exceptions.InvalidParameter('distance')
+            return JsonResponse({'error_code': e.error_code,
+                                 'error_msg': e.error_msg}, status=400)
+
+        clusters = duplicates.get_near_duplicates(request.user, max_distance)
+        images = Image.objects.select_related('origin_file').in_bulk(
+            [image_id for cluster in clusters for image_id in cluster])
+        get_url = image_file_url_builder(request)
+        return JsonResponse({'clusters': [{'images': [{
+            'id': image_id,
+            'album_id': images[image_id].album_id,
+            'title': images[image_id].title,
+            'origin': serialize_image_file(images[image_id].origin_file,
+                                           get_url),
+        } for image_id in cluster]} for cluster in clusters]})
 
 
 class AlbumsFindJsonView(LoginRequiredMixin, View):
@@ -348,9 +1118,8 @@ class AlbumsFindJsonView(LoginRequiredMixin, View):
         q = request.GET.get('q')
 
         ret_values = []
-        for row in Album.objects.filter(
-                owner=request.user, title__contains=q)\
-                .values_list('id', 'title', named=True):
+        for row in search_albums(request.user, q) \
+                .values_list('id', 'title', named=True)[:get_typeahead_limit()]:
             ret_values.append({'value': row.id, 'text': row.title})
 
         return JsonResponse(ret_values, safe=False)
@@ -359,12 +1128,11 @@ class AlbumsFindJsonView(LoginRequiredMixin, View):
 class AlbumsSearchView(AlbumIndexView):
     def get_queryset(self):
         q = self.request.GET.get('q')
-        return Album.objects.filter(owner=self.request.user,
-                                    title__contains=q) \
-            .order_by(*self.ordering)
+        return with_cover_photo(search_albums(self.request.user, q))
 
 
 class ApiImageView(APIView):
+    @revalidated(get_image_etag)
     def get(self, request, image_id):
         image = Image.objects.get(album__owner=request.user, id=image_id)
         serializer = serializers.ImageSerializer(image)